@@ -35,11 +35,11 @@ export function CompanyCard({ company: c }: CompanyCardProps) {
 				</div>
 				<div>{shortenSector(c.sector)}</div>
 			</div>
-			{(c.deepReport?.riskAssessment?.concerns || c.shallowReport?.riskAssessment?.concerns) && (
+			{c.concerns && (
 				<div className="mt-2">
 					<p className="text-xs font-semibold uppercase text-gray-500 dark:text-gray-400">Concerns</p>
 					<p className="text-sm text-gray-700 dark:text-gray-200">
-						{truncate(c.deepReport?.riskAssessment?.concerns || c.shallowReport?.riskAssessment?.concerns || '', 100)}
+						{truncate(c.concerns, 100)}
 					</p>
 				</div>
 			)}
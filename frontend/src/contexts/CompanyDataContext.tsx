@@ -1,5 +1,5 @@
 import { createContext, useContext, useState, useEffect, ReactNode } from 'react'
-import { Company } from '../types'
+import { Company, CompanyDetail } from '../types'
 
 interface CompanyDataContextType {
 	companies: Company[]
@@ -7,19 +7,29 @@ interface CompanyDataContextType {
 	error: Error | null
 }
 
-const CompanyDataContext = createContext<CompanyDataContextType | undefined>(undefined)
+// Detail files are content-hashed, so a fetched detail never goes stale within a session
+const detailCache = new Map<string, Promise<CompanyDetail>>()
 
-// Helper to determine AI report status
-const getAiReportStatus = (company: any): number => {
-	if (company.state === 'done_deep' && company.deepReport) {
-		return 2 // Full report
+export const fetchCompanyDetail = (company: Company): Promise<CompanyDetail> => {
+	if (!company.detail) {
+		return Promise.resolve({ id: company.id })
 	}
-	if (company.state === 'done_shallow' && company.shallowReport) {
-		return 1 // Shallow report
+	let detail = detailCache.get(company.detail)
+	if (!detail) {
+		detail = fetch(`${import.meta.env.BASE_URL}data/${company.detail}`).then((res) => {
+			if (!res.ok) {
+				throw new Error('Network response was not ok')
+			}
+			return res.json()
+		})
+		detail.catch(() => detailCache.delete(company.detail!))
+		detailCache.set(company.detail, detail)
 	}
-	return 0 // No report
+	return detail
 }
 
+const CompanyDataContext = createContext<CompanyDataContextType | undefined>(undefined)
+
 export const CompanyProvider = ({ children }: { children: ReactNode }) => {
 	const [companies, setCompanies] = useState<Company[]>([])
 	const [loading, setLoading] = useState(true)
@@ -28,7 +38,7 @@ export const CompanyProvider = ({ children }: { children: ReactNode }) => {
 	useEffect(() => {
 		async function fetchData() {
 			try {
-				const res = await fetch(`${import.meta.env.BASE_URL}data/investments_exported.json`)
+				const res = await fetch(`${import.meta.env.BASE_URL}data/investments_index.json`)
 
 				if (!res.ok) {
 					throw new Error('Network response was not ok')
@@ -36,34 +46,24 @@ export const CompanyProvider = ({ children }: { children: ReactNode }) => {
 
 				const data = await res.json()
 
+				// The index only carries what the list needs; reports are in the per-company detail files
 				const transformedCompanies = data.map(
-					(item: any): Company => {
-						const shallowReport = item.shallowReport
-						const deepReport = item.deepReport
-
-						let category: number | undefined
-						if (deepReport && deepReport.riskAssessment) {
-							category = parseInt(deepReport.riskAssessment.category, 10)
-						} else if (shallowReport && shallowReport.riskAssessment) {
-							category = parseInt(shallowReport.riskAssessment.category, 10)
-						}
-
-						return {
-							id: item.id,
-							name: item.name,
-							country: item.country,
-							sector: item.industry, // Assuming 'industry' maps to 'sector'
-							marketValueNok: parseFloat(String(item.marketValueNok).replace(/ /g, '')) || 0,
-							ownership: parseFloat(String(item.ownership).replace(',', '.')) || 0,
-							voting: parseFloat(String(item.voting).replace(',', '.')) || 0,
-							incorporationCountry: item.incorporationCountry,
-							state: item.state,
-							shallowReport: shallowReport,
-							deepReport: deepReport,
-							aiReportStatus: getAiReportStatus(item),
-							category: category,
-						}
-					},
+					(item: any): Company => ({
+						id: item.id,
+						name: item.name,
+						country: item.country,
+						sector: item.industry, // Assuming 'industry' maps to 'sector'
+						marketValueNok: parseFloat(String(item.marketValueNok).replace(/ /g, '')) || 0,
+						ownership: parseFloat(String(item.ownership).replace(',', '.')) || 0,
+						voting: parseFloat(String(item.voting).replace(',', '.')) || 0,
+						incorporationCountry: item.incorporationCountry,
+						state: item.state,
+						aiReportStatus: item.aiReportStatus,
+						category: item.category ?? undefined,
+						concerns: item.concerns ?? undefined,
+						rationale: item.rationale ?? undefined,
+						detail: item.detail,
+					}),
 				)
 
 				setCompanies(transformedCompanies)
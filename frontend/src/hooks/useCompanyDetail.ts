@@ -0,0 +1,36 @@
+import { useEffect, useState } from 'react'
+import { Company } from '../types'
+import { fetchCompanyDetail } from '../contexts/CompanyDataContext'
+
+export function useCompanyDetail(company: Company | undefined) {
+	const [detailed, setDetailed] = useState<Company | undefined>(undefined)
+	const [loading, setLoading] = useState(false)
+	const [error, setError] = useState<Error | null>(null)
+
+	useEffect(() => {
+		if (!company) {
+			setDetailed(undefined)
+			return
+		}
+		let cancelled = false
+		setLoading(true)
+		setError(null)
+		fetchCompanyDetail(company)
+			.then((detail) => {
+				if (!cancelled) {
+					setDetailed({ ...company, shallowReport: detail.shallowReport, deepReport: detail.deepReport })
+				}
+			})
+			.catch((error) => {
+				if (!cancelled) setError(error as Error)
+			})
+			.finally(() => {
+				if (!cancelled) setLoading(false)
+			})
+		return () => {
+			cancelled = true
+		}
+	}, [company])
+
+	return { company: detailed, loading, error }
+}
@@ -23,9 +23,8 @@ export default function CompaniesPage() {
 		return companies
 			.filter((c) => {
 				const searchLower = q.toLowerCase()
-				const shallowReport = c.shallowReport?.riskAssessment
-				const concernsMatch = shallowReport?.concerns?.toLowerCase().includes(searchLower) ?? false
-				const rationaleMatch = shallowReport?.rationale?.toLowerCase().includes(searchLower) ?? false
+				const concernsMatch = c.concerns?.toLowerCase().includes(searchLower) ?? false
+				const rationaleMatch = c.rationale?.toLowerCase().includes(searchLower) ?? false
 
 				return (
 					(c.name.toLowerCase().includes(searchLower) || concernsMatch || rationaleMatch) &&
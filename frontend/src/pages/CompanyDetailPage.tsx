@@ -1,8 +1,9 @@
-import React from 'react'
+import React, { useMemo } from 'react'
 import { Link, useParams } from 'react-router-dom'
 import * as Flags from 'country-flag-icons/react/3x2'
 import { InformationCircleIcon } from '@heroicons/react/24/outline'
 import { useCompanyData } from '../hooks/useCompanyData'
+import { useCompanyDetail } from '../hooks/useCompanyDetail'
 import { Company, ShallowReport, DeepReport } from '../types'
 import { CategoryBadge } from '../components/CategoryBadge'
 import countries from 'i18n-iso-countries'
@@ -253,11 +254,14 @@ export default function CompanyDetailPage() {
 	const { companies, loading, error } = useCompanyData()
 	const { t } = useTranslation()
 
-	const company = companies.find((c) => c.id === id)
+	const listed = useMemo(() => companies.find((c) => c.id === id), [companies, id])
+	const { company, loading: detailLoading, error: detailError } = useCompanyDetail(listed)
 
 	if (loading) return <p className="text-gray-500">Loading…</p>
 	if (error) return <p className="text-red-600">Error: {error.message}</p>
-	if (!company) return <p className="text-red-600">{t('company.not_found')}</p>
+	if (!listed) return <p className="text-red-600">{t('company.not_found')}</p>
+	if (detailError) return <p className="text-red-600">Error: {detailError.message}</p>
+	if (detailLoading || !company) return <p className="text-gray-500">Loading…</p>
 
 	const report = company.deepReport || company.shallowReport
 	const profile = company.deepReport?.companyProfile || company.shallowReport?.companyProfile
@@ -12,6 +12,15 @@ export interface Company {
 	deepReport?: DeepReport
 	aiReportStatus: number
 	category?: number
+	concerns?: string
+	rationale?: string
+	detail?: string
+}
+
+export interface CompanyDetail {
+	id: string
+	shallowReport?: ShallowReport
+	deepReport?: DeepReport
 }
 
 export interface ShallowReport {
@@ -1,5 +1,179 @@
+import hashlib
+import json
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+
+DATA_FILE = os.environ.get('DATA_FILE', 'frontend/public/data/investments_exported.json')
+FILTERS = ('category', 'region', 'industry', 'state')
+MAX_PAGE_SIZE = 500
+
+def _market_value(investment):
+    value = investment.get('marketValueNok')
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(str(value).replace(' ', '').replace('\u00a0', ''))
+    except ValueError:
+        return 0
+
+def _category(investment):
+    for report in ('deepReport', 'shallowReport'):
+        risk = (investment.get(report) or {}).get('riskAssessment')
+        if isinstance(risk, dict) and risk.get('category'):
+            return str(risk['category'])
+    return None
+
+def _report_status(investment):
+    if investment.get('state') == 'done_deep' and investment.get('deepReport'):
+        return 2
+    if investment.get('state') == 'done_shallow' and investment.get('shallowReport'):
+        return 1
+    return 0
+
+def summarize(investment):
+    """Reduces an investment to the fields shown in the company list."""
+    concerns = None
+    for report in ('deepReport', 'shallowReport'):
+        risk = (investment.get(report) or {}).get('riskAssessment')
+        if isinstance(risk, dict) and risk.get('concerns'):
+            concerns = risk['concerns']
+            break
+    category = _category(investment)
+    return {
+        'id': investment['id'],
+        'name': investment.get('name'),
+        'country': investment.get('country'),
+        'region': investment.get('region'),
+        'industry': investment.get('industry'),
+        'marketValueNok': _market_value(investment),
+        'ownership': investment.get('ownership'),
+        'voting': investment.get('voting'),
+        'state': investment.get('state'),
+        'category': int(category) if category and category.isdigit() else None,
+        'aiReportStatus': _report_status(investment),
+        'concerns': concerns,
+    }
+
+def load_investments(path):
+    """Reads an export written by export_from_datastore.py, as a JSON array or NDJSON."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.ndjson'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+class InvestmentIndex:
+    """
+    Holds the exported investments in memory. Investments are numbered by descending
+    market value, and each filter value maps to the sorted list of numbers that have
+    it, so a filtered page is a set intersection and a slice rather than a scan.
+    """
+
+    def __init__(self, investments, version):
+        self.version = version
+        ordered = sorted(investments, key=_market_value, reverse=True)
+        self.investments = ordered
+        self.summaries = [summarize(investment) for investment in ordered]
+        self.by_id = {investment['id']: position for position, investment in enumerate(ordered)}
+        self.etags = {}
+
+        self.postings = {name: {} for name in FILTERS}
+        for position, summary in enumerate(self.summaries):
+            for name in FILTERS:
+                value = summary[name]
+                key = str(value).lower() if value is not None else 'none'
+                self.postings[name].setdefault(key, []).append(position)
+
+        by_name = sorted(range(len(ordered)), key=lambda position: (self.summaries[position]['name'] or '').lower())
+        self.name_rank = [0] * len(ordered)
+        for rank, position in enumerate(by_name):
+            self.name_rank[position] = rank
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            version = hashlib.sha256(f.read()).hexdigest()[:16]
+        return cls(load_investments(path), version)
+
+    def query(self, filters, sort='-marketValue', page=1, page_size=50):
+        """Returns (total, summaries) for one page of the investments matching every filter."""
+        postings = sorted((self.postings[name].get(str(value).lower(), []) for name, value in filters.items()), key=len)
+        if postings:
+            # Start from the rarest value, so each intersection only walks the smallest list
+            positions = postings[0]
+            for matches in postings[1:]:
+                wanted = set(matches)
+                positions = [position for position in positions if position in wanted]
+        else:
+            positions = range(len(self.summaries))
+
+        if sort == 'marketValue':
+            positions = positions[::-1]
+        elif sort in ('name', '-name'):
+            positions = sorted(positions, key=self.name_rank.__getitem__, reverse=sort == '-name')
+
+        start = (page - 1) * page_size
+        return len(positions), [self.summaries[position] for position in positions[start:start + page_size]]
+
+    def get(self, investment_id):
+        position = self.by_id.get(investment_id)
+        return None if position is None else self.investments[position]
+
+    def etag(self, investment_id):
+        """Returns the ETag of one investment, computed once from its content."""
+        if investment_id not in self.etags:
+            data = json.dumps(self.get(investment_id), sort_keys=True, ensure_ascii=False)
+            self.etags[investment_id] = '"' + hashlib.sha256(data.encode('utf-8')).hexdigest()[:16] + '"'
+        return self.etags[investment_id]
+
+def _not_modified(request, response, etag):
+    """Sets the ETag on the response and returns True if the client already has this version."""
+    response.headers['ETag'] = etag
+    response.headers['Cache-Control'] = 'no-cache'
+    if_none_match = request.headers.get('if-none-match', '')
+    return etag in (tag.strip() for tag in if_none_match.split(',')) or if_none_match.strip() == '*'
+
+@asynccontextmanager
+async def lifespan(app):
+    app.state.index = InvestmentIndex.from_file(DATA_FILE)
+    print(f"Loaded {len(app.state.index.investments)} investments from {DATA_FILE}.")
+    yield
+
+app = FastAPI(title='Oljefondsvokteren', lifespan=lifespan)
+
+@app.get('/investments')
+def list_investments(request: Request, response: Response,
+                     category: str | None = None, region: str | None = None,
+                     industry: str | None = None, state: str | None = None,
+                     sort: str = Query('-marketValue', pattern='^(-?marketValue|-?name)$'),
+                     page: int = Query(1, ge=1),
+                     page_size: int = Query(50, ge=1, le=MAX_PAGE_SIZE, alias='pageSize')):
+    index = request.app.state.index
+    filters = {name: value for name, value in
+               (('category', category), ('region', region), ('industry', industry), ('state', state)) if value}
+
+    # A list only changes when the loaded data does, so the data version and the query identify it
+    query = json.dumps([sorted(filters.items()), sort, page, page_size])
+    etag = '"' + hashlib.sha256(f"{index.version}:{query}".encode('utf-8')).hexdigest()[:16] + '"'
+    if _not_modified(request, response, etag):
+        return Response(status_code=304, headers=dict(response.headers))
+
+    total, items = index.query(filters, sort, page, page_size)
+    return {'total': total, 'page': page, 'pageSize': page_size, 'items': items}
+
+@app.get('/investments/{investment_id}')
+def get_investment(investment_id: str, request: Request, response: Response):
+    index = request.app.state.index
+    investment = index.get(investment_id)
+    if investment is None:
+        raise HTTPException(status_code=404, detail=f"No investment with id '{investment_id}'.")
+    if _not_modified(request, response, index.etag(investment_id)):
+        return Response(status_code=304, headers=dict(response.headers))
+    return investment
+
 def main():
-    print("Hello from oljefondet-vakten!")
+    import uvicorn
+    uvicorn.run(app, host=os.environ.get('HOST', '127.0.0.1'), port=int(os.environ.get('PORT', '8080')))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+class BatchSizeStats:
+    """Running totals for all batches sent with one batch size."""
+
+    def __init__(self):
+        self.batches = 0
+        self.failures = 0
+        self.companies = 0
+        self.total_latency = 0.0
+
+    @property
+    def throughput(self):
+        """Companies completed per second of model latency."""
+        return self.companies / self.total_latency if self.total_latency else 0.0
+
+class AdaptiveBatcher:
+    """
+    Chooses how many companies to put in each prompt. The size grows by one after
+    `grow_after` consecutive batches that validated within `target_latency` seconds,
+    shrinks by one when a batch validates but is slow, and is halved on timeouts
+    and count mismatches.
+    """
+
+    SHRINK_REASONS = ('timeout', 'mismatch')
+
+    def __init__(self, initial_size=10, min_size=1, max_size=25, target_latency=60, grow_after=3):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.size = max(min_size, min(initial_size, max_size))
+        self.target_latency = target_latency
+        self.grow_after = grow_after
+        self.stats = {}
+        self._fast_streak = 0
+
+    def next_size(self):
+        return self.size
+
+    def _stats_for(self, size):
+        if size not in self.stats:
+            self.stats[size] = BatchSizeStats()
+        return self.stats[size]
+
+    def record_success(self, size, latency):
+        stats = self._stats_for(size)
+        stats.batches += 1
+        stats.companies += size
+        stats.total_latency += latency
+
+        # Only batches at the current size say anything about whether it should change
+        if size != self.size:
+            return
+        if latency <= self.target_latency:
+            self._fast_streak += 1
+            if self._fast_streak >= self.grow_after:
+                self.size = min(self.max_size, self.size + 1)
+                self._fast_streak = 0
+        else:
+            self.size = max(self.min_size, self.size - 1)
+            self._fast_streak = 0
+
+    def record_failure(self, size, latency, reason):
+        stats = self._stats_for(size)
+        stats.batches += 1
+        stats.failures += 1
+        stats.total_latency += latency
+
+        self._fast_streak = 0
+        if reason in self.SHRINK_REASONS and size >= self.size:
+            self.size = max(self.min_size, size // 2)
+
+    def print_stats(self):
+        """Prints throughput per batch size."""
+        print("\nBatch Size Statistics:")
+        print(f"  {'Size':>4}  {'Batches':>7}  {'Failed':>6}  {'Companies':>9}  {'Avg latency':>11}  {'Companies/s':>11}")
+        for size in sorted(self.stats):
+            stats = self.stats[size]
+            avg_latency = stats.total_latency / stats.batches if stats.batches else 0.0
+            print(f"  {size:>4}  {stats.batches:>7}  {stats.failures:>6}  {stats.companies:>9}  "
+                  f"{avg_latency:>10.1f}s  {stats.throughput:>11.2f}")
+        print(f"  Final batch size: {self.size}")
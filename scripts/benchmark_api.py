@@ -0,0 +1,98 @@
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+BASE_URL = 'http://127.0.0.1:8080'
+
+def _get(url, headers=None):
+    request = urllib.request.Request(url, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers, b''
+
+def build_requests(base_url, num_requests):
+    """Builds a mix of list queries with random filters, sorts and pages, and single-company lookups."""
+    _, _, body = _get(f"{base_url}/investments?pageSize=500")
+    sample = json.loads(body)['items']
+    ids = [item['id'] for item in sample]
+    values = {name: sorted({str(item[name]) for item in sample if item[name] is not None})
+              for name in ('category', 'region', 'industry', 'state')}
+
+    urls = []
+    for _ in range(num_requests):
+        if random.random() < 0.3:
+            urls.append(('detail', f"{base_url}/investments/{urllib.parse.quote(random.choice(ids))}"))
+            continue
+        params = {'page': random.randint(1, 5), 'sort': random.choice(['-marketValue', 'marketValue', 'name'])}
+        for name in random.sample(list(values), random.randint(0, 2)):
+            if values[name]:
+                params[name] = random.choice(values[name])
+        urls.append(('list', f"{base_url}/investments?{urllib.parse.urlencode(params)}"))
+    return urls
+
+def run_benchmark(base_url=BASE_URL, num_requests=2000, concurrency=16, revalidate=False):
+    """
+    Sends `num_requests` requests from `concurrency` threads and prints p50/p99 latency
+    per request type. With `revalidate`, every request repeats a first fetch with
+    If-None-Match, which measures the 304 path.
+    """
+    urls = build_requests(base_url, num_requests)
+    etags = {}
+    if revalidate:
+        for _, url in urls:
+            if url not in etags:
+                etags[url] = _get(url)[1].get('ETag')
+
+    latencies = {}
+    statuses = {}
+    lock = threading.Lock()
+    next_request = iter(urls)
+
+    def worker():
+        while True:
+            with lock:
+                item = next(next_request, None)
+            if item is None:
+                return
+            kind, url = item
+            headers = {'If-None-Match': etags[url]} if revalidate and etags.get(url) else None
+            start = time.perf_counter()
+            status, _, _ = _get(url, headers)
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                latencies.setdefault(kind, []).append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    print(f"\n{num_requests} requests from {concurrency} threads in {elapsed:.1f}s ({num_requests / elapsed:.0f} req/s)")
+    print(f"Status codes: {dict(sorted(statuses.items()))}")
+    for kind, values in sorted(latencies.items()):
+        percentiles = statistics.quantiles(values, n=100)
+        print(f"  - {kind:<6} n={len(values):<5} p50={percentiles[49]:.1f}ms p99={percentiles[98]:.1f}ms "
+              f"max={max(values):.1f}ms")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Measure the latency of the read API under concurrent load.")
+    parser.add_argument('--url', default=BASE_URL, help=f'Base URL of the API. Defaults to {BASE_URL}.')
+    parser.add_argument('--requests', type=int, default=2000, help='Total number of requests. Defaults to 2000.')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of client threads. Defaults to 16.')
+    parser.add_argument('--revalidate', action='store_true',
+                        help='Send If-None-Match with a known ETag to measure 304 responses.')
+    args = parser.parse_args()
+
+    run_benchmark(args.url.rstrip('/'), args.requests, args.concurrency, args.revalidate)
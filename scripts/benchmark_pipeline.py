@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import tempfile
+import time
+from google.cloud import datastore
+import create_shallow_investments as shallow
+import sync_deep_reports as deep
+from adaptive_batcher import AdaptiveBatcher
+from local_backends import LocalDatastore, LocalModel, LocalStorage
+from metrics import Metrics, get_metrics, set_metrics
+from rate_limiter import set_limits
+from scheduling import PRIORITY_MODES, set_priority
+from response_cache import ResponseCache
+from sharding import PROGRESS_KIND
+from stats_index import STATS_KIND, rebuild_stats
+from vertex_functions import (DEEP_MODEL, SHALLOW_MODEL, ShallowReportEngine, load_prompt_template, set_response_cache,
+                              set_shared_client)
+
+INVESTMENTS_FILE = 'scripts/investments.json'
+PUT_LIMIT = 500 # Datastore's maximum number of entities per commit
+BUCKET_NAME = 'benchmark-investments'
+# Finer than the default buckets, so tail latencies can be told apart between runs
+LATENCY_BUCKETS = tuple(round(0.005 * 1.15 ** i, 4) for i in range(80))
+
+def parse_ints(value):
+    return [int(part) for part in value.split(',') if part]
+
+def make_store(args):
+    """Returns an empty Datastore: the emulator from DATASTORE_EMULATOR_HOST with --emulator, otherwise a local one."""
+    if not args.emulator:
+        return LocalDatastore(latency=args.datastore_latency)
+    client = datastore.Client(project=os.environ.get('DATASTORE_PROJECT_ID', 'oljefondvakt'))
+    for kind in ('Investment', STATS_KIND, PROGRESS_KIND):
+        query = client.query(kind=kind)
+        query.keys_only()
+        keys = [entity.key for entity in query.fetch()]
+        for start in range(0, len(keys), PUT_LIMIT):
+            client.delete_multi(keys[start:start + PUT_LIMIT])
+    return client
+
+def seed_investments(client, investments):
+    """Stores the investments as pending and builds the stats index, like a fresh import."""
+    entities = []
+    for investment in investments:
+        entity = datastore.Entity(key=client.key('Investment', investment['id']))
+        entity.update(investment)
+        entity['state'] = 'pending'
+        entities.append(set_priority(entity))
+    for start in range(0, len(entities), PUT_LIMIT):
+        client.put_multi(entities[start:start + PUT_LIMIT])
+    rebuild_stats(client)
+
+def make_model(args):
+    return LocalModel(args.latency, args.per_item_latency, args.jitter, args.failure_rate, args.mismatch_rate,
+                      args.deep_latency, args.seed, args.quota_rpm)
+
+def _stage(summary, name):
+    return next((stage for label, stage in summary['stages'].items() if label.split('/')[0] == name), {})
+
+def _result(pipeline, workers, batch_size, items, elapsed, store, model, states):
+    summary = get_metrics().summary()
+    generate = _stage(summary, f'{pipeline}_generate')
+    return {
+        'pipeline': pipeline,
+        'workers': workers,
+        'batchSize': batch_size,
+        'items': items,
+        'seconds': round(elapsed, 2),
+        'itemsPerSecond': round(items / elapsed, 2) if elapsed else 0.0,
+        'errors': states.get(f'error_{pipeline}', 0),
+        'modelCalls': model.calls,
+        'modelFailures': model.failures,
+        'quotaErrors': model.quota_errors,
+        'modelP50': generate.get('p50Seconds'),
+        'modelP99': generate.get('p99Seconds'),
+        'commitP99': _stage(summary, 'datastore_commit').get('p99Seconds'),
+        'claimP99': _stage(summary, 'datastore_claim').get('p99Seconds'),
+        'conflicts': sum(value for name, value in summary['counters'].items() if name.startswith('transaction_conflicts')),
+        'lockWaitSeconds': round(store.stats['lockWaitSeconds'], 3) if isinstance(store, LocalDatastore) else None,
+        'retries': sum(value for name, value in summary['counters'].items() if name.startswith('retries')),
+        'tokens': summary['tokens'],
+    }
+
+def _states(client, ids):
+    states = {}
+    for start in range(0, len(ids), PUT_LIMIT):
+        for entity in client.get_multi([client.key('Investment', investment_id) for investment_id in ids[start:start + PUT_LIMIT]]):
+            states[entity.get('state')] = states.get(entity.get('state'), 0) + 1
+    return states
+
+def run_shallow(args, investments, workers, batch_size):
+    """Runs the shallow pipeline over the investments with a fixed batch size and `workers` in flight."""
+    store = make_store(args)
+    model = make_model(args)
+    set_metrics(Metrics(LATENCY_BUCKETS))
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed_investments(store, investments)
+
+    shallow.Config.TOTAL_ITEMS_TO_PROCESS = len(investments)
+    shallow.Config.MAX_IN_FLIGHT = workers
+    shallow.Config.REQUEST_TIMEOUT = args.timeout
+    shallow.Config.PRIORITY = args.priority
+    engine = ShallowReportEngine(b'%PDF-benchmark' * 1000, 'shallow.schema.json', max_in_flight=workers,
+                                 timeout=args.timeout, client=model, response_cache=ResponseCache(enabled=False),
+                                 limiter=set_limits(SHALLOW_MODEL, args.rpm, args.tpm))
+    batcher = AdaptiveBatcher(batch_size, batch_size, batch_size)
+
+    start = time.monotonic()
+    output = io.StringIO() if not args.verbose else None
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        asyncio.run(shallow.run_pipeline(engine, batcher, shallow.load_shallow_schema(), load_prompt_template(), client=store))
+    elapsed = time.monotonic() - start
+
+    states = _states(store, [investment['id'] for investment in investments])
+    return _result('shallow', workers, batch_size, len(investments), elapsed, store, model, states)
+
+def run_deep(args, investments, workers, pdf_dir):
+    """Runs deep report generation for one local PDF per investment with `workers` generating at once."""
+    store = make_store(args)
+    model = make_model(args)
+    set_metrics(Metrics(LATENCY_BUCKETS))
+    set_shared_client(model)
+    set_response_cache(ResponseCache(enabled=False))
+    set_limits(DEEP_MODEL, args.rpm, args.tpm)
+    deep.set_storage_client(LocalStorage(latency=args.gcs_latency))
+    with contextlib.redirect_stdout(io.StringIO()):
+        seed_investments(store, investments)
+
+    ids = [investment['id'] for investment in investments]
+    entities = deep.get_investments_by_ids(store, ids)
+    work = [(os.path.join(pdf_dir, f"{investment_id}.pdf"), entities[investment_id]) for investment_id in ids]
+
+    start = time.monotonic()
+    output = io.StringIO() if not args.verbose else None
+    with contextlib.redirect_stdout(output) if output else contextlib.nullcontext():
+        asyncio.run(deep.generate_deep_reports(store, BUCKET_NAME, work, workers))
+    elapsed = time.monotonic() - start
+
+    return _result('deep', workers, None, len(investments), elapsed, store, model, _states(store, ids))
+
+def print_results(results):
+    print(f"\n{'Pipeline':<9}{'Workers':>8}{'Batch':>6}{'Items':>7}{'Seconds':>9}{'Items/s':>9}{'Errors':>7}"
+          f"{'Calls':>7}{'429s':>6}{'Model p50':>10}{'Model p99':>10}{'Commit p99':>11}{'Conflicts':>10}{'Lock wait':>10}")
+    for r in results:
+        lock_wait = f"{r['lockWaitSeconds']:.3f}s" if r['lockWaitSeconds'] is not None else '-'
+        print(f"{r['pipeline']:<9}{r['workers']:>8}{r['batchSize'] or '-':>6}{r['items']:>7}{r['seconds']:>9.1f}"
+              f"{r['itemsPerSecond']:>9.2f}{r['errors']:>7}{r['modelCalls']:>7}{r['quotaErrors']:>6}{r['modelP50'] or 0:>9.2f}s"
+              f"{r['modelP99'] or 0:>9.2f}s{r['commitP99'] or 0:>10.3f}s{r['conflicts']:>10}{lock_wait:>10}")
+
+def run_benchmark(args):
+    """Runs the selected pipelines for every combination of worker count and batch size."""
+    with open(INVESTMENTS_FILE, 'r', encoding='utf-8') as f:
+        all_investments = json.load(f)
+    rng = random.Random(args.seed)
+    results = []
+
+    if args.pipeline in ('shallow', 'both'):
+        investments = rng.sample(all_investments, min(args.items, len(all_investments)))
+        for workers in args.workers:
+            for batch_size in args.batch_sizes:
+                print(f"Running shallow pipeline: {len(investments)} items, {workers} workers, batches of {batch_size}...")
+                results.append(run_shallow(args, investments, workers, batch_size))
+
+    if args.pipeline in ('deep', 'both'):
+        investments = rng.sample(all_investments, min(args.deep_items, len(all_investments)))
+        with tempfile.TemporaryDirectory() as pdf_dir:
+            for investment in investments:
+                with open(os.path.join(pdf_dir, f"{investment['id']}.pdf"), 'wb') as f:
+                    f.write(os.urandom(args.pdf_kb * 1024))
+            for workers in args.workers:
+                print(f"Running deep pipeline: {len(investments)} PDFs, {workers} workers...")
+                results.append(run_deep(args, investments, workers, pdf_dir))
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nWrote the results to {args.output}")
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Benchmark the shallow and deep pipelines offline, against a local model, Datastore and GCS.")
+    parser.add_argument('--pipeline', choices=['shallow', 'deep', 'both'], default='shallow',
+                        help='Pipeline to benchmark. Defaults to shallow.')
+    parser.add_argument('--items', type=int, default=200, help='Investments per shallow run. Defaults to 200.')
+    parser.add_argument('--deep-items', type=int, default=20, help='PDFs per deep run. Defaults to 20.')
+    parser.add_argument('--workers', type=parse_ints, default=[1, 4, 10],
+                        help='Comma-separated worker counts to compare. Defaults to 1,4,10.')
+    parser.add_argument('--batch-sizes', type=parse_ints, default=[10],
+                        help='Comma-separated shallow batch sizes to compare. Defaults to 10.')
+    parser.add_argument('--latency', type=float, default=1.0, help='Base seconds per shallow model call. Defaults to 1.0.')
+    parser.add_argument('--per-item-latency', type=float, default=0.1,
+                        help='Extra seconds per company in a shallow model call. Defaults to 0.1.')
+    parser.add_argument('--deep-latency', type=float, default=5.0, help='Seconds per deep model call. Defaults to 5.0.')
+    parser.add_argument('--jitter', type=float, default=0.3, help='Random +/- share of each model latency. Defaults to 0.3.')
+    parser.add_argument('--failure-rate', type=float, default=0.02, help='Share of model calls that fail. Defaults to 0.02.')
+    parser.add_argument('--mismatch-rate', type=float, default=0.05,
+                        help='Share of shallow responses missing one report. Defaults to 0.05.')
+    parser.add_argument('--quota-rpm', type=int, default=None,
+                        help='Calls per minute the local model accepts before it answers with 429s. Unlimited by default.')
+    parser.add_argument('--rpm', type=int, default=None,
+                        help="Requests per minute for the pipelines' rate limiter. Defaults to rate_limiter.MODEL_LIMITS.")
+    parser.add_argument('--tpm', type=int, default=None,
+                        help="Tokens per minute for the pipelines' rate limiter. Defaults to rate_limiter.MODEL_LIMITS.")
+    parser.add_argument('--priority', choices=PRIORITY_MODES, default=None,
+                        help='Claim shallow work in this priority order, like create_shallow_investments.py --priority.')
+    parser.add_argument('--timeout', type=int, default=120, help='Model call timeout in seconds. Defaults to 120.')
+    parser.add_argument('--datastore-latency', type=float, default=0.01,
+                        help='Seconds per local Datastore round trip. Defaults to 0.01.')
+    parser.add_argument('--gcs-latency', type=float, default=0.05, help='Seconds per local GCS upload. Defaults to 0.05.')
+    parser.add_argument('--pdf-kb', type=int, default=500, help='Size of each generated PDF in KiB. Defaults to 500.')
+    parser.add_argument('--emulator', action='store_true',
+                        help='Use the Datastore emulator at DATASTORE_EMULATOR_HOST instead of the local Datastore. '
+                             'Its data is cleared before each run.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the sample and the local model. Defaults to 0.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    parser.add_argument('--verbose', action='store_true', help="Show the pipelines' own output.")
+    args = parser.parse_args()
+
+    run_benchmark(args)
@@ -0,0 +1,142 @@
+import asyncio
+import time
+from google.genai import types
+from google.genai.errors import APIError
+
+PROMPT_PLACEHOLDER = '{companies_data}'
+
+class CachedContentExpired(Exception):
+    pass
+
+def split_prompt_template(prompt_template):
+    """
+    Splits the prompt template around the companies placeholder. The prefix is
+    identical for every batch and can be cached; the returned batch template
+    holds the placeholder and everything after it.
+    """
+    prefix, suffix = prompt_template.split(PROMPT_PLACEHOLDER, 1)
+    # The template is meant for str.format, so unescape any doubled braces in the prefix
+    return prefix.format(), PROMPT_PLACEHOLDER + suffix
+
+def build_cache_contents(ethical_guidelines_pdf_bytes, prompt_prefix):
+    """Builds the contents shared by every shallow batch: the guidelines PDF and the prompt prefix."""
+    return [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_bytes(data=ethical_guidelines_pdf_bytes, mime_type="application/pdf"),
+                types.Part.from_text(text=prompt_prefix),
+            ]
+        )
+    ]
+
+def is_cache_expired_error(error):
+    """Checks whether a failed call referenced a cached content that no longer exists."""
+    if isinstance(error, CachedContentExpired):
+        return True
+    if isinstance(error, APIError) and error.code in (400, 404):
+        return 'cache' in str(error).lower()
+    return False
+
+class VertexCacheBackend:
+    """Creates and deletes cached contents on Vertex AI."""
+
+    def __init__(self, client):
+        self.client = client
+
+    async def create(self, model, contents, ttl_seconds, display_name):
+        cache = await self.client.aio.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=contents,
+                ttl=f"{ttl_seconds}s",
+                display_name=display_name,
+            )
+        )
+        return cache.name
+
+    async def delete(self, name):
+        await self.client.aio.caches.delete(name=name)
+
+class FakeCacheBackend:
+    """
+    In-memory stand-in for Vertex AI context caching, so cache creation, expiry
+    and refresh can be exercised offline. A fake model can call `resolve` to
+    look up the contents a cache name refers to.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.caches = {}
+        self.created_count = 0
+
+    async def create(self, model, contents, ttl_seconds, display_name):
+        self.created_count += 1
+        name = f"fakeCachedContents/{display_name}-{self.created_count}"
+        self.caches[name] = (contents, self.clock() + ttl_seconds)
+        return name
+
+    async def delete(self, name):
+        self.caches.pop(name, None)
+
+    def resolve(self, name):
+        """Returns the cached contents, or raises CachedContentExpired if the cache has expired."""
+        if name not in self.caches:
+            raise CachedContentExpired(f"Cached content {name} not found")
+        contents, expires_at = self.caches[name]
+        if self.clock() >= expires_at:
+            del self.caches[name]
+            raise CachedContentExpired(f"Cached content {name} has expired")
+        return contents
+
+class CachedContext:
+    """
+    Holds one cached context for the lifetime of a run. The cache is created on
+    first use and recreated when it is about to expire or when a call reports
+    that it has already expired.
+    """
+
+    def __init__(self, backend, model, contents, ttl_seconds=3600, refresh_margin=60,
+                 display_name='shallow-guidelines', clock=time.monotonic):
+        self.backend = backend
+        self.model = model
+        self.contents = contents
+        self.ttl_seconds = ttl_seconds
+        self.refresh_margin = refresh_margin
+        self.display_name = display_name
+        self.clock = clock
+        self.name = None
+        self.expires_at = 0
+        self.refresh_count = 0
+        self._lock = None
+
+    async def get_name(self):
+        """Returns the name of a live cache, creating or refreshing it if needed."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.name is None or self.clock() >= self.expires_at - self.refresh_margin:
+                await self._create()
+            return self.name
+
+    def invalidate(self, name):
+        """Marks a cache as expired so the next call to get_name recreates it."""
+        if self.name == name:
+            self.name = None
+
+    async def _create(self):
+        if self.name is not None:
+            self.refresh_count += 1
+            print(f"Refreshing context cache {self.name}.")
+        self.name = await self.backend.create(self.model, self.contents, self.ttl_seconds, self.display_name)
+        self.expires_at = self.clock() + self.ttl_seconds
+        print(f"Created context cache {self.name} (TTL {self.ttl_seconds}s).")
+
+    async def close(self):
+        """Deletes the cache so it is not billed for storage after the run."""
+        if self.name is not None:
+            try:
+                await self.backend.delete(self.name)
+            except Exception as e:
+                print(f"Could not delete context cache {self.name}: {e}")
+            self.name = None
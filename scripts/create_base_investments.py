@@ -1,28 +1,59 @@
+import argparse
 import csv
 import json
 import re
+import numpy as np
 
-def create_base_investments():
-    csv_file_path = 'scripts/EQ_2025_06_30_Industry.csv'
-    json_file_path = 'scripts/investments.json'
-    
+CSV_FILE_PATH = 'scripts/EQ_2025_06_30_Industry.csv'
+JSON_FILE_PATH = 'scripts/investments.json'
+COLUMNAR_FILE_PATH = 'scripts/investments.npz'
+
+# Static definition of CSV headers
+HEADER = [
+    "industry", "region", "country", "name", "marketValueNok",
+    "marketValueUsd", "voting", "ownership", "incorporationCountry"
+]
+STRING_COLUMNS = ['industry', 'region', 'country', 'name', 'incorporationCountry']
+
+def parse_norwegian_int(value):
+    """Parses a Norwegian-formatted integer such as '97 148 575' or '-3 419 625'. Empty values become None."""
+    value = (value or '').replace(' ', '').replace('\u00a0', '')
+    return int(value) if value else None
+
+def parse_norwegian_float(value):
+    """Parses a Norwegian-formatted decimal such as '0,47'. Empty values become None."""
+    value = (value or '').replace(' ', '').replace('\u00a0', '').replace(',', '.')
+    return float(value) if value else None
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '-', (name or '').lower()).strip('-')
+
+def load_holdings(csv_file_path=CSV_FILE_PATH):
+    """
+    Reads an NBIM holdings CSV into typed investment dicts. Ids are slugs of the company
+    name; when two names produce the same slug, later holdings get a numeric suffix and
+    the collisions are reported, so no holding silently overwrites another.
+    """
     investments = []
-    
-    # Static definition of CSV headers
-    header = [
-        "industry", "region", "country", "name", "marketValueNok",
-        "marketValueUsd", "voting", "ownership", "incorporationCountry"
-    ]
-    
-    with open(csv_file_path, mode='r', encoding='utf-8') as csv_file:
+    seen_ids = {}
+    collisions = []
+
+    with open(csv_file_path, mode='r', encoding='utf-8-sig') as csv_file:
         csv_reader = csv.reader(csv_file, delimiter=';')
         next(csv_reader)  # Skip header row in the file
-        
+
         for row in csv_reader:
-            row_data = dict(zip(header, row))
-            
+            row_data = dict(zip(HEADER, row))
+
             # Create a slug for the id
-            company_id = re.sub(r'[^a-z0-9]+', '-', row_data.get('name', '').lower()).strip('-')
+            company_id = slugify(row_data.get('name'))
+            if company_id in seen_ids:
+                seen_ids[company_id] += 1
+                unique_id = f"{company_id}-{seen_ids[company_id]}"
+                collisions.append((company_id, row_data.get('name'), unique_id))
+                company_id = unique_id
+            else:
+                seen_ids[company_id] = 1
 
             investment = {
                 'id': company_id,
@@ -30,19 +61,68 @@ def create_base_investments():
                 'region': row_data.get('region'),
                 'country': row_data.get('country'),
                 'name': row_data.get('name'),
-                'marketValueNok': row_data.get('marketValueNok'),
-                'marketValueUsd': row_data.get('marketValueUsd'),
-                'voting': row_data.get('voting'),
-                'ownership': row_data.get('ownership'),
+                'marketValueNok': parse_norwegian_int(row_data.get('marketValueNok')),
+                'marketValueUsd': parse_norwegian_int(row_data.get('marketValueUsd')),
+                'voting': parse_norwegian_float(row_data.get('voting')),
+                'ownership': parse_norwegian_float(row_data.get('ownership')),
                 'incorporationCountry': row_data.get('incorporationCountry'),
                 'shallowReport': {}
             }
             investments.append(investment)
-            
+
+    if collisions:
+        print(f"Warning: {len(collisions)} id collision(s) from slugging company names:")
+        for company_id, name, unique_id in collisions:
+            print(f"  - '{name}' collides on '{company_id}'; using '{unique_id}'")
+
+    return investments
+
+def write_columnar(investments, columnar_file_path=COLUMNAR_FILE_PATH):
+    """
+    Writes the holdings as NumPy arrays, one per column, in a compressed .npz file.
+    Missing numbers are stored as 0 for integers and NaN for floats.
+    """
+    columns = {
+        'id': np.array([inv['id'] for inv in investments]),
+        'marketValueNok': np.array([inv['marketValueNok'] or 0 for inv in investments], dtype=np.int64),
+        'marketValueUsd': np.array([inv['marketValueUsd'] or 0 for inv in investments], dtype=np.int64),
+        'voting': np.array([np.nan if inv['voting'] is None else inv['voting'] for inv in investments], dtype=np.float64),
+        'ownership': np.array([np.nan if inv['ownership'] is None else inv['ownership'] for inv in investments], dtype=np.float64),
+    }
+    for column in STRING_COLUMNS:
+        columns[column] = np.array([inv[column] or '' for inv in investments])
+    np.savez_compressed(columnar_file_path, **columns)
+
+def load_columnar(columnar_file_path=COLUMNAR_FILE_PATH):
+    """Loads the columnar holdings. Returns the columns and an index from id to row number."""
+    with np.load(columnar_file_path) as data:
+        columns = {name: data[name] for name in data.files}
+    id_index = {company_id: row for row, company_id in enumerate(columns['id'].tolist())}
+    return columns, id_index
+
+def top_by_market_value(columns, num, mask=None):
+    """Returns the ids of the `num` holdings with the highest NOK market value, optionally within a boolean mask."""
+    rows = np.flatnonzero(mask) if mask is not None else np.arange(len(columns['id']))
+    order = np.argsort(columns['marketValueNok'][rows])[::-1][:num]
+    return columns['id'][rows[order]].tolist()
+
+def create_base_investments(csv_file_path=CSV_FILE_PATH, json_file_path=JSON_FILE_PATH,
+                            columnar_file_path=COLUMNAR_FILE_PATH):
+    investments = load_holdings(csv_file_path)
+
     with open(json_file_path, mode='w', encoding='utf-8') as json_file:
         json.dump(investments, json_file, indent=4)
 
-    print(f"Successfully created {json_file_path} with {len(investments)} entries.")
+    write_columnar(investments, columnar_file_path)
+
+    print(f"Successfully created {json_file_path} and {columnar_file_path} with {len(investments)} entries.")
 
 if __name__ == '__main__':
-    create_base_investments()
+    parser = argparse.ArgumentParser(description="Create the base investments from an NBIM holdings CSV.")
+    parser.add_argument('--csv', default=CSV_FILE_PATH, help=f'Holdings CSV. Defaults to {CSV_FILE_PATH}.')
+    parser.add_argument('--json', default=JSON_FILE_PATH, help=f'Output JSON file. Defaults to {JSON_FILE_PATH}.')
+    parser.add_argument('--columnar', default=COLUMNAR_FILE_PATH,
+                        help=f'Output columnar .npz file. Defaults to {COLUMNAR_FILE_PATH}.')
+    args = parser.parse_args()
+
+    create_base_investments(args.csv, args.json, args.columnar)
@@ -1,181 +1,421 @@
 import argparse
-import threading
-import queue
-import json
-from jsonschema import validate, ValidationError
+import asyncio
+import time
+from jsonschema import ValidationError
 from google.cloud import datastore
-from vertex_functions import vertex_generate_shallow_report, load_pdf_bytes, load_prompt_template
+from vertex_schema import SHALLOW_MATCH_FIELDS, SHALLOW_SCHEMA, get_schema
+from vertex_functions import ShallowReportEngine, SHALLOW_MODEL, TimeoutException, get_shared_client, load_pdf_bytes, load_prompt_template
+from rate_limiter import is_quota_error, set_limits
+from scheduling import PRIORITY_MODES, RunBudget, parse_budget
+from response_cache import ResponseCache
+from context_cache import CachedContext, VertexCacheBackend, build_cache_contents, split_prompt_template
+from adaptive_batcher import AdaptiveBatcher
+from job_claims import claim_pending_investments, make_worker_id, release_claims, release_lease
+from timestamps import stamp_updated
+from stats_index import put_with_stats
+from metrics import get_metrics
+from sharding import NodeProgress, describe_key_range, load_base_ids, parse_key_range, parse_shard, shard_key_range
 
 class Config:
-    COMPANIES_PER_PROMPT = 10
-    NUM_THREADS = 10
+    COMPANIES_PER_PROMPT = 10 # Initial batch size; adapted during the run
+    MIN_COMPANIES_PER_PROMPT = 1
+    MAX_COMPANIES_PER_PROMPT = 25
+    TARGET_LATENCY = 60 # Seconds; batches answered faster than this let the batch size grow
+    MAX_IN_FLIGHT = 10 # Maximum number of concurrent Vertex AI calls
+    REQUEST_TIMEOUT = 120 # Seconds before an in-flight Vertex AI call is cancelled
+    LEASE_SECONDS = 1800 # Seconds a claimed investment stays reserved before another worker may take it over
+    CACHE_TTL = 3600 # Seconds a context cache lives before it is refreshed
     TOTAL_ITEMS_TO_PROCESS = 250 # Default value, can be overridden by cmd arg
+    KEY_RANGE = None # (start, end) of the ids this node claims; None processes all ids
+    SHARD = 'all' # Label for this node's part of the universe in progress reports
+    SCHEMA = SHALLOW_SCHEMA
+    RUN_ID = 'default' # Groups the progress of the nodes that take part in one run
+    METRICS_PORT = None # Port serving OpenMetrics while the run is going; None serves nothing
+    METRICS_SUMMARY = None # Path of the JSON run summary; None only prints it
+    RPM = None # Requests per minute for the shallow model; None uses rate_limiter.MODEL_LIMITS
+    TPM = None # Tokens per minute for the shallow model; None uses rate_limiter.MODEL_LIMITS
+    PRIORITY = None # 'value', 'ownership' or 'risk' claims the highest scoring investments first; None claims any
+    BUDGET = None # ('calls' or 'tokens', amount) the run may spend on the model; None is unlimited
 
 def load_shallow_schema():
-    """Loads the shallow report schema."""
-    with open('scripts/shallow.schema.json', 'r') as f:
-        return json.load(f)
-
-def get_and_lock_pending_investments(client, limit, lock):
-    """Fetches and locks a batch of investments that are in the 'pending' state."""
-    with lock:
-        query = client.query(kind='Investment')
-        query.add_filter('state', '=', 'pending')
-        # Fetch full entities
-        investments = list(query.fetch(limit=limit))
-        
-        if investments:
-            # Create a list of keys to fetch the full entities again
-            keys = [client.key('Investment', inv['id']) for inv in investments]
-            # Fetch the full entities to ensure we have all data (like deepReport)
-            full_investments = client.get_multi(keys)
-
-            for investment in full_investments:
-                investment['state'] = 'in_progress_shallow'
-            
-            batch = client.batch()
-            batch.begin()
-            for investment in full_investments:
-                key = client.key('Investment', investment['id'])
-                entity = datastore.Entity(key=key)
-                entity.update(investment)
-                batch.put(entity)
-            batch.commit()
-            return full_investments
-    return []
-
-def update_investments(client, updated_investments, completed_count, lock):
-    """Updates a list of investments in Datastore."""
-    batch = client.batch()
-    batch.begin()
+    """Returns the compiled shallow report schema, which is loaded once per process."""
+    return get_schema(Config.SCHEMA)
+
+def update_investments(client, updated_investments):
+    """Updates a list of investments in Datastore and releases their leases."""
+    entities = []
     for investment in updated_investments:
+        release_lease(investment)
+        stamp_updated(investment)
         key = client.key('Investment', investment['id'])
         entity = datastore.Entity(key=key)
         entity.update(investment)
-        batch.put(entity)
-    batch.commit()
-    with lock:
-        completed_count[0] += len(updated_investments)
-        print(f"({completed_count[0]}/{Config.TOTAL_ITEMS_TO_PROCESS}) investments updated.")
-
-def results_saver(result_queue, stop_event, completed_count, lock):
-    """A dedicated thread to save results as they come in."""
-    client = datastore.Client(database='investment-reports')
-    while not stop_event.is_set() or not result_queue.empty():
-        try:
-            batch = result_queue.get(timeout=1)
-            update_investments(client, batch, completed_count, lock)
-            result_queue.task_done()
-        except queue.Empty:
+        entities.append(entity)
+    with get_metrics().track('datastore_commit'):
+        put_with_stats(client, entities)
+
+async def save_results(client, updated_investments, progress):
+    """Saves a finished batch without blocking the event loop."""
+    await asyncio.to_thread(update_investments, client, updated_investments)
+    progress.record(updated_investments)
+    for investment in updated_investments:
+        get_metrics().inc('investments', state=investment.get('state'))
+    print(f"({progress.done + progress.errors}/{Config.TOTAL_ITEMS_TO_PROCESS}) investments updated.")
+    if progress.report_due():
+        await asyncio.to_thread(progress.report)
+
+def build_prompt(batch, prompt_template):
+    """Sanitizes and formats the batch of companies for the prompt."""
+    sanitized_companies = []
+    for company in batch:
+        name = company.get('name', '').replace('"', '').replace('\\', '')
+        country = company.get('country', '').replace('"', '').replace('\\', '')
+        sanitized_companies.append(f"{company['id']}: {name} from {country}")
+
+    companies_data_string = "\n".join(sanitized_companies)
+    return prompt_template.format(companies_data=companies_data_string)
+
+def match_reports(batch, shallow_reports, schema):
+    """
+    Matches reports to companies by the id echoed back in each report. Returns the
+    (company, report) pairs that matched and validated, and the companies left
+    without a valid report.
+    """
+    by_id = {company['id']: company for company in batch}
+
+    candidates = []
+    for report in shallow_reports:
+        if not isinstance(report, dict):
+            continue
+        company = by_id.get(report.get('id'))
+        if company is not None:
+            candidates.append((company, report))
+
+    # Every report is checked with the same compiled validator
+    invalid = schema.validate_many([report for _, report in candidates])
+    matched = {}
+    for index, (company, report) in enumerate(candidates):
+        if company['id'] in matched:
+            continue
+        if index in invalid:
+            print(f"Discarding invalid report for {company['id']}: {'; '.join(invalid[index])}")
+            get_metrics().inc('validation_failures', stage='shallow_generate', scope='item')
             continue
+        matched[company['id']] = (company, report)
+
+    missing = [company for company in batch if company['id'] not in matched]
+    return list(matched.values()), missing
+
+def apply_reports(matched):
+    """Associates matched reports with their companies."""
+    for company, report in matched:
+        # The match fields only exist to pair the report with its company; see get_stored_shallow_schema
+        for field in SHALLOW_MATCH_FIELDS:
+            report.pop(field, None)
+        # This ensures we keep all original data, including deepReport if present
+        company.update({
+            'shallowReport': report,
+            'state': 'done_shallow'
+        })
+
+def use_stored_reports(engine, batch, prompt_template, schema):
+    """
+    Applies reports the model produced for single-company prompts in earlier runs,
+    e.g. after a failing batch was split down to one company, so a rerun does not
+    pay for them again. Responses are only cached under the prompt that produced
+    them. Returns the companies that still need a report.
+    """
+    remaining = []
+    for company in batch:
+        reports = engine.cached(build_prompt([company], prompt_template))
+        matched = match_reports([company], reports, schema)[0] if isinstance(reports, list) else []
+        if matched:
+            apply_reports(matched)
+        else:
+            remaining.append(company)
+    if len(remaining) < len(batch):
+        print(f"Used stored reports for {len(batch) - len(remaining)} of {len(batch)} companies.")
+    return remaining
+
+def failure_reason(error):
+    """Classifies a failed batch for the adaptive batcher."""
+    if isinstance(error, TimeoutException):
+        return 'timeout'
+    if isinstance(error, ValidationError):
+        return 'validation'
+    if is_quota_error(error):
+        return 'quota'
+    return 'error'
+
+async def process_batch(name, engine, batch, batcher, schema, prompt_template, retries_left=1):
+    """
+    Generates shallow reports for a batch and returns it with every company's state set.
+    Reports are matched to companies by id, so a response with missing or invalid items
+    keeps every valid report and only the companies without one are sent again.
+    A batch that yields nothing is split in half and each half is retried, so a single
+    bad company cannot fail the rest. A single company that fails is retried once
+    before it is marked 'error_shallow'. Quota errors are retried by the engine's rate
+    limiter; a batch that still hits one goes back to 'pending' for a later run
+    without using up its retries.
+    """
+    shallow_reports = None
+    start = time.monotonic()
+    try:
+        print(f"{name} processing batch of {len(batch)} companies.")
+        prompt = build_prompt(batch, prompt_template)
+
+        # Call the Vertex AI function
+        shallow_reports = await engine.generate(prompt)
+
+        if not isinstance(shallow_reports, list):
+            raise ValidationError(f"Expected a list of reports, got {type(shallow_reports).__name__}")
+
+        matched, missing = match_reports(batch, shallow_reports, schema)
+        if not matched:
+            raise ValidationError(f"None of the {len(shallow_reports)} reports matched a valid company report")
+
+    except (ValidationError, Exception) as e:
+        reason = failure_reason(e)
+        batcher.record_failure(len(batch), time.monotonic() - start, reason)
+        if reason == 'validation':
+            get_metrics().inc('validation_failures', stage='shallow_generate', scope='batch')
+        print(f"{name} failed batch of {len(batch)} companies: {e}")
+        if shallow_reports is not None:
+            await asyncio.to_thread(engine.discard, prompt)
+
+        if reason == 'quota':
+            # Splitting or retrying would only send more calls against the exhausted quota
+            print(f"{name} returning {len(batch)} companies to the queue after repeated quota errors.")
+            for company in batch:
+                company['state'] = 'pending'
+            return batch
+
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            print(f"{name} splitting batch into {middle} and {len(batch) - middle} companies.")
+            get_metrics().inc('retries', len(batch), reason='split')
+            halves = await asyncio.gather(
+                process_batch(name, engine, batch[:middle], batcher, schema, prompt_template),
+                process_batch(name, engine, batch[middle:], batcher, schema, prompt_template),
+            )
+            return halves[0] + halves[1]
+
+        if retries_left > 0:
+            get_metrics().inc('retries', reason='retry')
+            return await process_batch(name, engine, batch, batcher, schema, prompt_template, retries_left - 1)
+
+        # Log the raw response if it exists
+        if shallow_reports is not None:
+            print("--- FAILED VERTEX RESPONSE ---")
+            print(shallow_reports)
+            print("-----------------------------")
+        print(f"{batch[0].get('name')} failed after 2 attempts. Marking as error and skipping.")
+        batch[0]['state'] = 'error_shallow'
+        return batch
+
+    apply_reports(matched)
+
+    if not missing:
+        batcher.record_success(len(batch), time.monotonic() - start)
+        print(f"{name} finished processing batch of {len(batch)} companies.")
+        return batch
+
+    reason = 'mismatch' if len(shallow_reports) != len(batch) else 'validation'
+    batcher.record_failure(len(batch), time.monotonic() - start, reason)
+    print(f"{name} kept {len(matched)} of {len(batch)} reports; requeueing {len(missing)} companies.")
+    get_metrics().inc('retries', len(missing), reason='requeue')
+    await process_batch(name, engine, missing, batcher, schema, prompt_template, retries_left)
+    return batch
 
-def worker(processed_count, lock, result_queue, schema, pdf_bytes, prompt_template):
-    """The worker function for each thread."""
-    client = datastore.Client(database='investment-reports')
-    
+async def release_batch(name, client, batch, worker_id):
+    """Returns a batch the worker could not finish to the queue; its leases expire if even that fails."""
+    try:
+        released = await asyncio.to_thread(release_claims, client, [company['id'] for company in batch], worker_id)
+        print(f"{name} returned {released} companies to the queue.")
+    except Exception as e:
+        print(f"{name} could not release its claims ({e}); they become claimable after {Config.LEASE_SECONDS}s.")
+
+async def worker(name, engine, batcher, client, processed_count, progress, schema, prompt_template):
+    """
+    A worker coroutine that claims batches and generates their shallow reports. A batch
+    that fails outside of generation, e.g. when saving it, is logged and released, and
+    the worker moves on to the next one.
+    """
+    worker_id = make_worker_id(name)
     while True:
-        with lock:
-            if processed_count[0] >= Config.TOTAL_ITEMS_TO_PROCESS:
-                break
-            
-            batch_size = min(Config.COMPANIES_PER_PROMPT, Config.TOTAL_ITEMS_TO_PROCESS - processed_count[0])
-            if batch_size <= 0:
-                break
-            
-            processed_count[0] += batch_size
-        
-        batch = get_and_lock_pending_investments(client, batch_size, lock)
+        if processed_count[0] >= Config.TOTAL_ITEMS_TO_PROCESS:
+            break
+
+        batch_size = min(batcher.next_size(), Config.TOTAL_ITEMS_TO_PROCESS - processed_count[0])
+        if batch_size <= 0:
+            break
+        if engine.budget is not None and engine.budget.exhausted:
+            print(f"{name} stopping: the run budget is spent ({engine.budget.describe()}).")
+            break
+
+        processed_count[0] += batch_size
+
+        try:
+            with get_metrics().track('datastore_claim'):
+                batch = await asyncio.to_thread(
+                    claim_pending_investments, client, batch_size, worker_id, Config.LEASE_SECONDS, Config.KEY_RANGE,
+                    Config.PRIORITY
+                )
+        except Exception as e:
+            print(f"{name} failed to claim a batch: {e}")
+            continue
         if not batch:
             break
 
-        for attempt in range(2): # Allow for one retry
-            try:
-                print(f"Thread {threading.current_thread().name} processing batch of {len(batch)} companies (Attempt {attempt + 1}).")
-                
-                # Sanitize and format the data for the prompt
-                sanitized_companies = []
-                for company in batch:
-                    name = company.get('name', '').replace('"', '').replace('\\', '')
-                    country = company.get('country', '').replace('"', '').replace('\\', '')
-                    sanitized_companies.append(f"{name} from {country}")
-                
-                companies_data_string = "\n".join(sanitized_companies)
-                prompt = prompt_template.format(companies_data=companies_data_string)
-                
-                # Call the Vertex AI function
-                shallow_reports = vertex_generate_shallow_report(pdf_bytes, prompt, "shallow.schema.json")
-                
-                # Check if the number of reports matches the batch size
-                if len(shallow_reports) != len(batch):
-                    raise ValueError(f"Mismatched response count: expected {len(batch)}, got {len(shallow_reports)}")
-                
-                # Validate the response against the schema
-                validate(instance=shallow_reports, schema=schema)
-                
-                # Associate results with original companies
-                for i, report in enumerate(shallow_reports):
-                    # This ensures we keep all original data, including deepReport if present
-                    batch[i].update({
-                        'shallowReport': report,
-                        'state': 'done_shallow'
-                    })
-                
-                result_queue.put(batch)
-                print(f"Thread {threading.current_thread().name} finished processing batch.")
-                break # Success, exit the retry loop
-                
-            except (ValidationError, Exception) as e:
-                print(f"Attempt {attempt + 1} failed for batch: {e}")
-                if attempt == 1:
-                    # Log the raw response if it exists
-                    if 'shallow_reports' in locals():
-                        print("--- FAILED VERTEX RESPONSE ---")
-                        print(shallow_reports)
-                        print("-----------------------------")
-                    print(f"Batch failed after 2 attempts. Marking as error and skipping.")
-                    for company in batch:
-                        company['state'] = 'error_shallow'
-                    result_queue.put(batch) # Put the batch with error state in the queue to be updated
-        
-def main(num_items):
+        try:
+            remaining = await asyncio.to_thread(use_stored_reports, engine, batch, prompt_template, schema)
+            if remaining:
+                await process_batch(name, engine, remaining, batcher, schema, prompt_template)
+
+            # Save the batch, including any companies with error state
+            await save_results(client, batch, progress)
+        except Exception as e:
+            print(f"{name} failed to finish a batch of {len(batch)} companies: {e}")
+            await release_batch(name, client, batch, worker_id)
+
+async def run_pipeline(engine, batcher, schema, prompt_template, client=None):
+    """Runs MAX_IN_FLIGHT worker coroutines until the item budget or the pending queue is exhausted."""
+    client = client or datastore.Client(database='investment-reports')
+
+    # Use a list to hold the counter so it's mutable and passed by reference
+    processed_count = [0]
+    progress = NodeProgress(client, Config.RUN_ID, Config.SHARD)
+
+    workers = [
+        worker(f"Worker-{i+1}", engine, batcher, client, processed_count, progress, schema, prompt_template)
+        for i in range(Config.MAX_IN_FLIGHT)
+    ]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        if engine.cached_context is not None:
+            await engine.cached_context.close()
+        batcher.print_stats()
+        engine.limiter.print_stats()
+        if engine.budget is not None:
+            print(f"\nRun budget: spent {engine.budget.describe()}.")
+        engine.response_cache.print_stats()
+        progress.print_summary()
+        await asyncio.to_thread(progress.report, True)
+        get_metrics().print_summary()
+        if Config.METRICS_SUMMARY:
+            get_metrics().write_summary(Config.METRICS_SUMMARY)
+
+def main(num_items, max_in_flight=None, timeout=None, use_context_cache=False, cache_ttl=None,
+         batch_size=None, fixed_batch_size=False, shard=None, key_range=None, run_id=None, use_response_cache=True,
+         metrics_port=None, metrics_summary=None, rpm=None, tpm=None, priority=None, budget=None):
     Config.TOTAL_ITEMS_TO_PROCESS = num_items if num_items else Config.TOTAL_ITEMS_TO_PROCESS
-    
+    Config.COMPANIES_PER_PROMPT = batch_size if batch_size else Config.COMPANIES_PER_PROMPT
+    Config.MAX_IN_FLIGHT = max_in_flight if max_in_flight else Config.MAX_IN_FLIGHT
+    Config.REQUEST_TIMEOUT = timeout if timeout else Config.REQUEST_TIMEOUT
+    Config.CACHE_TTL = cache_ttl if cache_ttl else Config.CACHE_TTL
+    Config.RUN_ID = run_id if run_id else Config.RUN_ID
+    Config.METRICS_PORT = metrics_port if metrics_port else Config.METRICS_PORT
+    Config.METRICS_SUMMARY = metrics_summary if metrics_summary else Config.METRICS_SUMMARY
+    Config.RPM = rpm if rpm else Config.RPM
+    Config.TPM = tpm if tpm else Config.TPM
+    Config.PRIORITY = priority if priority else Config.PRIORITY
+    Config.BUDGET = budget if budget else Config.BUDGET
+
+    if Config.RPM or Config.TPM:
+        set_limits(SHALLOW_MODEL, Config.RPM, Config.TPM)
+
+    if Config.METRICS_PORT:
+        get_metrics().serve(Config.METRICS_PORT)
+
+    if shard:
+        shard_index, shard_count = shard
+        Config.KEY_RANGE = shard_key_range(shard_index, shard_count, load_base_ids())
+        Config.SHARD = f"{shard_index}/{shard_count}"
+    elif key_range:
+        Config.KEY_RANGE = key_range
+        Config.SHARD = describe_key_range(key_range)
+    if Config.KEY_RANGE:
+        print(f"Processing shard {Config.SHARD} with key range {describe_key_range(Config.KEY_RANGE)}.")
+
     # Load external files once
     pdf_bytes = load_pdf_bytes('scripts/etchical_guidelines.pdf')
     prompt_template = load_prompt_template()
     shallow_schema = load_shallow_schema()
-    
-    job_lock = threading.Lock()
-    completed_lock = threading.Lock()
-    result_queue = queue.Queue()
-    
-    # Use a list to hold the counter so it's mutable and passed by reference
-    processed_count = [0]
-    completed_count = [0]
-    
-    # Create and start worker threads
-    threads = []
-    for i in range(Config.NUM_THREADS):
-        thread = threading.Thread(target=worker, args=(processed_count, job_lock, result_queue, shallow_schema, pdf_bytes, prompt_template), name=f"Worker-{i+1}")
-        threads.append(thread)
-        thread.start()
-        
-    # Create and start the results saver thread
-    stop_event = threading.Event()
-    saver_thread = threading.Thread(target=results_saver, args=(result_queue, stop_event, completed_count, completed_lock))
-    saver_thread.start()
-        
-    for thread in threads:
-        thread.join()
-        
-    # All workers are done, signal the saver to stop
-    stop_event.set()
-    saver_thread.join()
+
+    cached_context = None
+    if use_context_cache:
+        # Register the guidelines and the prompt prefix once; each batch then only sends its companies
+        prompt_prefix, prompt_template = split_prompt_template(prompt_template)
+        cached_context = CachedContext(
+            VertexCacheBackend(get_shared_client()),
+            SHALLOW_MODEL,
+            build_cache_contents(pdf_bytes, prompt_prefix),
+            ttl_seconds=Config.CACHE_TTL,
+        )
+
+    engine = ShallowReportEngine(
+        pdf_bytes,
+        Config.SCHEMA,
+        max_in_flight=Config.MAX_IN_FLIGHT,
+        timeout=Config.REQUEST_TIMEOUT,
+        cached_context=cached_context,
+        response_cache=None if use_response_cache else ResponseCache(enabled=False),
+        budget=RunBudget.from_arg(Config.BUDGET),
+    )
+    if fixed_batch_size:
+        batcher = AdaptiveBatcher(Config.COMPANIES_PER_PROMPT, Config.COMPANIES_PER_PROMPT, Config.COMPANIES_PER_PROMPT)
+    else:
+        batcher = AdaptiveBatcher(
+            Config.COMPANIES_PER_PROMPT,
+            Config.MIN_COMPANIES_PER_PROMPT,
+            Config.MAX_COMPANIES_PER_PROMPT,
+            Config.TARGET_LATENCY,
+        )
+    asyncio.run(run_pipeline(engine, batcher, shallow_schema, prompt_template))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Create shallow investment reports using Vertex AI.")
-    parser.add_argument('num_items', type=int, nargs='?', default=None, 
+    parser.add_argument('num_items', type=int, nargs='?', default=None,
                         help='The total number of investments to process. Defaults to the value set in the script (currently 250).')
+    parser.add_argument('--max-in-flight', type=int, default=None,
+                        help=f'Maximum number of concurrent Vertex AI calls. Defaults to {Config.MAX_IN_FLIGHT}.')
+    parser.add_argument('--timeout', type=int, default=None,
+                        help=f'Seconds before a Vertex AI call is cancelled. Defaults to {Config.REQUEST_TIMEOUT}.')
+    parser.add_argument('--context-cache', action='store_true',
+                        help='Upload the guidelines PDF and prompt prefix once as a Vertex AI context cache.')
+    parser.add_argument('--cache-ttl', type=int, default=None,
+                        help=f'TTL in seconds for the context cache. Defaults to {Config.CACHE_TTL}.')
+    parser.add_argument('--no-response-cache', action='store_true',
+                        help='Call the model even for prompts with a response in the local response cache.')
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help=f'Initial number of companies per prompt. Defaults to {Config.COMPANIES_PER_PROMPT}.')
+    parser.add_argument('--fixed-batch-size', action='store_true',
+                        help='Keep the number of companies per prompt fixed instead of adapting it.')
+    shard_group = parser.add_mutually_exclusive_group()
+    shard_group.add_argument('--shard', type=parse_shard, default=None,
+                             help='Only process shard i of N equal key ranges, e.g. 0/4. Run one node per shard.')
+    shard_group.add_argument('--key-range', type=parse_key_range, default=None,
+                             help='Only process ids in [START, END), e.g. a:m. Either end may be left empty.')
+    parser.add_argument('--run-id', default=None,
+                        help='Groups the progress of nodes in one run for "python scripts/sharding.py".')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve OpenMetrics on this port at /metrics, and a JSON summary at /summary, during the run.')
+    parser.add_argument('--metrics-summary', default=None,
+                        help='Write the JSON run summary with per-stage latencies and token usage to this file.')
+    parser.add_argument('--rpm', type=int, default=None,
+                        help=f'Requests per minute allowed for {SHALLOW_MODEL}. Defaults to its entry in rate_limiter.MODEL_LIMITS.')
+    parser.add_argument('--tpm', type=int, default=None,
+                        help=f'Tokens per minute allowed for {SHALLOW_MODEL}. Defaults to its entry in rate_limiter.MODEL_LIMITS.')
+    parser.add_argument('--priority', choices=PRIORITY_MODES, default=None,
+                        help='Process the pending investments with the highest market value, ownership share or '
+                             'industry-weighted market value first. Run "python scripts/scheduling.py" once to store '
+                             'the scores on investments imported before they existed.')
+    parser.add_argument('--budget', type=parse_budget, default=None,
+                        help='Stop claiming work once the run has made this many model calls, e.g. 300, or used this '
+                             'many tokens, e.g. 5Mtokens. Batches already in flight still finish.')
     args = parser.parse_args()
-    
-    main(args.num_items)
+
+    main(args.num_items, args.max_in_flight, args.timeout, args.context_cache, args.cache_ttl,
+         args.batch_size, args.fixed_batch_size, args.shard, args.key_range, args.run_id, not args.no_response_cache,
+         args.metrics_port, args.metrics_summary, args.rpm, args.tpm, args.priority, args.budget)
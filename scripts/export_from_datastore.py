@@ -1,34 +1,504 @@
+import argparse
+import gzip
+import hashlib
 import json
 import os
+import re
+from datetime import datetime
 from google.cloud import datastore
+from stats_index import get_category_from_entity, is_removed
+from timestamps import now_utc
+from vertex_schema import get_schema, get_stored_shallow_schema
 
-def export_investments_to_json():
-    """Fetches all investments from Datastore and exports them to a JSON file."""
-    
-    client = datastore.Client(database='investment-reports')
-    
-    # Query for all entities of kind 'Investment'
-    query = client.query(kind='Investment')
-    all_investments = list(query.fetch())
-    
-    if not all_investments:
-        print("No investments found in Datastore to export.")
-        return
-        
-    print(f"Found {len(all_investments)} investments to export.")
-    
+try:
+    import brotli
+except ImportError:
+    brotli = None # Only the gzip copy of the index is written
+
+PAGE_SIZE = 500
+INDEX_FILE_NAME = 'investments_index.json'
+DETAIL_DIR_NAME = 'companies'
+# Report fields checked with --validate, and the compiled schema of the report as it is stored
+REPORT_SCHEMAS = (('shallowReport', get_stored_shallow_schema), ('deepReport', lambda: get_schema('full.schema.json')))
+INDEX_FIELDS = ('id', 'name', 'country', 'industry', 'marketValueNok', 'ownership', 'voting',
+                'incorporationCountry', 'state')
+
+def default_data_dir():
     # Define the output path relative to the script's location
     script_dir = os.path.dirname(__file__)
-    output_path = os.path.join(script_dir, '..', 'frontend', 'public', 'data', 'investments_exported.json')
-    
+    return os.path.join(script_dir, '..', 'frontend', 'public', 'data')
+
+def default_output_path():
+    return os.path.join(default_data_dir(), 'investments_exported.json')
+
+def _json_default(value):
+    """Serializes Datastore values that json does not handle, such as lease and update timestamps."""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class StreamWriter:
+    """
+    Writes investments to a file one at a time, either as a JSON array or as NDJSON.
+    A writer can be reopened at a saved offset, which drops anything written after
+    that offset, so an interrupted export resumes without duplicates.
+    """
+
+    def __init__(self, path, fmt, offset=None, count=0):
+        self.path = path
+        self.fmt = fmt
+        self.count = count
+        if offset is None:
+            self.file = open(path, 'w', encoding='utf-8')
+            if fmt == 'json':
+                self.file.write('[')
+        else:
+            self.file = open(path, 'r+', encoding='utf-8')
+            self.file.seek(offset)
+            self.file.truncate()
+
+    def write(self, investment):
+        data = json.dumps(investment, ensure_ascii=False, default=_json_default)
+        if self.fmt == 'json':
+            self.file.write(',\n' if self.count else '\n')
+            self.file.write(data)
+        else:
+            self.file.write(data + '\n')
+        self.count += 1
+
+    def checkpoint(self):
+        """Flushes the file and returns the offset and count to resume from."""
+        self.file.flush()
+        return {'offset': self.file.tell(), 'count': self.count}
+
+    def close(self):
+        if self.fmt == 'json':
+            self.file.write('\n]\n')
+        self.file.close()
+
+def _shard_value(entity, shard_by):
+    if shard_by == 'category':
+        value = get_category_from_entity(entity) or 'none'
+    else:
+        value = entity.get(shard_by) or 'none'
+    return re.sub(r'[^a-z0-9]+', '-', str(value).lower()).strip('-')
+
+def _shard_path(output_path, shard_by, value):
+    base, extension = os.path.splitext(output_path)
+    return f"{base}.{shard_by}-{value}{extension}"
+
+def _load_state(state_path):
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _save_state(state_path, state):
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temp_path, state_path)
+
+def _last_export_path(output_path):
+    return output_path + '.last-export.json'
+
+def _load_last_export(output_path):
+    """Returns the start time of the last completed export to `output_path`, or None."""
+    path = _last_export_path(output_path)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return datetime.fromisoformat(json.load(f)['exportedAt'])
+
+def _save_last_export(output_path, started_at):
+    with open(_last_export_path(output_path), 'w', encoding='utf-8') as f:
+        json.dump({'exportedAt': started_at.isoformat()}, f)
+
+def _read_exported(path, fmt):
+    """Yields the investments of an existing export file."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if fmt == 'ndjson':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+def iter_investment_pages(client, page_size=PAGE_SIZE, cursor=None, since=None):
+    """
+    Yields (entities, cursor) for each page of investments, starting after `cursor`.
+    The cursor is the one to resume from after that page. With `since`, only
+    investments whose 'updatedAt' is at or after it are fetched.
+    """
+    while True:
+        query = client.query(kind='Investment')
+        if since is not None:
+            query.add_filter('updatedAt', '>=', since)
+        iterator = query.fetch(limit=page_size, start_cursor=cursor)
+        page = next(iterator.pages, None)
+        entities = list(page) if page is not None else []
+        cursor = iterator.next_page_token
+        if isinstance(cursor, bytes):
+            cursor = cursor.decode('ascii')
+        yield entities, cursor
+        if len(entities) < page_size or not cursor:
+            return
+
+def fetch_changed_investments(client, since, page_size=PAGE_SIZE):
+    """Fetches the investments whose 'updatedAt' is at or after `since`, keyed by id."""
+    changed = {}
+    for entities, _ in iter_investment_pages(client, page_size, since=since):
+        for entity in entities:
+            changed[entity.key.name] = entity
+    return changed
+
+def export_changed_investments(output_path=None, fmt='json', since='last', page_size=PAGE_SIZE):
+    """
+    Merges only the investments changed since `since` into an existing export. `since`
+    is a datetime, or 'last' for the start of the previous completed export. The cost is
+    proportional to the number of changed investments rather than the size of the fund.
+    Changed holdings that have been marked removed are dropped from the export.
+    """
+    client = datastore.Client(database='investment-reports')
+    output_path = output_path or default_output_path()
+
+    if not os.path.exists(output_path):
+        print(f"No existing export at {output_path}; run a full export first.")
+        return
+
+    if since == 'last':
+        since = _load_last_export(output_path)
+        if since is None:
+            print(f"No previous export time recorded for {output_path}; run a full export first.")
+            return
+
+    started_at = now_utc()
+    changed = fetch_changed_investments(client, since, page_size)
+    print(f"Found {len(changed)} investments changed since {since.isoformat()}.")
+
+    if changed:
+        # Rewrite the export with the changed investments swapped in, then append new ones
+        temp_path = output_path + '.tmp'
+        writer = StreamWriter(temp_path, fmt)
+        updated = 0
+        removed = 0
+        for investment in _read_exported(output_path, fmt):
+            if investment.get('id') in changed:
+                investment = changed.pop(investment['id'])
+                if is_removed(investment):
+                    removed += 1
+                    continue
+                updated += 1
+            writer.write(investment)
+        added = [investment for investment in changed.values() if not is_removed(investment)]
+        for investment in added:
+            writer.write(investment)
+        writer.close()
+        os.replace(temp_path, output_path)
+        print(f"Updated {updated}, added {len(added)} and removed {removed} investments in {output_path}")
+
+    _save_last_export(output_path, started_at)
+
+def find_invalid_reports(entities):
+    """
+    Validates the reports of a page of investments, one batch per report schema.
+    Returns (id, field, error messages) for every report that does not match its schema.
+    """
+    invalid = []
+    for field, stored_schema in REPORT_SCHEMAS:
+        owners = [entity for entity in entities if entity.get(field)]
+        errors = stored_schema().validate_many([entity[field] for entity in owners], items=False)
+        invalid += [(owners[index].key.name, field, messages) for index, messages in sorted(errors.items())]
+    return invalid
+
+def print_invalid_reports(invalid, num=10):
+    if not invalid:
+        print("Every report matches its schema.")
+        return
+    print(f"{len(invalid)} reports do not match their schema:")
+    for investment_id, field, messages in invalid[:num]:
+        print(f"  - {investment_id} {field}: {'; '.join(messages)}")
+    if len(invalid) > num:
+        print(f"  ... and {len(invalid) - num} more.")
+
+def export_investments_to_json(output_path=None, fmt='json', page_size=PAGE_SIZE, resume=False, shard_by=None,
+                               validate=False):
+    """
+    Streams all investments from Datastore to a JSON or NDJSON file, one page at a time,
+    so memory use does not grow with the dataset. The query cursor is saved after every
+    page; with `resume`, an interrupted export continues from the last saved page.
+    With `shard_by` set to 'category' or 'region', each value gets its own file.
+    With `validate`, every report is checked against its schema as it is exported.
+    Holdings marked removed by holdings_diff.py are left out.
+    """
+    client = datastore.Client(database='investment-reports')
+    output_path = output_path or default_output_path()
+    state_path = output_path + '.export-state.json'
+
     # Ensure the output directory exists
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    
-    # Write the data to the JSON file
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(all_investments, f, indent=2, ensure_ascii=False)
-        
-    print(f"Successfully exported all investments to {output_path}")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+
+    state = _load_state(state_path) if resume else None
+    if state:
+        if state['format'] != fmt or state['shardBy'] != shard_by:
+            print(f"Saved export state in {state_path} was written with different options; not resuming.")
+            state = None
+        else:
+            print(f"Resuming export after {state['exported']} investments.")
+    if state is None:
+        state = {'cursor': None, 'exported': 0, 'format': fmt, 'shardBy': shard_by, 'files': {},
+                 'startedAt': now_utc().isoformat()}
+
+    writers = {}
+    def writer_for(entity):
+        path = _shard_path(output_path, shard_by, _shard_value(entity, shard_by)) if shard_by else output_path
+        if path not in writers:
+            saved = state['files'].get(path)
+            if saved:
+                writers[path] = StreamWriter(path, fmt, saved['offset'], saved['count'])
+            else:
+                writers[path] = StreamWriter(path, fmt)
+        return writers[path]
+
+    # Reopen every file from the saved state, so files that get no new entities are still closed properly
+    for path in state['files']:
+        if path not in writers:
+            saved = state['files'][path]
+            writers[path] = StreamWriter(path, fmt, saved['offset'], saved['count'])
+    if not shard_by:
+        writer_for(None)
+
+    invalid = []
+    for entities, cursor in iter_investment_pages(client, page_size, state['cursor']):
+        for entity in entities:
+            if not is_removed(entity):
+                writer_for(entity).write(entity)
+        if validate:
+            invalid += find_invalid_reports(entities)
+
+        state['cursor'] = cursor
+        state['exported'] += len(entities)
+        state['files'] = {path: writer.checkpoint() for path, writer in writers.items()}
+        _save_state(state_path, state)
+
+        if entities:
+            print(f"Exported {state['exported']} investments...")
+
+    for writer in writers.values():
+        writer.close()
+    os.remove(state_path)
+    if not shard_by:
+        # Anything written after the export started is picked up by the next --since run
+        _save_last_export(output_path, datetime.fromisoformat(state['startedAt']))
+
+    if state['exported'] == 0:
+        print("No investments found in Datastore to export.")
+        return
+
+    for path, writer in sorted(writers.items()):
+        print(f"Wrote {writer.count} investments to {path}")
+    print(f"Successfully exported {state['exported']} investments.")
+    if validate:
+        print_invalid_reports(invalid)
+
+def report_status(entity):
+    """Returns 2 for a deep report, 1 for a shallow report and 0 for none, as shown in the company list."""
+    if entity.get('state') == 'done_deep' and entity.get('deepReport'):
+        return 2
+    if entity.get('state') == 'done_shallow' and entity.get('shallowReport'):
+        return 1
+    return 0
+
+def _risk_assessment(entity):
+    for report in ('deepReport', 'shallowReport'):
+        risk = (entity.get(report) or {}).get('riskAssessment')
+        if isinstance(risk, dict) and risk:
+            return risk
+    return {}
+
+def summarize_for_index(entity, detail_file):
+    """
+    Reduces an investment to what the company list needs: the holding itself, its
+    category and report status, and the short concerns and rationale used by search.
+    """
+    summary = {field: entity.get(field) for field in INDEX_FIELDS}
+    summary['id'] = summary['id'] or entity.key.name
+    risk = _risk_assessment(entity)
+    try:
+        summary['category'] = int(risk.get('category'))
+    except (TypeError, ValueError):
+        summary['category'] = None
+    summary['aiReportStatus'] = report_status(entity)
+    summary['concerns'] = risk.get('concerns')
+    summary['rationale'] = (entity.get('shallowReport') or {}).get('riskAssessment', {}).get('rationale')
+    summary['detail'] = detail_file
+    return summary
+
+def write_detail(data_dir, entity):
+    """
+    Writes the reports of one investment to a file named after a hash of its content,
+    so the file can be cached forever and only changes when the reports do. Returns
+    the path of the file relative to `data_dir`.
+    """
+    investment_id = entity.get('id') or entity.key.name
+    detail = {'id': investment_id, 'shallowReport': entity.get('shallowReport'), 'deepReport': entity.get('deepReport')}
+    data = json.dumps(detail, ensure_ascii=False, default=_json_default, separators=(',', ':')).encode('utf-8')
+    relative_path = f"{DETAIL_DIR_NAME}/{investment_id}.{hashlib.sha256(data).hexdigest()[:12]}.json"
+    path = os.path.join(data_dir, relative_path)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return relative_path
+
+def write_with_compressed_copies(path, data):
+    """Writes `data` along with a .gz copy, and a .br copy when the brotli package is installed."""
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data))
+
+def write_index(data_dir, index):
+    """Writes the summary index and removes the detail files it no longer references."""
+    index_path = os.path.join(data_dir, INDEX_FILE_NAME)
+    data = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    write_with_compressed_copies(index_path, data)
+
+    referenced = {os.path.basename(item['detail']) for item in index}
+    detail_dir = os.path.join(data_dir, DETAIL_DIR_NAME)
+    stale = [name for name in os.listdir(detail_dir) if name not in referenced]
+    for name in stale:
+        os.remove(os.path.join(detail_dir, name))
+
+    print(f"Wrote index of {len(index)} investments to {index_path} ({len(data) / 1024:.0f} KiB), "
+          f"{len(referenced)} detail files to {detail_dir} ({len(stale)} stale removed).")
+
+def export_split_artifact(data_dir=None, page_size=PAGE_SIZE, validate=False):
+    """
+    Writes the frontend data as a compact summary index of every investment plus one
+    content-hashed detail file per investment with its full reports. The list view
+    only loads the index; a company's detail file is fetched when it is opened.
+    Detail files that are no longer referenced are removed, as are holdings marked
+    removed by holdings_diff.py. With `validate`, every report is checked against its
+    schema as it is exported.
+    """
+    client = datastore.Client(database='investment-reports')
+    data_dir = data_dir or default_data_dir()
+    os.makedirs(os.path.join(data_dir, DETAIL_DIR_NAME), exist_ok=True)
+
+    started_at = now_utc()
+    index = []
+    invalid = []
+    for entities, _ in iter_investment_pages(client, page_size):
+        for entity in entities:
+            if not is_removed(entity):
+                index.append(summarize_for_index(entity, write_detail(data_dir, entity)))
+        if validate:
+            invalid += find_invalid_reports(entities)
+        if entities:
+            print(f"Exported {len(index)} investments...")
+
+    if not index:
+        print("No investments found in Datastore to export.")
+        return
+
+    write_index(data_dir, index)
+    # Anything written after the export started is picked up by the next --since run
+    _save_last_export(os.path.join(data_dir, INDEX_FILE_NAME), started_at)
+    if validate:
+        print_invalid_reports(invalid)
+
+def export_changed_split_artifact(data_dir=None, since='last', page_size=PAGE_SIZE, validate=False):
+    """
+    Updates an existing summary index and its detail files with only the investments
+    changed since `since`, a datetime or 'last' for the start of the previous completed
+    export. Changed holdings that have been marked removed are dropped from the index.
+    With `validate`, the changed investments' reports are checked.
+    """
+    client = datastore.Client(database='investment-reports')
+    data_dir = data_dir or default_data_dir()
+    index_path = os.path.join(data_dir, INDEX_FILE_NAME)
+
+    if not os.path.exists(index_path):
+        print(f"No existing index at {index_path}; run a full export first.")
+        return
+
+    if since == 'last':
+        since = _load_last_export(index_path)
+        if since is None:
+            print(f"No previous export time recorded for {index_path}; run a full export first.")
+            return
+
+    started_at = now_utc()
+    changed = fetch_changed_investments(client, since, page_size)
+    print(f"Found {len(changed)} investments changed since {since.isoformat()}.")
+
+    if changed:
+        invalid = find_invalid_reports(list(changed.values())) if validate else []
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        updated = 0
+        kept = []
+        for item in index:
+            if item['id'] in changed:
+                entity = changed.pop(item['id'])
+                if is_removed(entity):
+                    continue
+                item = summarize_for_index(entity, write_detail(data_dir, entity))
+                updated += 1
+            kept.append(item)
+        added = [entity for entity in changed.values() if not is_removed(entity)]
+        for entity in added:
+            kept.append(summarize_for_index(entity, write_detail(data_dir, entity)))
+        print(f"Updated {updated}, added {len(added)} and removed {len(index) + len(added) - len(kept)} investments.")
+        write_index(data_dir, kept)
+        if validate:
+            print_invalid_reports(invalid)
+
+    _save_last_export(index_path, started_at)
 
 if __name__ == '__main__':
-    export_investments_to_json()
+    parser = argparse.ArgumentParser(
+        description="Export investments from Datastore to the frontend data folder: the summary index "
+                    "and per-company detail files the frontend loads, or with --file a single file "
+                    "for the read API in main.py.")
+    parser.add_argument('--data-dir', default=None,
+                        help='Output folder for the index and detail files. Defaults to frontend/public/data.')
+    parser.add_argument('--file', action='store_true',
+                        help='Write every investment to a single file instead of the index and detail files.')
+    parser.add_argument('--output', default=None,
+                        help='Output file for --file. Defaults to frontend/public/data/investments_exported.json.')
+    parser.add_argument('--format', choices=['json', 'ndjson'], default='json',
+                        help='Write a JSON array (default) or one JSON object per line with --file.')
+    parser.add_argument('--page-size', type=int, default=PAGE_SIZE,
+                        help=f'Number of entities fetched per page. Defaults to {PAGE_SIZE}.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted --file export from its last saved cursor.')
+    parser.add_argument('--shard-by', choices=['category', 'region'], default=None,
+                        help='Write one file per category or region with --file.')
+    parser.add_argument('--since', default=None,
+                        help='Only fetch investments updated since this ISO timestamp, or since the last export '
+                             'with "last", and merge them into the existing export.')
+    parser.add_argument('--validate', action='store_true',
+                        help='Check every shallow and deep report against its schema and list the ones that fail.')
+    args = parser.parse_args()
+
+    since = None
+    if args.since:
+        since = args.since if args.since == 'last' else datetime.fromisoformat(args.since)
+
+    if not args.file:
+        if args.output or args.format != 'json' or args.resume or args.shard_by:
+            parser.error('--output, --format, --resume and --shard-by require --file.')
+        if since:
+            export_changed_split_artifact(args.data_dir, since, args.page_size, args.validate)
+        else:
+            export_split_artifact(args.data_dir, args.page_size, args.validate)
+    elif since:
+        if args.shard_by or args.resume:
+            parser.error('--since cannot be combined with --shard-by or --resume.')
+        export_changed_investments(args.output, args.format, since, args.page_size)
+    else:
+        export_investments_to_json(args.output, args.format, args.page_size, args.resume, args.shard_by, args.validate)
@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import google_crc32c
+from metrics import get_metrics
+
+HASH_CACHE_PATH = os.path.join(os.path.dirname(__file__), '.gcs_hash_cache.json')
+UPLOAD_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+
+def _file_hashes(path):
+    """Returns the base64 MD5 and CRC32C of a file, in the same encoding GCS uses for object metadata."""
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+            crc32c.update(chunk)
+    return base64.b64encode(md5.digest()).decode('ascii'), base64.b64encode(crc32c.digest()).decode('ascii')
+
+class HashCache:
+    """
+    Remembers the hashes of local files by path, along with the size and mtime they
+    were computed for, so an unchanged file is never read again to be hashed.
+    """
+
+    def __init__(self, path=HASH_CACHE_PATH):
+        self.path = path
+        self.entries = {}
+        self.rehashed = 0
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def hashes(self, file_path):
+        """Returns (md5, crc32c) for a file, hashing it only if it changed since it was last hashed."""
+        stat = os.stat(file_path)
+        key = os.path.abspath(file_path)
+        entry = self.entries.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            md5, crc32c = _file_hashes(file_path)
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'md5': md5, 'crc32c': crc32c}
+            self.entries[key] = entry
+            self.rehashed += 1
+        return entry['md5'], entry['crc32c']
+
+    def save(self):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(temp_path, self.path)
+
+def list_remote_objects(bucket):
+    """Lists the name, size and checksums of every object in the bucket in one paged listing."""
+    remote = {}
+    for blob in bucket.list_blobs(fields='items(name,size,md5Hash,crc32c),nextPageToken'):
+        remote[blob.name] = {'size': blob.size, 'md5': blob.md5_hash, 'crc32c': blob.crc32c}
+    return remote
+
+def is_unchanged(remote_object, md5, crc32c):
+    """Compares by MD5 when the object has one; composite objects only carry a CRC32C."""
+    if remote_object is None:
+        return False
+    if remote_object['md5']:
+        return remote_object['md5'] == md5
+    return remote_object['crc32c'] == crc32c
+
+def _format_bytes(size):
+    if size < 1024:
+        return f"{size} B"
+    for unit in ('KiB', 'MiB', 'GiB'):
+        size /= 1024
+        if size < 1024 or unit == 'GiB':
+            return f"{size:.1f} {unit}"
+
+def sync_files_to_gcs(bucket, files, workers=UPLOAD_WORKERS, force=False, hash_cache=None):
+    """
+    Uploads local files to the bucket, skipping those whose bytes the bucket already
+    has. `files` maps local paths to object names. The bucket is listed once and its
+    checksums compared against local hashes; with `force`, every file is uploaded.
+    Returns (uploaded, skipped, failed) file counts.
+    """
+    start = time.monotonic()
+    hash_cache = hash_cache or HashCache()
+    remote = {} if force else list_remote_objects(bucket)
+
+    to_upload = []
+    skipped_bytes = 0
+    for local_path, object_name in sorted(files.items()):
+        md5, crc32c = hash_cache.hashes(local_path)
+        if not force and is_unchanged(remote.get(object_name), md5, crc32c):
+            skipped_bytes += os.path.getsize(local_path)
+        else:
+            to_upload.append((local_path, object_name))
+    hash_cache.save()
+
+    def upload(local_path, object_name):
+        with get_metrics().track('gcs_upload'):
+            bucket.blob(object_name).upload_from_filename(local_path)
+        return os.path.getsize(local_path)
+
+    uploaded_bytes = 0
+    failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(upload, *item): item for item in to_upload}
+        for future in as_completed(futures):
+            local_path, object_name = futures[future]
+            try:
+                uploaded_bytes += future.result()
+                print(f"File {local_path} uploaded to {object_name}.")
+            except Exception as e:
+                failed += 1
+                print(f"Error uploading {local_path}: {e}")
+
+    uploaded = len(to_upload) - failed
+    skipped = len(files) - len(to_upload)
+    print(f"\nUploaded {uploaded} files ({_format_bytes(uploaded_bytes)}), skipped {skipped} unchanged files "
+          f"({_format_bytes(skipped_bytes)} saved), {failed} failed. Hashed {hash_cache.rehashed} files "
+          f"in {time.monotonic() - start:.1f}s.")
+    return uploaded, skipped, failed
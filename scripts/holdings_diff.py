@@ -0,0 +1,292 @@
+import argparse
+import difflib
+import json
+import random
+import re
+import time
+from google.api_core.exceptions import Aborted, Conflict
+from google.cloud import datastore
+from create_base_investments import load_holdings
+from import_to_firestore import BASE_FIELDS, CHUNK_SIZE, TRANSACTION_ATTEMPTS
+from job_claims import release_lease
+from scheduling import set_priority
+from stats_index import REMOVED_STATE, apply_transitions, is_removed, summarize
+from timestamps import now_utc, stamp_updated
+
+RENAME_SIMILARITY = 0.85 # Name similarity at which a removed and an added holding count as one renamed company
+MATERIAL_VALUE_RATIO = 0.5 # A market value change of more than 50% up or down is material
+MATERIAL_OWNERSHIP_DELTA = 1.0 # So is an ownership change of more than one percentage point
+# Fields whose change means the company itself changed, so its reports may no longer hold
+IDENTITY_FIELDS = ('industry', 'country', 'incorporationCountry')
+REPORT_FIELDS = ('state', 'shallowReport', 'deepReport')
+# Reports of a holding sent back to pending are kept under these names until new ones are generated
+ARCHIVED_REPORT_FIELDS = {'shallowReport': 'previousShallowReport', 'deepReport': 'previousDeepReport'}
+
+def _normalize_name(name):
+    """Lowercases a company name and drops punctuation and legal suffixes, which often change on their own."""
+    name = re.sub(r'[^a-z0-9 ]+', ' ', (name or '').lower())
+    words = [word for word in name.split() if word not in ('ltd', 'limited', 'inc', 'corp', 'co', 'plc', 'sa', 'ag',
+                                                            'nv', 'asa', 'ab', 'spa', 'se', 'the', 'holdings')]
+    return ' '.join(words)
+
+def _delta(old, new):
+    if old is None or new is None:
+        return None
+    return new - old
+
+def compare(old, new, ownership_delta=MATERIAL_OWNERSHIP_DELTA, value_ratio=MATERIAL_VALUE_RATIO):
+    """
+    Compares two snapshots of one holding. Returns None if nothing changed, otherwise
+    the changed fields, the value and ownership deltas and whether the change is
+    material enough to generate new reports.
+    """
+    fields = [field for field in BASE_FIELDS if old.get(field) != new.get(field)]
+    if not fields:
+        return None
+
+    value_delta = _delta(old.get('marketValueNok'), new.get('marketValueNok'))
+    value_change = value_delta / old['marketValueNok'] if value_delta is not None and old['marketValueNok'] else None
+    ownership = _delta(old.get('ownership'), new.get('ownership'))
+
+    reasons = [f"{field} changed" for field in IDENTITY_FIELDS if field in fields]
+    if value_change is not None and abs(value_change) > value_ratio:
+        reasons.append(f"market value {value_change:+.0%}")
+    if ownership is not None and abs(ownership) > ownership_delta:
+        reasons.append(f"ownership {ownership:+.2f} pp")
+
+    return {
+        'id': new['id'],
+        'name': new.get('name'),
+        'fields': fields,
+        'marketValueNokDelta': value_delta,
+        'marketValueChange': value_change,
+        'ownershipDelta': ownership,
+        'votingDelta': _delta(old.get('voting'), new.get('voting')),
+        'material': bool(reasons),
+        'reasons': reasons,
+    }
+
+def detect_renames(removed, added, similarity=RENAME_SIMILARITY):
+    """
+    Pairs removed holdings with added ones in the same country whose normalized names
+    are similar enough to be the same company under a new name. Returns the
+    (old, new, similarity) pairs; each holding is used at most once.
+    """
+    added_by_country = {}
+    for holding in added:
+        added_by_country.setdefault(holding.get('country'), []).append(holding)
+
+    candidates = []
+    for old in removed:
+        old_name = _normalize_name(old.get('name'))
+        for new in added_by_country.get(old.get('country'), []):
+            ratio = difflib.SequenceMatcher(None, old_name, _normalize_name(new.get('name'))).ratio()
+            if ratio >= similarity:
+                candidates.append((ratio, old, new))
+
+    # Best matches first, so a name is paired with its closest counterpart
+    pairs = []
+    used = set()
+    for ratio, old, new in sorted(candidates, key=lambda candidate: -candidate[0]):
+        if old['id'] in used or new['id'] in used:
+            continue
+        used.update((old['id'], new['id']))
+        pairs.append((old, new, ratio))
+    return pairs
+
+def diff_holdings(old_holdings, new_holdings, ownership_delta=MATERIAL_OWNERSHIP_DELTA,
+                  value_ratio=MATERIAL_VALUE_RATIO, similarity=RENAME_SIMILARITY):
+    """Diffs two holdings snapshots into added, removed, renamed and changed holdings."""
+    old_by_id = {holding['id']: holding for holding in old_holdings}
+    new_by_id = {holding['id']: holding for holding in new_holdings}
+
+    added = [holding for holding in new_holdings if holding['id'] not in old_by_id]
+    removed = [holding for holding in old_holdings if holding['id'] not in new_by_id]
+    renames = detect_renames(removed, added, similarity)
+    renamed_ids = {old['id'] for old, _, _ in renames} | {new['id'] for _, new, _ in renames}
+
+    changed = []
+    for holding in new_holdings:
+        if holding['id'] in old_by_id:
+            change = compare(old_by_id[holding['id']], holding, ownership_delta, value_ratio)
+            if change:
+                changed.append(change)
+
+    renamed = []
+    for old, new, ratio in renames:
+        change = compare(old, new, ownership_delta, value_ratio) or {'material': False, 'reasons': []}
+        renamed.append({'oldId': old['id'], 'oldName': old.get('name'), 'id': new['id'], 'name': new.get('name'),
+                        'similarity': round(ratio, 3), 'material': change['material'], 'reasons': change['reasons']})
+
+    return {
+        'added': [holding for holding in added if holding['id'] not in renamed_ids],
+        'removed': [holding for holding in removed if holding['id'] not in renamed_ids],
+        'renamed': renamed,
+        'changed': changed,
+    }
+
+def print_diff(diff, num=10):
+    material = [change for change in diff['changed'] if change['material']]
+    print(f"\nAdded: {len(diff['added'])}, removed: {len(diff['removed'])}, renamed: {len(diff['renamed'])}, "
+          f"changed: {len(diff['changed'])} ({len(material)} material).")
+
+    for title, holdings in (('Added', diff['added']), ('Removed', diff['removed'])):
+        if holdings:
+            print(f"\n{title} (largest first):")
+            for holding in sorted(holdings, key=lambda h: -(h.get('marketValueNok') or 0))[:num]:
+                print(f"  - {holding['name']} ({holding['country']}): {holding.get('marketValueNok') or 0:,} NOK")
+    if diff['renamed']:
+        print("\nRenamed:")
+        for rename in diff['renamed'][:num]:
+            print(f"  - {rename['oldName']} -> {rename['name']} (similarity {rename['similarity']:.2f})")
+    if material:
+        print("\nMaterial changes:")
+        for change in material[:num]:
+            print(f"  - {change['name']}: {', '.join(change['reasons'])}")
+
+def _chunks(items, size=CHUNK_SIZE):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+def _set_pending(entity):
+    """Sends an investment back for new reports, releasing its lease and archiving the reports that may no longer hold."""
+    entity['state'] = 'pending'
+    release_lease(entity)
+    for field, archived_field in ARCHIVED_REPORT_FIELDS.items():
+        if field in entity:
+            entity[archived_field] = entity.pop(field)
+
+def _mark_removed(entity, now, renamed_to=None):
+    """Marks a holding the fund no longer owns, keeping its reports but taking it out of the stats and exports."""
+    entity['state'] = REMOVED_STATE
+    entity['removedAt'] = now
+    if renamed_to:
+        entity['renamedTo'] = renamed_to
+    release_lease(entity)
+    stamp_updated(entity, now)
+
+def _apply_chunk(client, chunk, pending_ids, renamed_from):
+    """Writes one chunk of new holdings in a transaction. Returns the number of investments set to pending."""
+    keys = [client.key('Investment', holding['id']) for holding in chunk]
+    old_keys = [client.key('Investment', renamed_from[holding['id']]) for holding in chunk if holding['id'] in renamed_from]
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            now = now_utc()
+            transitions = []
+            written = []
+            with client.transaction():
+                existing = {entity.key.name: entity for entity in client.get_multi(keys + old_keys)}
+                for key, holding in zip(keys, chunk):
+                    entity = existing.get(key.name)
+                    before = summarize(entity) if entity is not None else None
+                    if entity is None:
+                        entity = datastore.Entity(key=key)
+                        entity.update(holding)
+                        entity['state'] = 'pending'
+                        previous = existing.get(renamed_from.get(holding['id']))
+                        if previous is not None:
+                            # A renamed company keeps the reports of its old id, which stops being a holding
+                            old_before = summarize(previous)
+                            entity.update({field: previous[field] for field in REPORT_FIELDS if field in previous})
+                            entity['renamedFrom'] = previous.key.name
+                            if entity['state'].startswith('in_progress') or is_removed(entity):
+                                # The lease stays with the old id, so the new one is queued afresh
+                                entity['state'] = 'pending'
+                            _mark_removed(previous, now, renamed_to=holding['id'])
+                            written.append(previous)
+                            transitions.append((old_before, summarize(previous)))
+                    else:
+                        entity.update({field: holding.get(field) for field in BASE_FIELDS})
+                    if holding['id'] in pending_ids:
+                        _set_pending(entity)
+                    set_priority(entity)
+                    stamp_updated(entity, now)
+                    written.append(entity)
+                    transitions.append((before, summarize(entity)))
+                client.put_multi(written)
+            apply_transitions(client, transitions)
+            return sum(1 for entity in written if entity['state'] == 'pending')
+        except (Aborted, Conflict):
+            time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+    raise RuntimeError(f"Chunk starting at '{chunk[0]['id']}' kept conflicting after {TRANSACTION_ATTEMPTS} attempts")
+
+def _remove_chunk(client, ids):
+    """Marks one chunk of removed holdings in a transaction. Returns the number marked."""
+    keys = [client.key('Investment', investment_id) for investment_id in ids]
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            now = now_utc()
+            transitions = []
+            written = []
+            with client.transaction():
+                for entity in client.get_multi(keys):
+                    if is_removed(entity):
+                        continue
+                    before = summarize(entity)
+                    _mark_removed(entity, now)
+                    written.append(entity)
+                    transitions.append((before, None))
+                if written:
+                    client.put_multi(written)
+            apply_transitions(client, transitions)
+            return len(written)
+        except (Aborted, Conflict):
+            time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+    raise RuntimeError(f"Chunk starting at '{ids[0]}' kept conflicting after {TRANSACTION_ATTEMPTS} attempts")
+
+def apply_diff(diff, new_holdings):
+    """
+    Writes a diff to Datastore. Added holdings and materially changed or renamed ones
+    go to pending with their old reports archived; other changes only update the
+    holding fields and keep their state and reports. Removed holdings, and the old ids
+    of renamed ones, are marked 'removed': their reports are kept, but they are no
+    longer counted in the stats index or exported.
+    """
+    client = datastore.Client(database='investment-reports')
+    new_by_id = {holding['id']: holding for holding in new_holdings}
+
+    pending_ids = {holding['id'] for holding in diff['added']}
+    pending_ids |= {change['id'] for change in diff['changed'] if change['material']}
+    pending_ids |= {rename['id'] for rename in diff['renamed'] if rename['material']}
+    renamed_from = {rename['id']: rename['oldId'] for rename in diff['renamed']}
+
+    ids = [holding['id'] for holding in diff['added']] + [change['id'] for change in diff['changed']]
+    # A rename also writes its old id, so renames go in half-size chunks to stay within a transaction's limit
+    chunks = _chunks([new_by_id[investment_id] for investment_id in ids])
+    chunks += _chunks([new_by_id[investment_id] for investment_id in renamed_from], CHUNK_SIZE // 2)
+    ids += list(renamed_from)
+    pending = 0
+    for chunk in chunks:
+        pending += _apply_chunk(client, chunk, pending_ids, renamed_from)
+    removed = 0
+    for chunk in _chunks([holding['id'] for holding in diff['removed']]):
+        removed += _remove_chunk(client, chunk)
+    print(f"\nWrote {len(ids)} investments to Datastore; {pending} set to pending, {removed} marked removed.")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Diff two NBIM holdings CSV snapshots, e.g. from consecutive quarters.")
+    parser.add_argument('old_csv', help='The earlier holdings CSV.')
+    parser.add_argument('new_csv', help='The later holdings CSV.')
+    parser.add_argument('--output', default=None, help='Write the full diff to this JSON file.')
+    parser.add_argument('--num', type=int, default=10, help='Number of holdings listed per section. Defaults to 10.')
+    parser.add_argument('--ownership-delta', type=float, default=MATERIAL_OWNERSHIP_DELTA,
+                        help=f'Ownership change in percentage points that counts as material. Defaults to {MATERIAL_OWNERSHIP_DELTA}.')
+    parser.add_argument('--value-ratio', type=float, default=MATERIAL_VALUE_RATIO,
+                        help=f'Relative market value change that counts as material. Defaults to {MATERIAL_VALUE_RATIO}.')
+    parser.add_argument('--similarity', type=float, default=RENAME_SIMILARITY,
+                        help=f'Name similarity from 0 to 1 for rename detection. Defaults to {RENAME_SIMILARITY}.')
+    parser.add_argument('--apply', action='store_true',
+                        help='Write the diff to Datastore, setting new and materially changed companies to pending.')
+    args = parser.parse_args()
+
+    old_holdings = load_holdings(args.old_csv)
+    new_holdings = load_holdings(args.new_csv)
+    diff = diff_holdings(old_holdings, new_holdings, args.ownership_delta, args.value_ratio, args.similarity)
+    print_diff(diff, args.num)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(diff, f, indent=2, ensure_ascii=False)
+        print(f"\nWrote the full diff to {args.output}")
+
+    if args.apply:
+        apply_diff(diff, new_holdings)
@@ -1,42 +1,165 @@
+import argparse
+import hashlib
 import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from google.api_core.exceptions import Aborted, Conflict
 from google.cloud import datastore
+from timestamps import now_utc, stamp_updated
+from stats_index import apply_transitions, put_with_stats, summarize
+from scheduling import PRIORITY_PROPERTY, set_priority
 
-def import_investments_to_datastore():
-    # Initialize Datastore client
-    # The client will automatically use the credentials from GOOGLE_APPLICATION_CREDENTIALS
-    client = datastore.Client(database='investment-reports')
-    
-    # Load the investments data
-    with open('scripts/investments.json', 'r', encoding='utf-8') as f:
-        investments = json.load(f)
-        
-    kind = 'Investment'
-    
-    batch = client.batch()
-    batch.begin()
-    
-    for i, investment in enumerate(investments):
-        # Add the state field
-        investment['state'] = 'pending'
-        
-        # Create a key for the entity. We'll use the company 'id' for the key name.
-        key = client.key(kind, investment['id'])
-        entity = datastore.Entity(key=key)
+JSON_FILE_PATH = 'scripts/investments.json'
+CHUNK_SIZE = 500 # Datastore commits are limited to 500 entities
+WORKERS = 8 # Chunks committed at the same time
+TRANSACTION_ATTEMPTS = 5
+# Fields that come from the holdings file; everything else (state, reports, leases) belongs to the pipelines
+BASE_FIELDS = ('name', 'industry', 'region', 'country', 'marketValueNok', 'marketValueUsd', 'voting', 'ownership',
+               'incorporationCountry')
+
+def _state_path(json_file_path):
+    return json_file_path + '.import-state.json'
+
+def _load_state(state_path, fingerprint, mode):
+    """Returns the chunks already committed by an interrupted import of the same file in the same mode."""
+    if not os.path.exists(state_path):
+        return set()
+    with open(state_path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    if state['fingerprint'] != fingerprint or state['mode'] != mode:
+        print(f"Saved import state in {state_path} is for a different file or mode; starting over.")
+        return set()
+    return set(state['done'])
+
+def _save_state(state_path, fingerprint, mode, done):
+    temp_path = state_path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump({'fingerprint': fingerprint, 'mode': mode, 'done': sorted(done)}, f)
+    os.replace(temp_path, state_path)
+
+def replace_chunk(client, chunk):
+    """Writes every holding in the chunk as a new pending investment, overwriting what is stored."""
+    entities = []
+    for investment in chunk:
+        entity = datastore.Entity(key=client.key('Investment', investment['id']))
         entity.update(investment)
-        batch.put(entity)
-        
-        # Datastore batches also have a limit of 500 operations.
-        if (i + 1) % 500 == 0:
-            print(f"Committing batch of 500 entities...")
-            batch.commit()
-            batch = client.batch()
-            batch.begin()
-    
-    # Commit any remaining entities
-    print("Committing final batch...")
-    batch.commit()
-        
-    print(f"Successfully imported {len(investments)} entities to Datastore.")
+        entity['state'] = 'pending'
+        set_priority(entity)
+        stamp_updated(entity)
+        entities.append(entity)
+    put_with_stats(client, entities)
+    return {'created': len(entities), 'updated': 0, 'unchanged': 0}
+
+def merge_chunk(client, chunk):
+    """
+    Upserts the holdings in the chunk in one transaction. New holdings are added as
+    pending; existing ones only have changed base fields written, keeping their state
+    and reports. Unchanged holdings that already have priority scores are not written
+    at all.
+    """
+    keys = [client.key('Investment', investment['id']) for investment in chunk]
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            counts = {'created': 0, 'updated': 0, 'unchanged': 0}
+            transitions = []
+            now = now_utc()
+            with client.transaction():
+                existing = {entity.key.name: entity for entity in client.get_multi(keys)}
+                written = []
+                for key, investment in zip(keys, chunk):
+                    entity = existing.get(key.name)
+                    if entity is None:
+                        entity = datastore.Entity(key=key)
+                        entity.update(investment)
+                        entity['state'] = 'pending'
+                        before = None
+                        counts['created'] += 1
+                    elif (PRIORITY_PROPERTY in entity
+                          and all(entity.get(field) == investment.get(field) for field in BASE_FIELDS)):
+                        counts['unchanged'] += 1
+                        continue
+                    else:
+                        before = summarize(entity)
+                        entity.update({field: investment.get(field) for field in BASE_FIELDS})
+                        counts['updated'] += 1
+                    set_priority(entity)
+                    stamp_updated(entity, now)
+                    written.append(entity)
+                    transitions.append((before, summarize(entity)))
+                if written:
+                    client.put_multi(written)
+            apply_transitions(client, transitions)
+            return counts
+        except (Aborted, Conflict):
+            # A pipeline wrote one of these rows meanwhile; re-read and try again
+            time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+    raise RuntimeError(f"Chunk starting at '{chunk[0]['id']}' kept conflicting after {TRANSACTION_ATTEMPTS} attempts")
+
+def import_investments_to_datastore(json_file_path=JSON_FILE_PATH, merge=True, workers=WORKERS, resume=True):
+    """
+    Loads the holdings file into Datastore in chunks of CHUNK_SIZE, `workers` chunks
+    at a time. Each committed chunk is checkpointed, so an interrupted import resumes
+    with the chunks it had not committed. With `merge`, existing investments keep
+    their state and reports; otherwise every holding is reset to pending.
+    """
+    client = datastore.Client(database='investment-reports')
+
+    with open(json_file_path, 'rb') as f:
+        data = f.read()
+    investments = json.loads(data)
+    fingerprint = hashlib.sha256(data).hexdigest()
+    mode = 'merge' if merge else 'replace'
+
+    chunks = [investments[start:start + CHUNK_SIZE] for start in range(0, len(investments), CHUNK_SIZE)]
+    state_path = _state_path(json_file_path)
+    done = _load_state(state_path, fingerprint, mode) if resume else set()
+    if done:
+        print(f"Resuming import; {len(done)} of {len(chunks)} chunks were already committed.")
+
+    write_chunk = merge_chunk if merge else replace_chunk
+    totals = {'created': 0, 'updated': 0, 'unchanged': 0}
+    failed = 0
+    start = time.monotonic()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(write_chunk, client, chunk): index
+                   for index, chunk in enumerate(chunks) if index not in done}
+        for future in as_completed(futures):
+            index = futures[future]
+            try:
+                counts = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"Chunk {index + 1}/{len(chunks)} failed: {e}")
+                continue
+            for name, count in counts.items():
+                totals[name] += count
+            done.add(index)
+            _save_state(state_path, fingerprint, mode, done)
+            print(f"Committed chunk {index + 1}/{len(chunks)}: {counts['created']} created, "
+                  f"{counts['updated']} updated, {counts['unchanged']} unchanged.")
+
+    elapsed = time.monotonic() - start
+    if failed:
+        print(f"\n{failed} chunk(s) failed; run the import again to resume with them.")
+        return
+    if os.path.exists(state_path):
+        os.remove(state_path)
+    print(f"\nSuccessfully imported {len(investments)} holdings in {mode} mode in {elapsed:.1f}s: "
+          f"{totals['created']} created, {totals['updated']} updated, {totals['unchanged']} unchanged.")
 
 if __name__ == '__main__':
-    import_investments_to_datastore()
+    parser = argparse.ArgumentParser(description="Import the base investments into Datastore.")
+    parser.add_argument('--input', default=JSON_FILE_PATH, help=f'Holdings JSON file. Defaults to {JSON_FILE_PATH}.')
+    parser.add_argument('--replace', action='store_true',
+                        help='Reset every holding to pending, discarding reports. By default, existing investments '
+                             'keep their state and reports and only changed holding fields are written.')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f'Number of chunks committed at the same time. Defaults to {WORKERS}.')
+    parser.add_argument('--restart', action='store_true',
+                        help='Ignore the checkpoint of an interrupted import and start over.')
+    args = parser.parse_args()
+
+    import_investments_to_datastore(args.input, not args.replace, args.workers, not args.restart)
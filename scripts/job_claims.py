@@ -0,0 +1,190 @@
+import os
+import random
+import socket
+from datetime import datetime, timedelta, timezone
+from google.api_core.exceptions import Aborted, Conflict
+from timestamps import stamp_updated
+from stats_index import apply_transitions, summarize
+from metrics import get_metrics
+from scheduling import priority_order
+
+LEASE_SECONDS = 1800 # How long a claimed investment stays reserved for its worker
+CANDIDATE_FACTOR = 3 # Fetch this many candidate keys per wanted item so workers rarely collide
+SCAN_PAGE_SIZE = 300 # Keys read per page when a key range is checked client-side
+MAX_SCAN_PAGES = 10 # Bounds how far such a scan reads for a shard whose keys are scarce
+LEASE_FIELDS = ('leaseOwner', 'leaseExpiresAt')
+
+def make_worker_id(name=''):
+    """Builds an id that is unique across machines and processes, e.g. 'vm-1/4312/Worker-3'."""
+    worker_id = f"{socket.gethostname()}/{os.getpid()}"
+    return f"{worker_id}/{name}" if name else worker_id
+
+def _is_claimable(entity, now):
+    state = entity.get('state')
+    if state == 'pending':
+        return True
+    if state == 'in_progress_shallow':
+        # Rows claimed by a worker that crashed are picked up once the lease runs out
+        lease_expires_at = entity.get('leaseExpiresAt')
+        return lease_expires_at is not None and lease_expires_at <= now
+    return False
+
+def _in_key_range(key, key_range):
+    start, end = key_range
+    return (start is None or key.name >= start) and (end is None or key.name < end)
+
+def _keys_in_range(query, wanted, key_range):
+    """
+    Reads a keys-only query page by page and keeps the keys in `key_range`, until
+    `wanted` are found or MAX_SCAN_PAGES pages have been read.
+    """
+    keys = []
+    cursor = None
+    for _ in range(MAX_SCAN_PAGES):
+        iterator = query.fetch(limit=SCAN_PAGE_SIZE, start_cursor=cursor)
+        page = list(next(iterator.pages, []))
+        keys += [entity.key for entity in page if _in_key_range(entity.key, key_range)]
+        cursor = iterator.next_page_token
+        if len(keys) >= wanted or len(page) < SCAN_PAGE_SIZE or not cursor:
+            break
+    return keys[:wanted]
+
+def _priority_keys(client, wanted, priority, key_range=None):
+    """Finds keys of the pending investments with the highest `priority` scores."""
+    # Requires the (state, -priority.<mode>) composite indexes in index.yaml
+    query = client.query(kind='Investment')
+    query.add_filter('state', '=', 'pending')
+    query.order = [priority_order(priority)]
+    query.keys_only()
+    if not key_range:
+        return [entity.key for entity in query.fetch(limit=wanted)]
+    # Datastore cannot sort by one property with an inequality filter on another, so
+    # the shard's key range is checked here while reading down the ordered results
+    return _keys_in_range(query, wanted, key_range)
+
+def _candidate_keys(client, limit, now, key_range=None, priority=None):
+    """
+    Finds keys of pending investments, highest `priority` first if one is given, then
+    of investments whose lease has expired.
+    """
+    wanted = limit * CANDIDATE_FACTOR
+    keys = _priority_keys(client, wanted, priority, key_range) if priority else []
+    if len(keys) >= wanted:
+        return keys
+
+    # Pending investments without priority scores are only found without an order
+    query = client.query(kind='Investment')
+    query.add_filter('state', '=', 'pending')
+    if key_range:
+        # Requires the (state, __key__) composite index in index.yaml
+        start, end = key_range
+        if start is not None:
+            query.add_filter('__key__', '>=', client.key('Investment', start))
+        if end is not None:
+            query.add_filter('__key__', '<', client.key('Investment', end))
+    query.keys_only()
+    seen = set(keys)
+    keys += [entity.key for entity in query.fetch(limit=wanted) if entity.key not in seen][:wanted - len(keys)]
+
+    if len(keys) < wanted:
+        # Requires the (state, leaseExpiresAt) composite index in index.yaml
+        query = client.query(kind='Investment')
+        query.add_filter('state', '=', 'in_progress_shallow')
+        query.add_filter('leaseExpiresAt', '<=', now)
+        query.keys_only()
+        if key_range:
+            # Datastore allows one inequality property per query, so the key range is checked here
+            keys += _keys_in_range(query, wanted - len(keys), key_range)
+        else:
+            keys += [entity.key for entity in query.fetch(limit=wanted - len(keys))]
+
+    return keys
+
+def _claim_keys(client, keys, worker_id, now, lease_expires_at):
+    """Claims every still-claimable entity among `keys` in a single transaction."""
+    claimed = []
+    transitions = []
+    with client.transaction():
+        for entity in client.get_multi(keys):
+            if not _is_claimable(entity, now):
+                continue
+            before = summarize(entity)
+            entity['state'] = 'in_progress_shallow'
+            entity['leaseOwner'] = worker_id
+            entity['leaseExpiresAt'] = lease_expires_at
+            stamp_updated(entity, now)
+            claimed.append(entity)
+            transitions.append((before, summarize(entity)))
+        if claimed:
+            client.put_multi(claimed)
+    apply_transitions(client, transitions)
+    return claimed
+
+def claim_pending_investments(client, limit, worker_id, lease_seconds=LEASE_SECONDS, key_range=None, priority=None):
+    """
+    Claims up to `limit` investments for `worker_id` by moving them from 'pending' to
+    'in_progress_shallow' with a lease. Candidates come from keys-only queries and the
+    state change is transactional, so concurrent workers in any process or on any
+    machine never claim the same row twice. With a `key_range` of (start, end) only
+    ids in [start, end) are claimed; either end may be None. With a `priority` mode
+    from scheduling.PRIORITY_MODES, the highest scoring pending investments are
+    claimed first, in order; a conflict with another worker makes this worker move on
+    to the next candidates rather than skip ahead at random.
+    """
+    now = datetime.now(timezone.utc)
+    lease_expires_at = now + timedelta(seconds=lease_seconds)
+
+    keys = _candidate_keys(client, limit, now, key_range, priority)
+    if not keys:
+        return []
+    if not priority:
+        # Workers see the same query results, so spread them over different candidates
+        random.shuffle(keys)
+
+    try:
+        claimed = _claim_keys(client, keys[:limit], worker_id, now, lease_expires_at)
+        remaining = keys[limit:]
+    except (Aborted, Conflict):
+        # Another worker touched one of the rows; fall back to claiming one at a time
+        get_metrics().inc('transaction_conflicts', stage='datastore_claim')
+        claimed = []
+        remaining = keys
+
+    for key in remaining:
+        if len(claimed) >= limit:
+            break
+        try:
+            claimed += _claim_keys(client, [key], worker_id, now, lease_expires_at)
+        except (Aborted, Conflict):
+            get_metrics().inc('transaction_conflicts', stage='datastore_claim')
+            continue
+    return claimed
+
+def release_claims(client, ids, worker_id):
+    """
+    Puts investments that `worker_id` claimed but could not finish back to 'pending'
+    in one transaction, so other workers can pick them up without waiting for the
+    lease to run out. Rows that have since been saved or claimed by someone else are
+    left alone. Returns how many were released.
+    """
+    released = []
+    transitions = []
+    with client.transaction():
+        for entity in client.get_multi([client.key('Investment', investment_id) for investment_id in ids]):
+            if entity.get('state') != 'in_progress_shallow' or entity.get('leaseOwner') != worker_id:
+                continue
+            before = summarize(entity)
+            entity['state'] = 'pending'
+            release_lease(entity)
+            stamp_updated(entity)
+            released.append(entity)
+            transitions.append((before, summarize(entity)))
+        if released:
+            client.put_multi(released)
+    apply_transitions(client, transitions)
+    return len(released)
+
+def release_lease(investment):
+    """Removes the lease fields from an investment that is about to be saved."""
+    for field in LEASE_FIELDS:
+        investment.pop(field, None)
@@ -0,0 +1,396 @@
+import asyncio
+import base64
+import collections
+import contextlib
+import copy
+import hashlib
+import json
+import operator
+import random
+import re
+import threading
+import time
+import google_crc32c
+from google.api_core.exceptions import Aborted
+from google.cloud import datastore
+from google.genai import errors, types
+
+# Rough token estimates for the local model's usage metadata
+CHARS_PER_TOKEN = 4
+PDF_BYTES_PER_TOKEN = 40
+DEEP_STREAM_CHUNKS = 20 # Chunks a deep report is streamed in
+# Company lines in a shallow prompt, as written by build_prompt: "id: NAME from COUNTRY"
+COMPANY_LINE = re.compile(r'^([^\s:]+): (.*) from (.*)$', re.MULTILINE)
+
+OPERATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'IN': lambda value, values: value in values,
+    'NOT_IN': lambda value, values: value not in values,
+}
+
+def _property(properties, name):
+    """Reads a property by name, following dots into embedded entities like Datastore does."""
+    value = properties
+    for part in name.split('.'):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+class LocalQuery:
+    """The part of datastore.Query the pipelines use: filters, order, keys-only and fetch."""
+
+    def __init__(self, store, kind):
+        self.store = store
+        self.kind = kind
+        self.filters = []
+        self.order = []
+        self._keys_only = False
+
+    def add_filter(self, property_name, operator_name, value):
+        self.filters.append((property_name, operator_name, value))
+        return self
+
+    def keys_only(self):
+        self._keys_only = True
+
+    def _matches(self, key, properties):
+        for name, operator_name, value in self.filters:
+            if name == '__key__':
+                actual, value = key.name, value.name
+            else:
+                actual = _property(properties, name)
+            if actual is None and operator_name not in ('=', '!=', 'IN', 'NOT_IN'):
+                return False
+            try:
+                if not OPERATORS[operator_name](actual, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def fetch(self, limit=None, start_cursor=None):
+        offset = int(start_cursor or 0)
+        found = self.store._run_query(self, None if limit is None else offset + limit)[offset:]
+        return LocalIterator(found, str(offset + len(found)) if limit is not None and len(found) == limit else None)
+
+class LocalIterator:
+    """Query results, iterable directly or as one page followed by the cursor of the next."""
+
+    def __init__(self, results, next_page_token):
+        self.results = results
+        self.next_page_token = next_page_token
+        self.pages = iter([iter(results)])
+
+    def __iter__(self):
+        return iter(self.results)
+
+class LocalBatch:
+    def __init__(self, store):
+        self.store = store
+        self.writes = {}
+
+    def begin(self):
+        pass
+
+    def put(self, entity):
+        self.writes[entity.key] = copy.deepcopy(dict(entity))
+
+    def commit(self):
+        self.store._round_trip()
+        self.store._commit(self.writes, {})
+
+class LocalDatastore:
+    """
+    An in-process stand-in for datastore.Client with the calls the pipelines make.
+    Every call sleeps `latency` seconds for the round trip. Transactions are
+    optimistic like Datastore's: the commit raises Aborted if an entity read in
+    the transaction was written by someone else meanwhile. `stats` counts reads,
+    writes, commits and such conflicts, and the time spent waiting for the store lock.
+    """
+
+    def __init__(self, latency=0.0, project='local'):
+        self.project = project
+        self.latency = latency
+        self.stats = {'reads': 0, 'writes': 0, 'queries': 0, 'commits': 0, 'conflicts': 0, 'lockWaitSeconds': 0.0}
+        self._entities = {} # key -> (version, properties)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        start = time.perf_counter()
+        with self._lock:
+            self.stats['lockWaitSeconds'] += time.perf_counter() - start
+            yield
+
+    def _round_trip(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project=self.project)
+
+    def query(self, kind):
+        return LocalQuery(self, kind)
+
+    def batch(self):
+        return LocalBatch(self)
+
+    def _run_query(self, query, limit):
+        self._round_trip()
+        with self._locked():
+            self.stats['queries'] += 1
+            found = [(key, properties) for key, (_, properties) in self._entities.items()
+                     if key.kind == query.kind and query._matches(key, properties)]
+        found.sort(key=lambda item: item[0].name)
+        for name in reversed(query.order):
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            found.sort(key=lambda item: (_property(item[1], name) is None, _property(item[1], name)), reverse=descending)
+        if limit is not None:
+            found = found[:limit]
+        if query._keys_only:
+            return [datastore.Entity(key=key) for key, _ in found]
+        return [self._entity(key, properties) for key, properties in found]
+
+    def _entity(self, key, properties):
+        entity = datastore.Entity(key=key)
+        entity.update(copy.deepcopy(properties))
+        return entity
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        self._round_trip()
+        transaction = self._transaction()
+        found = []
+        with self._locked():
+            self.stats['reads'] += len(keys)
+            for key in keys:
+                version, properties = self._entities.get(key, (0, None))
+                if transaction is not None:
+                    transaction['read'].setdefault(key, version)
+                if properties is not None:
+                    found.append(self._entity(key, properties))
+        return found
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        writes = {entity.key: copy.deepcopy(dict(entity)) for entity in entities}
+        transaction = self._transaction()
+        if transaction is not None:
+            transaction['writes'].update(writes)
+            return
+        self._round_trip()
+        self._commit(writes, {})
+
+    def _commit(self, writes, read):
+        with self._locked():
+            if any(self._entities.get(key, (0, None))[0] != version for key, version in read.items()):
+                self.stats['conflicts'] += 1
+                raise Aborted('Local datastore: an entity read in this transaction was written by another one.')
+            for key, properties in writes.items():
+                self._entities[key] = (self._entities.get(key, (0, None))[0] + 1, properties)
+            self.stats['writes'] += len(writes)
+            self.stats['commits'] += 1
+
+    @contextlib.contextmanager
+    def transaction(self, **kwargs):
+        transaction = {'read': {}, 'writes': {}}
+        self._local.transaction = transaction
+        try:
+            yield transaction
+        finally:
+            self._local.transaction = None
+        self._round_trip()
+        self._commit(transaction['writes'], transaction['read'])
+
+class LocalBlob:
+    def __init__(self, bucket, name, size=None, md5_hash=None, crc32c=None):
+        self.bucket = bucket
+        self.name = name
+        self.size = size
+        self.md5_hash = md5_hash
+        self.crc32c = crc32c
+
+    def upload_from_filename(self, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        storage = self.bucket.storage
+        time.sleep(storage.latency + len(data) / storage.bandwidth)
+        self.size = len(data)
+        self.md5_hash = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+        self.crc32c = base64.b64encode(google_crc32c.Checksum(data).digest()).decode('ascii')
+        with self.bucket.lock:
+            self.bucket.objects[self.name] = self
+
+class LocalBucket:
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def list_blobs(self, fields=None):
+        time.sleep(self.storage.latency)
+        with self.lock:
+            return list(self.objects.values())
+
+class LocalStorage:
+    """
+    An in-process stand-in for storage.Client. An upload takes `latency` seconds plus
+    its size over `bandwidth` bytes per second.
+    """
+
+    def __init__(self, latency=0.0, bandwidth=50 * 1024 * 1024):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.buckets = {}
+
+    def bucket(self, name):
+        return self.buckets.setdefault(name, LocalBucket(self, name))
+
+def sample_from_schema(schema, rng):
+    """Builds an instance that satisfies a JSON schema of objects, arrays, enums and scalars."""
+    if 'enum' in schema:
+        return rng.choice(schema['enum'])
+    # The SDK's Schema type spells types in upper case
+    schema_type = str(schema.get('type', '')).lower()
+    if schema_type == 'object':
+        return {name: sample_from_schema(prop, rng) for name, prop in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        return [sample_from_schema(schema.get('items', {}), rng) for _ in range(rng.randint(1, 3))]
+    if schema_type == 'integer':
+        return rng.randint(1900, 2020)
+    if schema_type == 'number':
+        return round(rng.random() * 100, 2)
+    if schema_type == 'boolean':
+        return rng.random() < 0.5
+    if schema.get('format') == 'date':
+        return '2025-06-30'
+    return 'Lorem ipsum dolor sit amet.'
+
+def _json_schema(response_schema):
+    if isinstance(response_schema, types.Schema):
+        return response_schema.model_dump(mode='json', exclude_none=True)
+    return response_schema
+
+def _response(text, prompt_tokens):
+    return types.GenerateContentResponse(
+        candidates=[types.Candidate(content=types.Content(role='model', parts=[types.Part(text=text)]))],
+        usage_metadata=types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=prompt_tokens,
+            candidates_token_count=len(text) // CHARS_PER_TOKEN,
+            total_token_count=prompt_tokens + len(text) // CHARS_PER_TOKEN,
+        ),
+    )
+
+def _prompt_tokens(contents):
+    tokens = 0
+    for content in contents:
+        for part in content.parts:
+            if part.text:
+                tokens += len(part.text) // CHARS_PER_TOKEN
+            elif part.inline_data:
+                tokens += len(part.inline_data.data) // PDF_BYTES_PER_TOKEN
+    return tokens
+
+class LocalModel:
+    """
+    A stand-in for the GenAI client's async models API. Shallow prompts get one report
+    per company line in the prompt and deep requests a streamed report, both built from
+    the response schema. A call takes `latency` seconds plus `per_item_latency` per
+    company, scaled by a random factor within +/- `jitter`. A `failure_rate` share of
+    calls fail with a 503, and a `mismatch_rate` share of shallow responses leave out
+    one company's report, as do deep reports one section's content. With a `quota_rpm`, calls beyond that many in the last
+    minute fail with a 429 like Vertex AI's quota errors.
+    """
+
+    def __init__(self, latency=1.0, per_item_latency=0.1, jitter=0.3, failure_rate=0.0, mismatch_rate=0.0,
+                 deep_latency=5.0, seed=None, quota_rpm=None):
+        self.latency = latency
+        self.per_item_latency = per_item_latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.mismatch_rate = mismatch_rate
+        self.deep_latency = deep_latency
+        self.quota_rpm = quota_rpm
+        self.rng = random.Random(seed)
+        self.calls = 0
+        self.failures = 0
+        self.quota_errors = 0
+        self._recent_calls = collections.deque()
+        # Mirrors client.aio.models
+        self.aio = self
+        self.models = self
+
+    def _delay(self, base):
+        return max(0.0, base * (1 + self.rng.uniform(-self.jitter, self.jitter)))
+
+    def _check_quota(self):
+        now = time.monotonic()
+        while self._recent_calls and self._recent_calls[0] <= now - 60:
+            self._recent_calls.popleft()
+        if len(self._recent_calls) >= self.quota_rpm:
+            self.quota_errors += 1
+            raise errors.ClientError(429, {'error': {'code': 429, 'message': 'Simulated quota exceeded',
+                                                     'status': 'RESOURCE_EXHAUSTED'}})
+        self._recent_calls.append(now)
+
+    def _maybe_fail(self):
+        self.calls += 1
+        if self.quota_rpm:
+            self._check_quota()
+        if self.rng.random() < self.failure_rate:
+            self.failures += 1
+            raise errors.ServerError(503, {'error': {'code': 503, 'message': 'Simulated failure', 'status': 'UNAVAILABLE'}})
+
+    async def generate_content(self, model, contents, config):
+        prompt = contents[0].parts[-1].text
+        companies = COMPANY_LINE.findall(prompt)
+        await asyncio.sleep(self._delay(self.latency + self.per_item_latency * len(companies)))
+        self._maybe_fail()
+
+        item_schema = _json_schema(config.response_schema)['items']
+        reports = []
+        for company_id, _, _ in companies:
+            report = sample_from_schema(item_schema, self.rng)
+            report['id'] = company_id
+            reports.append(report)
+        if len(reports) > 1 and self.rng.random() < self.mismatch_rate:
+            reports.pop(self.rng.randrange(len(reports)))
+        return _response(json.dumps(reports), _prompt_tokens(contents))
+
+    async def generate_content_stream(self, model, contents, config):
+        delay = self._delay(self.deep_latency)
+        self._maybe_fail()
+        report = sample_from_schema(_json_schema(config.response_schema), self.rng)
+        if report and self.rng.random() < self.mismatch_rate:
+            report[self.rng.choice(list(report))] = None
+        text = json.dumps(report)
+        size = -(-len(text) // DEEP_STREAM_CHUNKS)
+        prompt_tokens = _prompt_tokens(contents)
+
+        async def stream():
+            for start in range(0, len(text), size):
+                await asyncio.sleep(delay / DEEP_STREAM_CHUNKS)
+                chunk = _response(text[start:start + size], prompt_tokens)
+                if start + size < len(text):
+                    # Only the last chunk carries the usage totals
+                    chunk.usage_metadata = None
+                yield chunk
+        return stream()
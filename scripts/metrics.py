@@ -0,0 +1,271 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+NAMESPACE = 'oljevakt'
+# Upper bounds in seconds; Datastore and GCS calls land in the low buckets, model calls in the high ones
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+# Token counts reported in a response's usage metadata
+USAGE_FIELDS = {
+    'prompt': 'prompt_token_count',
+    'cached': 'cached_content_token_count',
+    'response': 'candidates_token_count',
+    'thoughts': 'thoughts_token_count',
+}
+FAMILIES = {
+    'stage_duration_seconds': ('histogram', 'Duration of pipeline stage calls.'),
+    'stage_in_flight': ('gauge', 'Pipeline stage calls currently running.'),
+    'stage_calls': ('counter', 'Finished pipeline stage calls by outcome.'),
+    'retries': ('counter', 'Companies sent to the model again after a failure, by reason.'),
+    'transaction_conflicts': ('counter', 'Datastore transactions aborted by a concurrent write.'),
+    'validation_failures': ('counter', 'Model responses or items rejected by schema validation.'),
+    'quota_errors': ('counter', 'Model calls rejected with 429 / RESOURCE_EXHAUSTED, by model.'),
+    'rate_limit_wait_seconds': ('counter', 'Seconds model calls waited for the rate limiter, by model.'),
+    'tokens': ('counter', 'Model tokens from response usage metadata.'),
+    'investments': ('counter', 'Investments saved, by resulting state.'),
+}
+
+_metrics = None
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+def _stage_label(labels):
+    """Names a stage in the summary by its stage label followed by its other labels, e.g. 'shallow_generate/gemini-2.5-flash'."""
+    labels = dict(labels)
+    return '/'.join([str(labels.pop('stage'))] + [str(value) for _, value in sorted(labels.items())])
+
+def _outcome(error):
+    if isinstance(error, TimeoutError) or 'Timeout' in type(error).__name__:
+        return 'timeout'
+    if not isinstance(error, Exception):
+        return 'cancelled'
+    return 'error'
+
+class Metrics:
+    """
+    Collects counters, gauges and latency histograms in memory. Every metric is keyed
+    by name and labels. render() returns the OpenMetrics text exposition, summary()
+    a JSON-friendly run summary.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def add(self, name, amount, **labels):
+        """Moves a gauge up or down."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram['buckets'][index] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+            histogram['max'] = max(histogram['max'], value)
+
+    @contextmanager
+    def track(self, stage, **labels):
+        """
+        Times a block as one call of `stage`, counting it as in flight while it runs and
+        by outcome (ok, error, timeout or cancelled) once it ends. Works in both
+        threads and coroutines.
+        """
+        labels['stage'] = stage
+        self.add('stage_in_flight', 1, **labels)
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            yield
+        except BaseException as e:
+            outcome = _outcome(e)
+            raise
+        finally:
+            self.add('stage_in_flight', -1, **labels)
+            self.observe('stage_duration_seconds', time.monotonic() - start, **labels)
+            self.inc('stage_calls', outcome=outcome, **labels)
+
+    def record_usage(self, stage, model, usage):
+        """Counts the tokens in a response's usage metadata; responses served from a cache have none."""
+        if usage is None:
+            return
+        for token_type, field in USAGE_FIELDS.items():
+            count = getattr(usage, field, None)
+            if count:
+                self.inc('tokens', count, stage=stage, model=model, type=token_type)
+
+    def _quantile(self, histogram, q):
+        """Estimates a quantile by interpolating within the bucket it falls in, like Prometheus' histogram_quantile."""
+        rank = q * histogram['count']
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, histogram['buckets']):
+            if count and seen + count >= rank:
+                estimate = lower + (bound - lower) * (rank - seen) / count
+                return round(min(estimate, histogram['max']), 3)
+            seen += count
+            lower = bound
+        return round(histogram['max'], 3)
+
+    def render(self):
+        """Returns every metric in the OpenMetrics text format."""
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: dict(value, buckets=list(value['buckets'])) for key, value in self.histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text) in FAMILIES.items():
+            family = f"{NAMESPACE}_{name}"
+            lines.append(f"# TYPE {family} {metric_type}")
+            lines.append(f"# HELP {family} {help_text}")
+            if metric_type == 'counter':
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{family}_total{_format_labels(labels)} {value}")
+            elif metric_type == 'gauge':
+                for (key_name, labels), value in sorted(gauges.items()):
+                    if key_name == name:
+                        lines.append(f"{family}{_format_labels(labels)} {value}")
+            else:
+                for (key_name, labels), histogram in sorted(histograms.items()):
+                    if key_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(self.buckets, histogram['buckets']):
+                        cumulative += count
+                        lines.append(f"{family}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                    lines.append(f"{family}_bucket{_format_labels(labels + (('le', '+Inf'),))} {histogram['count']}")
+                    lines.append(f"{family}_count{_format_labels(labels)} {histogram['count']}")
+                    lines.append(f"{family}_sum{_format_labels(labels)} {histogram['sum']:.6f}")
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        """Summarizes the run: time and outcomes per stage, tokens per model and every other counter."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {key: dict(value) for key, value in self.histograms.items()}
+
+        stages = {}
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name != 'stage_duration_seconds':
+                continue
+            stages[_stage_label(labels)] = {
+                'calls': histogram['count'],
+                'totalSeconds': round(histogram['sum'], 3),
+                'meanSeconds': round(histogram['sum'] / histogram['count'], 3),
+                'p50Seconds': self._quantile(histogram, 0.5),
+                'p95Seconds': self._quantile(histogram, 0.95),
+                'p99Seconds': self._quantile(histogram, 0.99),
+                'maxSeconds': round(histogram['max'], 3),
+                'outcomes': {},
+            }
+        tokens = {}
+        other = {}
+        for (name, labels), value in sorted(counters.items()):
+            labels = dict(labels)
+            if name == 'stage_calls':
+                outcome = labels.pop('outcome')
+                stages.setdefault(_stage_label(labels.items()), {'outcomes': {}})['outcomes'][outcome] = value
+            elif name == 'tokens':
+                tokens.setdefault(labels['model'], {}).setdefault(labels['type'], 0)
+                tokens[labels['model']][labels['type']] += value
+            else:
+                label = ','.join(f"{key}={value}" for key, value in sorted(labels.items()))
+                other[f"{name}{{{label}}}" if label else name] = value
+
+        return {
+            'startedAt': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(self.started)),
+            'wallSeconds': round(time.time() - self.started, 3),
+            'stages': stages,
+            'tokens': tokens,
+            'counters': other,
+        }
+
+    def print_summary(self):
+        summary = self.summary()
+        print(f"\nMetrics for a {summary['wallSeconds']:.0f}s run:")
+        for label, stage in summary['stages'].items():
+            outcomes = ', '.join(f"{count} {outcome}" for outcome, count in sorted(stage['outcomes'].items()))
+            print(f"  {label}: {stage.get('calls', 0)} calls ({outcomes}), {stage.get('totalSeconds', 0):.1f}s total, "
+                  f"p50 {stage.get('p50Seconds', 0)}s, p95 {stage.get('p95Seconds', 0)}s, max {stage.get('maxSeconds', 0)}s")
+        for model, counts in summary['tokens'].items():
+            print(f"  {model} tokens: " + ', '.join(f"{count:,} {token_type}" for token_type, count in sorted(counts.items())))
+        for name, value in summary['counters'].items():
+            print(f"  {name}: {value}")
+
+    def write_summary(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, indent=2)
+        print(f"Wrote the run summary to {path}")
+
+    def serve(self, port, host='0.0.0.0'):
+        """
+        Serves /metrics in the OpenMetrics format and /summary as JSON from a daemon
+        thread, so Prometheus can scrape a run while it is going.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = metrics.render().encode('utf-8')
+                    content_type = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+                elif path == '/summary':
+                    body = json.dumps(metrics.summary()).encode('utf-8')
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+def set_metrics(metrics):
+    """Replaces the process-wide metrics registry, e.g. with a fresh one per benchmark run."""
+    global _metrics
+    _metrics = metrics
+
+def get_metrics():
+    """Returns the process-wide metrics registry, creating it on first use."""
+    global _metrics
+    if _metrics is None:
+        _metrics = Metrics()
+    return _metrics
@@ -1,108 +1,161 @@
 from google.cloud import datastore
+from stats_index import load_stats, market_value, rebuild_stats
+from search_index import SearchIndex, print_results
+from scheduling import PRIORITY_MODES, PRIORITY_PROPERTY, priority_order
+from create_base_investments import COLUMNAR_FILE_PATH, load_columnar, top_by_market_value
+import numpy as np
+import os
 import json
 import random
 import argparse
 
-def get_category_from_entity(entity):
-    """Safely extracts the category from a Datastore entity."""
-    if 'shallowReport' in entity and isinstance(entity['shallowReport'], dict):
-        risk_assessment = entity['shallowReport'].get('riskAssessment', {})
-        if isinstance(risk_assessment, dict):
-            return risk_assessment.get('category')
-    return None
-
 def query_random(client, category, num):
     """Fetches random investments based on category."""
     query = client.query(kind='Investment')
-    investments = list(query.fetch())
-    
     if category is not None:
-        candidates = [
-            entity for entity in investments 
-            if get_category_from_entity(entity) == str(category)
-        ]
-    else:
-        candidates = investments
+        query.add_filter('shallowReport.riskAssessment.category', '=', str(category))
+    # Sample from keys only and fetch just the selected entities
+    query.keys_only()
+    keys = [entity.key for entity in query.fetch()]
         
-    if not candidates:
+    if not keys:
         print(f"No investments found with category {category}.")
         return
 
-    num_to_select = min(num, len(candidates))
-    selected_candidates = random.sample(candidates, num_to_select)
+    num_to_select = min(num, len(keys))
+    selected_candidates = client.get_multi(random.sample(keys, num_to_select))
     
     print(f"Found {len(selected_candidates)} random investment(s):")
-    print(json.dumps(selected_candidates, indent=2, ensure_ascii=False))
+    print(json.dumps(selected_candidates, indent=2, ensure_ascii=False, default=str))
+
+def load_or_build_stats(client):
+    """Loads the stats index, building it from a full scan the first time."""
+    stats = load_stats(client)
+    if stats is None:
+        print("No stats index found.")
+        rebuild_stats(client)
+        stats = load_stats(client)
+    return stats
+
+def fetch_highest_no_deep(client, num, exclude=()):
+    """Reads Category 1 investments down by market value until `num` without a deep report are found."""
+    # Requires the (category, -priority.value) composite index in index.yaml
+    query = client.query(kind='Investment')
+    query.add_filter('shallowReport.riskAssessment.category', '=', '1')
+    query.order = [priority_order('value')]
+    found = []
+    for entity in query.fetch():
+        if entity.get('state') != 'done_deep' and entity.key.name not in exclude:
+            found.append(entity)
+            if len(found) >= num:
+                break
+    return found
 
 def query_highest_no_deep(client, num):
     """Fetches top market value investments in Category 1 without a deep report."""
-    query = client.query(kind='Investment')
-    query.add_filter('state', '!=', 'done_deep')
-    investments = list(query.fetch())
+    stats = load_or_build_stats(client)
+    if '1' in stats['shortTop']:
+        # Investments that left the list were not replaced, so it may miss some that now rank in it
+        print("Note: the stats index's Category 1 top list has lost entries since it was built, so Datastore is "
+              "searched instead. Run 'python scripts/query_investments.py stats --rebuild' to refill it.")
+        candidates = []
+    else:
+        candidates = [item['id'] for item in stats['top'].get('1', []) if item['state'] != 'done_deep'][:num]
+    selected_candidates = client.get_multi([client.key('Investment', item_id) for item_id in candidates]) if candidates else []
 
-    candidates = [
-        entity for entity in investments
-        if get_category_from_entity(entity) == '1'
-    ]
-    
-    if not candidates:
+    if len(selected_candidates) < num:
+        # The stats index only tracks the top TOP_N per category, and some of those may be done
+        selected_candidates += fetch_highest_no_deep(client, num - len(selected_candidates), set(candidates))
+
+    if not selected_candidates:
         print("No Category 1 investments found that are awaiting a deep report.")
         return
 
-    # Sort by marketValueNok descending
-    candidates.sort(key=lambda x: x.get('marketValueNok', 0), reverse=True)
-    
-    num_to_select = min(num, len(candidates))
-    selected_candidates = candidates[:num_to_select]
+    if len(selected_candidates) < num:
+        print(f"Note: only {len(selected_candidates)} Category 1 investments are awaiting a deep report. Investments "
+              "without priority scores are not searched past the stats index; run 'python scripts/scheduling.py'.")
+
+    selected_candidates = sorted(selected_candidates, key=market_value, reverse=True)
     
     print(f"Found {len(selected_candidates)} highest value investment(s) in Category 1 without a deep report:")
-    print(json.dumps(selected_candidates, indent=2, ensure_ascii=False))
+    print(json.dumps(selected_candidates, indent=2, ensure_ascii=False, default=str))
 
-def show_stats(client):
-    """Fetches and displays statistics about the 'state' field."""
-    print("Fetching investment stats...")
+def query_highest_pending(client, num, priority):
+    """Lists the pending investments a shallow run with '--priority' would claim first."""
     query = client.query(kind='Investment')
-    query.projection = ['state']
-    all_investments = list(query.fetch())
-
-    stats = {
-        'pending': 0,
-        'in_progress_shallow': 0,
-        'done_shallow': 0,
-        'error_shallow': 0,
-        'done_deep': 0,
-        'other': 0
-    }
-
-    for entity in all_investments:
-        state = entity.get('state', 'other')
-        if state in stats:
-            stats[state] += 1
-        else:
-            stats['other'] += 1
-    
-    total = len(all_investments)
+    query.add_filter('state', '=', 'pending')
+    query.order = [priority_order(priority)]
+    candidates = list(query.fetch(limit=num))
+
+    if not candidates:
+        print("No pending investments with priority scores found. Run 'python scripts/scheduling.py' to store them.")
+        return
+
+    print(f"Next {len(candidates)} pending investment(s) by {priority} priority:")
+    for entity in candidates:
+        print(f"  - {entity.key.name}: {entity.get('name')} ({entity.get('industry')}), "
+              f"{market_value(entity) / 1e6:,.0f} M NOK, {entity.get('ownership')}% owned, "
+              f"score {entity[PRIORITY_PROPERTY][priority]:,.2f}")
+
+def query_top_holdings(num, region=None, industry=None, columnar_file_path=COLUMNAR_FILE_PATH):
+    """Ranks the fund's holdings by market value from the columnar file written by create_base_investments.py."""
+    if not os.path.exists(columnar_file_path):
+        print(f"No columnar holdings at {columnar_file_path}. Run 'python scripts/create_base_investments.py' to write them.")
+        return
+
+    columns, id_index = load_columnar(columnar_file_path)
+    mask = np.ones(len(columns['id']), dtype=bool)
+    if region:
+        mask &= columns['region'] == region
+    if industry:
+        mask &= columns['industry'] == industry
+    top_ids = top_by_market_value(columns, num, mask)
+
+    if not top_ids:
+        print("No holdings match the given region and industry.")
+        return
+
+    total = columns['marketValueNok'][mask].sum()
+    print(f"Top {len(top_ids)} of {mask.sum()} holdings by market value ({total / 1e9:,.1f} bn NOK in total):")
+    for company_id in top_ids:
+        row = id_index[company_id]
+        print(f"  - {company_id}: {columns['name'][row]} ({columns['country'][row]}, {columns['industry'][row]}), "
+              f"{columns['marketValueNok'][row] / 1e6:,.0f} M NOK, {columns['ownership'][row]:.2f}% owned")
+
+def show_stats(client, rebuild=False):
+    """Displays statistics about the 'state' field and the category, region and industry breakdowns."""
+    if rebuild:
+        rebuild_stats(client)
+    print("Fetching investment stats...")
+    stats = load_or_build_stats(client)
+    states = stats['state']
+    known_states = ['pending', 'in_progress_shallow', 'done_shallow', 'error_shallow', 'done_deep']
+    other = sum(count for state, count in states.items() if state not in known_states)
+
     print("\nInvestment State Statistics:")
-    print(f"  - Total Investments: {total}")
-    print(f"  - Pending: {stats['pending']}")
-    print(f"  - In Progress (Shallow): {stats['in_progress_shallow']}")
-    print(f"  - Shallow Report Done: {stats['done_shallow']}")
-    print(f"  - Deep Report Done: {stats['done_deep']}")
-    print(f"  - Error (Shallow): {stats['error_shallow']}")
-    if stats['other'] > 0:
-        print(f"  - Other/Unknown: {stats['other']}")
+    print(f"  - Total Investments: {stats['total']}")
+    print(f"  - Pending: {states.get('pending', 0)}")
+    print(f"  - In Progress (Shallow): {states.get('in_progress_shallow', 0)}")
+    print(f"  - Shallow Report Done: {states.get('done_shallow', 0)}")
+    print(f"  - Deep Report Done: {states.get('done_deep', 0)}")
+    print(f"  - Error (Shallow): {states.get('error_shallow', 0)}")
+    if other > 0:
+        print(f"  - Other/Unknown: {other}")
 
-def query_no_reports(client):
-    """Finds investments missing both a shallow and a deep report field."""
-    print("Fetching all investments to check for missing reports...")
-    query = client.query(kind='Investment')
-    all_investments = list(query.fetch())
-    
-    missing_both_reports_count = 0
+    for dimension, title in [('category', 'Category'), ('region', 'Region'), ('industry', 'Industry')]:
+        print(f"\nBy {title}:")
+        for value, count in sorted(stats[dimension].items(), key=lambda item: -item[1]):
+            if count:
+                print(f"  - {value}: {count}")
+
+    if stats['shortTop']:
+        print(f"\nThe top lists of categories {', '.join(sorted(stats['shortTop']))} have lost entries since the "
+              "index was built. Run with --rebuild to refill them.")
 
-    for entity in all_investments:
-        if 'shallowReport' not in entity and 'deepReport' not in entity:
-            missing_both_reports_count += 1
+def query_no_reports(client):
+    """Counts investments missing both a shallow and a deep report field."""
+    stats = load_or_build_stats(client)
+    missing_both_reports_count = stats['reports'].get('none', 0)
             
     print(f"\nFound {missing_both_reports_count} investments missing both a shallowReport and deepReport.")
 
@@ -114,27 +167,56 @@ if __name__ == '__main__':
                     '  stats (default):  Show statistics about the processing state of investments.\n'
                     '  random:           Fetch one or more random investments, optionally filtering by category.\n'
                     '  highest-no-deep:  Find the highest market value investments in Category 1 that are missing a deep report.\n'
-                    '  no-reports:       List investments that are missing a shallow or deep report field.',
+                    '  highest-pending:  List the pending investments a shallow run with --priority would claim first.\n'
+                    '  no-reports:       List investments that are missing a shallow or deep report field.\n'
+                    '  search:           Full-text search of the report text using the exported search index.\n'
+                    '  top-holdings:     Rank the fund\'s holdings by market value from the columnar holdings file.',
         formatter_class=argparse.RawTextHelpFormatter
     )
-    parser.add_argument('mode', nargs='?', default='stats', choices=['stats', 'random', 'highest-no-deep', 'no-reports'], 
+    parser.add_argument('mode', nargs='?', default='stats', choices=['stats', 'random', 'highest-no-deep', 'highest-pending', 'no-reports', 'search', 'top-holdings'],
                         help='The query mode to execute. Defaults to "stats".')
     parser.add_argument('--cat', type=int, choices=[1, 2, 3, 4], 
                         help='Category to filter by for "random" mode.')
     parser.add_argument('--num', type=int, default=None, 
-                        help='Number of investments to return. Defaults to 1 for "random" and 5 for "highest-no-deep".')
+                        help='Number of investments to return. Defaults to 1 for "random", 5 for "highest-no-deep", '
+                             '10 for "highest-pending", 10 for "search" and 10 for "top-holdings".')
+    parser.add_argument('--priority', choices=PRIORITY_MODES, default='value',
+                        help='Priority to order by in "highest-pending" mode. Defaults to value.')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Rebuild the stats index from a full scan before showing "stats".')
+    parser.add_argument('--query', '-q', default=None,
+                        help='Words to search for in "search" mode. The last word also matches as a prefix.')
+    parser.add_argument('--index', default=None,
+                        help='Search index file built by search_index.py. Defaults to frontend/public/data/search_index.json.')
+    parser.add_argument('--region', default=None, help='Region to rank within in "top-holdings" mode, e.g. Europe.')
+    parser.add_argument('--industry', default=None, help='Industry to rank within in "top-holdings" mode, e.g. Energy.')
+    parser.add_argument('--columnar', default=COLUMNAR_FILE_PATH,
+                        help=f'Columnar holdings file for "top-holdings" mode. Defaults to {COLUMNAR_FILE_PATH}.')
 
     args = parser.parse_args()
-    
-    client = datastore.Client(database='investment-reports')
+
+    if args.mode == 'search' and not args.query:
+        parser.error('"search" mode requires --query.')
+
+    # "search" and "top-holdings" read static files, so they need no Datastore access
+    client = None if args.mode in ('search', 'top-holdings') else datastore.Client(database='investment-reports')
 
     if args.mode == 'stats':
-        show_stats(client)
+        show_stats(client, args.rebuild)
     elif args.mode == 'random':
         num = args.num if args.num is not None else 1
         query_random(client, args.cat, num)
     elif args.mode == 'highest-no-deep':
         num = args.num if args.num is not None else 5
         query_highest_no_deep(client, num)
+    elif args.mode == 'highest-pending':
+        num = args.num if args.num is not None else 10
+        query_highest_pending(client, num, args.priority)
     elif args.mode == 'no-reports':
         query_no_reports(client)
+    elif args.mode == 'search':
+        num = args.num if args.num is not None else 10
+        print_results(SearchIndex.load(args.index), args.query, num)
+    elif args.mode == 'top-holdings':
+        num = args.num if args.num is not None else 10
+        query_top_holdings(num, args.region, args.industry, args.columnar)
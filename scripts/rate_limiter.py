@@ -0,0 +1,211 @@
+import asyncio
+import random
+import threading
+import time
+from google.api_core.exceptions import ResourceExhausted, TooManyRequests
+from google.genai.errors import APIError
+from metrics import get_metrics
+
+# Requests and tokens per minute for each model. Vertex AI's shared quota differs per
+# project and region, so these are starting points to set to the project's own quota.
+MODEL_LIMITS = {
+    'gemini-2.5-flash': {'rpm': 500, 'tpm': 2_000_000},
+    'gemini-2.5-pro': {'rpm': 60, 'tpm': 1_000_000},
+}
+DEFAULT_LIMITS = {'rpm': 60, 'tpm': 1_000_000}
+QUOTA_ATTEMPTS = 8 # Calls made per request before a quota error is raised to the caller
+BACKOFF_BASE = 2.0 # Seconds; the backoff ceiling doubles with each quota error in a row
+BACKOFF_MAX = 60.0
+BURST_SECONDS = 10 # A bucket holds this many seconds' worth of its rate, which bounds bursts
+DECREASE_FACTOR = 0.7 # Share of the current rate kept after a quota error
+RECOVERY_PER_MINUTE = 0.1 # Share of the configured limit regained per minute without quota errors
+MIN_RATE_SHARE = 0.05 # The rate never drops below this share of the configured limit
+# Rough token estimates for a call's first reservation; later calls use the learned average
+CHARS_PER_TOKEN = 4
+INLINE_BYTES_PER_TOKEN = 40
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def is_quota_error(error):
+    """Checks whether a call was rejected for exceeding a quota (HTTP 429 / RESOURCE_EXHAUSTED)."""
+    if isinstance(error, (ResourceExhausted, TooManyRequests)):
+        return True
+    if isinstance(error, APIError):
+        return error.code == 429 or error.status == 'RESOURCE_EXHAUSTED'
+    return False
+
+def estimate_tokens(contents):
+    """Roughly estimates the prompt tokens of a request's contents."""
+    tokens = 0
+    for content in contents:
+        for part in content.parts:
+            if part.text:
+                tokens += len(part.text) // CHARS_PER_TOKEN
+            elif part.inline_data:
+                tokens += len(part.inline_data.data) // INLINE_BYTES_PER_TOKEN
+    return tokens
+
+class TokenBucket:
+    """
+    Hands out up to `rate` units per minute with bursts of up to BURST_SECONDS' worth.
+    reserve() takes the units right away and returns how long the caller must wait
+    before using them, so callers are served in order and never need to poll. The
+    balance goes negative while callers are waiting for units they already reserved.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.available = self.capacity
+        self._updated = time.monotonic()
+
+    @property
+    def capacity(self):
+        return self.rate * BURST_SECONDS / 60
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self._updated) * self.rate / 60)
+        self._updated = now
+
+    def reserve(self, amount, now):
+        self._refill(now)
+        self.available -= amount
+        return 0.0 if self.available >= 0 else -self.available * 60 / self.rate
+
+    def refund(self, amount, now):
+        self._refill(now)
+        self.available = min(self.capacity, self.available + amount)
+
+class ModelLimiter:
+    """
+    Keeps one model's calls within its requests per minute and tokens per minute.
+    Each call reserves one request and its estimated tokens before it is sent; once
+    the response's usage is known, the estimate is corrected. A quota error cuts
+    both rates by DECREASE_FACTOR, once per BURST_SECONDS since concurrent calls
+    tend to fail together, and the failed call is retried after a backoff; without
+    quota errors they recover by RECOVERY_PER_MINUTE of the configured limits per
+    minute. The rates so settle just under what the quota sustains. Thread-safe, so the
+    threads and event loops of one process share a single limiter per model.
+    """
+
+    def __init__(self, model, rpm, tpm):
+        self.model = model
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.average_tokens = None # Tokens per call, learned from usage metadata
+        self._adjusted = time.monotonic()
+        self._last_cut = None
+        self.calls = 0
+        self.quota_errors = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def estimate(self, fallback):
+        """Returns the tokens to reserve for a call: the learned average, or `fallback` before the first response."""
+        return self.average_tokens if self.average_tokens is not None else fallback
+
+    def _recover(self, now):
+        share = RECOVERY_PER_MINUTE * (now - self._adjusted) / 60
+        self._adjusted = now
+        self.requests.rate = min(self.rpm, self.requests.rate + self.rpm * share)
+        self.tokens.rate = min(self.tpm, self.tokens.rate + self.tpm * share)
+
+    def reserve(self, tokens):
+        """Reserves a request and `tokens` tokens. Returns the seconds to wait before sending the call."""
+        with self._lock:
+            now = time.monotonic()
+            self._recover(now)
+            delay = max(self.requests.reserve(1, now), self.tokens.reserve(tokens, now))
+            self.calls += 1
+            self.waited += delay
+        if delay > 0:
+            get_metrics().inc('rate_limit_wait_seconds', delay, model=self.model)
+        return delay
+
+    def settle(self, reserved, used):
+        """Corrects a reservation of `reserved` tokens with the `used` tokens from the response's usage."""
+        with self._lock:
+            now = time.monotonic()
+            if used > reserved:
+                self.tokens.reserve(used - reserved, now)
+            elif used < reserved:
+                self.tokens.refund(reserved - used, now)
+            self.average_tokens = used if self.average_tokens is None else 0.8 * self.average_tokens + 0.2 * used
+
+    def refund(self, reserved):
+        """Returns the tokens reserved for a call that failed before using them."""
+        with self._lock:
+            self.tokens.refund(reserved, time.monotonic())
+
+    def on_quota_error(self, attempt):
+        """Slows the model down after a quota error and returns the jittered backoff for this attempt."""
+        with self._lock:
+            now = time.monotonic()
+            self._recover(now)
+            self.quota_errors += 1
+            if self._last_cut is None or now - self._last_cut >= BURST_SECONDS:
+                self._last_cut = now
+                self.requests.rate = max(self.rpm * MIN_RATE_SHARE, self.requests.rate * DECREASE_FACTOR)
+                self.tokens.rate = max(self.tpm * MIN_RATE_SHARE, self.tokens.rate * DECREASE_FACTOR)
+        get_metrics().inc('quota_errors', model=self.model)
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    async def call(self, make_call, estimated_tokens=0, usage=None):
+        """
+        Awaits `make_call()` once the limits allow it. Quota errors are retried after a
+        jittered exponential backoff, up to QUOTA_ATTEMPTS calls; any other error is
+        raised straight away. A failed call's reserved tokens are refunded. `usage(result)`
+        returns the total tokens a result used. The waits happen before `make_call()`
+        is awaited, so a caller that limits concurrency should do so inside it.
+        """
+        for attempt in range(QUOTA_ATTEMPTS):
+            reserved = self.estimate(estimated_tokens)
+            delay = self.reserve(reserved)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = await make_call()
+            except Exception as e:
+                self.refund(reserved)
+                if not is_quota_error(e) or attempt == QUOTA_ATTEMPTS - 1:
+                    raise
+                backoff = self.on_quota_error(attempt)
+                print(f"{self.model} quota exceeded; backing off {backoff:.1f}s (attempt {attempt + 1}/{QUOTA_ATTEMPTS}).")
+                await asyncio.sleep(backoff)
+                continue
+            used = usage(result) if usage else None
+            if used is not None:
+                self.settle(reserved, used)
+            return result
+
+    def print_stats(self):
+        print(f"\nRate limiter for {self.model}:")
+        print(f"  Calls: {self.calls}, quota errors: {self.quota_errors}, waited {self.waited:.1f}s in total")
+        print(f"  Current rate: {self.requests.rate:.0f}/{self.rpm} requests/min, "
+              f"{self.tokens.rate:.0f}/{self.tpm} tokens/min")
+
+def get_limiter(model):
+    """Returns the process-wide limiter for a model, created with MODEL_LIMITS on first use."""
+    with _limiters_lock:
+        if model not in _limiters:
+            limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+            _limiters[model] = ModelLimiter(model, limits['rpm'], limits['tpm'])
+        return _limiters[model]
+
+def set_limits(model, rpm=None, tpm=None):
+    """Replaces the process-wide limiter for a model, keeping the configured limit for any rate left as None."""
+    limits = MODEL_LIMITS.get(model, DEFAULT_LIMITS)
+    limiter = ModelLimiter(model, rpm or limits['rpm'], tpm or limits['tpm'])
+    with _limiters_lock:
+        _limiters[model] = limiter
+    return limiter
+
+def usage_tokens(usage):
+    """Returns the total tokens in usage metadata, or None without any."""
+    return getattr(usage, 'total_token_count', None) if usage else None
+
+def total_tokens(response):
+    """Returns the total tokens in a response's usage metadata, or None if it has none."""
+    return usage_tokens(getattr(response, 'usage_metadata', None))
@@ -1,48 +1,137 @@
-import json
+import argparse
+import random
+import time
+from datetime import timedelta
+from google.api_core.exceptions import Aborted, Conflict
 from google.cloud import datastore
+from timestamps import now_utc, stamp_updated
+from stats_index import apply_transitions, get_category_from_entity, summarize
+from job_claims import release_lease
 
-def reset_datastore_entries():
+DEFAULT_STATES = ('in_progress_shallow', 'error_shallow')
+CHUNK_SIZE = 500 # Datastore transactions are limited to 500 entities
+TRANSACTION_ATTEMPTS = 5
+
+def _matches(entity, states, cutoff, category):
+    """
+    Checks the filters against a fetched entity, which may have changed since it was
+    queried. The cutoff is only checked here: an in-progress row without 'updatedAt'
+    was written before rows were stamped, so it counts as stale.
+    """
+    if entity is None:
+        return False
+    if states and entity.get('state') not in states:
+        return False
+    if cutoff is not None and (entity.get('state') or '').startswith('in_progress'):
+        updated_at = entity.get('updatedAt')
+        if updated_at is not None and updated_at >= cutoff:
+            return False
+    if category is not None and str(get_category_from_entity(entity)) != str(category):
+        return False
+    return True
+
+def find_keys(client, states, cutoff=None, category=None):
+    """
+    Finds the keys of candidate investments in `states` with keys-only queries, in
+    `category` if one is given. The `cutoff` is not part of the query, since Datastore
+    never returns rows without 'updatedAt' for a filter on it; reset_chunk checks it
+    with _matches instead.
+    """
+    keys = []
+    for state in states:
+        query = client.query(kind='Investment')
+        query.add_filter('state', '=', state)
+        if category is not None:
+            query.add_filter('shallowReport.riskAssessment.category', '=', str(category))
+        query.keys_only()
+        keys += [entity.key for entity in query.fetch()]
+    return keys
+
+def reset_chunk(client, keys, states, cutoff, category):
+    """
+    Sets the matching investments among `keys` back to pending in one transaction,
+    writing only the state, lease and update time and keeping their reports.
+    Returns the ids that were reset.
+    """
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            now = now_utc()
+            transitions = []
+            reset = []
+            with client.transaction():
+                for entity in client.get_multi(keys):
+                    if not _matches(entity, states, cutoff, category):
+                        continue
+                    before = summarize(entity)
+                    entity['state'] = 'pending'
+                    release_lease(entity)
+                    stamp_updated(entity, now)
+                    reset.append(entity)
+                    transitions.append((before, summarize(entity)))
+                if reset:
+                    client.put_multi(reset)
+            apply_transitions(client, transitions)
+            return [entity.key.name for entity in reset]
+        except (Aborted, Conflict):
+            # A worker saved one of these rows meanwhile; re-read and check it again
+            time.sleep(random.uniform(0.1, 0.5) * (attempt + 1))
+    raise RuntimeError(f"Chunk starting at '{keys[0].name}' kept conflicting after {TRANSACTION_ATTEMPTS} attempts")
+
+def reset_datastore_entries(states=None, older_than_minutes=None, ids=None, category=None, dry_run=False):
+    """
+    Sets stuck or failed investments back to pending. Candidates are found by id, or
+    with keys-only queries on `states` (DEFAULT_STATES by default), optionally limited
+    to in-progress rows older than `older_than_minutes` and to one category. Only the
+    state and lease fields change, so existing reports are kept.
+    """
     client = datastore.Client(database='investment-reports')
-    
-    # Load the base investments data
-    with open('scripts/investments.json', 'r', encoding='utf-8') as f:
-        base_investments = {item['id']: item for item in json.load(f)}
-        
-    # Query for entities that need resetting
-    query = client.query(kind='Investment')
-    query.add_filter('state', 'IN', ['in_progress_shallow', 'error_shallow'])
-    entities_to_reset = list(query.fetch())
-    
-    if not entities_to_reset:
+    cutoff = now_utc() - timedelta(minutes=older_than_minutes) if older_than_minutes is not None else None
+
+    if ids:
+        keys = [client.key('Investment', investment_id) for investment_id in dict.fromkeys(ids)]
+    else:
+        states = states or DEFAULT_STATES
+        keys = find_keys(client, states, cutoff, category)
+
+    if not keys:
         print("No entries to reset.")
         return
-        
-    print(f"Found {len(entities_to_reset)} entries to reset.")
-    
-    batch = client.batch()
-    batch.begin()
-    
-    for i, entity in enumerate(entities_to_reset):
-        entity_id = entity.key.name
-        if entity_id in base_investments:
-            reset_data = base_investments[entity_id]
-            reset_data['state'] = 'pending'
-            
-            key = client.key('Investment', entity_id)
-            entity_to_update = datastore.Entity(key=key)
-            entity_to_update.update(reset_data)
-            batch.put(entity_to_update)
-            
-            if (i + 1) % 500 == 0:
-                print("Committing batch...")
-                batch.commit()
-                batch = client.batch()
-                batch.begin()
-    
-    print("Committing final batch...")
-    batch.commit()
-    
-    print("Datastore reset complete.")
+
+    chunks = [keys[start:start + CHUNK_SIZE] for start in range(0, len(keys), CHUNK_SIZE)]
+    if dry_run:
+        matched = [entity for chunk in chunks for entity in client.get_multi(chunk)
+                   if _matches(entity, states, cutoff, category)]
+        print(f"Dry run: {len(matched)} entries would be reset to pending.")
+        for entity in matched:
+            print(f"  - {entity.key.name} ({entity.get('state')})")
+        return
+
+    print(f"Found {len(keys)} candidate entries.")
+    reset = []
+    for chunk in chunks:
+        reset += reset_chunk(client, chunk, states, cutoff, category)
+        print(f"Reset {len(reset)} entries so far...")
+
+    print(f"Datastore reset complete: {len(reset)} entries set to pending.")
 
 if __name__ == '__main__':
-    reset_datastore_entries()
+    parser = argparse.ArgumentParser(description="Set stuck or failed investments back to pending, keeping their reports.")
+    parser.add_argument('--state', action='append', dest='states', default=None,
+                        help=f"State to reset; may be repeated. Defaults to {', '.join(DEFAULT_STATES)}. "
+                             "With --ids, any state unless given.")
+    parser.add_argument('--older-than', type=float, default=None, metavar='MINUTES',
+                        help='Only reset in-progress investments last updated more than this many minutes ago.')
+    parser.add_argument('--ids', default=None, help='Comma-separated investment ids to reset.')
+    parser.add_argument('--ids-file', default=None, help='File with one investment id per line to reset.')
+    parser.add_argument('--cat', type=int, choices=[1, 2, 3, 4], default=None,
+                        help='Only reset investments in this risk category.')
+    parser.add_argument('--dry-run', action='store_true', help='List the investments that would be reset without writing.')
+    args = parser.parse_args()
+
+    ids = [investment_id.strip() for investment_id in args.ids.split(',')] if args.ids else []
+    if args.ids_file:
+        with open(args.ids_file, 'r', encoding='utf-8') as f:
+            ids += [line.strip() for line in f]
+    ids = [investment_id for investment_id in ids if investment_id]
+
+    reset_datastore_entries(args.states, args.older_than, ids, args.cat, args.dry_run)
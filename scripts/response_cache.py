@@ -0,0 +1,172 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.dirname(__file__), '.response_cache.sqlite')
+MAX_BYTES = 512 * 1024 * 1024 # Least recently used responses are evicted beyond this size
+MAX_AGE_DAYS = 90
+ACCESS_FLUSH_SIZE = 100 # Hits whose access times are buffered before they are written
+KEY_VERSION = 1 # Bump to invalidate every cached response, e.g. when the request config changes
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def make_key(model, pdf_bytes, prompt, schema):
+    """
+    Builds the cache key for one model call from everything that determines its
+    response: the model, a hash of the PDF, the full prompt text and the response
+    schema. Calls run with temperature 0 and a fixed seed, so equal keys mean
+    equal responses.
+    """
+    request = {
+        'version': KEY_VERSION,
+        'model': model,
+        'pdf': sha256(pdf_bytes) if pdf_bytes else None,
+        'prompt': prompt,
+        'schema': schema,
+    }
+    return sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+
+class ResponseCache:
+    """
+    Stores model responses on disk in SQLite, keyed by make_key. Entries older than
+    `max_age_days` are never returned, and the least recently used entries are
+    evicted once the cache grows past `max_bytes`. A disabled cache never reads or
+    writes, which bypasses it for a run.
+
+    The calls block on disk, so async code runs them with asyncio.to_thread. Hits
+    only buffer their access time, which is written with the next store, delete or
+    ACCESS_FLUSH_SIZE hits, and the cache's size is tracked as entries come and go
+    rather than summed on every store.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, max_bytes=MAX_BYTES, max_age_days=MAX_AGE_DAYS, enabled=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age_days * 24 * 3600
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        self._accessed = {} # Access times of hits not yet written
+        self._total = 0 # Bytes of all stored responses
+
+    def _connect(self):
+        # Opened lazily so a disabled cache never creates the file
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, accessed REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS responses_created ON responses (created)')
+            self._total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._connection
+
+    def _flush_accessed(self, connection):
+        if self._accessed:
+            connection.executemany(
+                'UPDATE responses SET accessed = ? WHERE key = ?',
+                [(accessed, key) for key, accessed in self._accessed.items()],
+            )
+            self._accessed = {}
+
+    def _size(self, connection, key):
+        row = connection.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def get(self, key):
+        """Returns the cached response text for `key`, or None."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            row = connection.execute(
+                'SELECT response FROM responses WHERE key = ? AND created >= ?', (key, now - self.max_age)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_SIZE:
+                self._flush_accessed(connection)
+                connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, model, response):
+        """Stores a response and evicts old or least recently used entries if needed."""
+        if not self.enabled:
+            return
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            size = len(response.encode('utf-8'))
+            self._total -= self._size(connection, key)
+            self._accessed.pop(key, None)
+            connection.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)',
+                (key, model, response, size, now, now),
+            )
+            self._total += size
+            self.stores += 1
+            self._flush_accessed(connection)
+            self._evict(connection, now)
+            connection.commit()
+
+    def delete(self, key):
+        """Removes one response, e.g. one that parsed but was rejected by the caller."""
+        if not self.enabled:
+            return
+        with self._lock:
+            connection = self._connect()
+            self._total -= self._size(connection, key)
+            self._accessed.pop(key, None)
+            connection.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self._flush_accessed(connection)
+            connection.commit()
+
+    def _evict(self, connection, now):
+        cutoff = now - self.max_age
+        expired, expired_size = connection.execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses WHERE created < ?', (cutoff,)
+        ).fetchone()
+        if expired:
+            connection.execute('DELETE FROM responses WHERE created < ?', (cutoff,))
+            self._total -= expired_size
+            self.evictions += expired
+        if self._total <= self.max_bytes:
+            return
+        evicted = []
+        for key, size in connection.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if self._total <= self.max_bytes:
+                break
+            evicted.append((key,))
+            self._total -= size
+        connection.executemany('DELETE FROM responses WHERE key = ?', evicted)
+        self.evictions += len(evicted)
+
+    def print_stats(self):
+        if not self.enabled:
+            print("\nResponse cache: bypassed.")
+            return
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        print(f"\nResponse cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0f}% hit rate), "
+              f"{self.stores} stored, {self.evictions} evicted.")
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._flush_accessed(self._connection)
+                self._connection.commit()
+                self._connection.close()
+                self._connection = None
@@ -0,0 +1,139 @@
+import argparse
+import threading
+from google.cloud import datastore
+from stats_index import market_value
+from timestamps import stamp_updated
+
+PRIORITY_PROPERTY = 'priority' # Embedded entity with one score per priority mode
+PRIORITY_MODES = ('value', 'ownership', 'risk')
+BACKFILL_PAGE_SIZE = 500 # Datastore's maximum number of entities per commit
+# Rough priors for how likely a holding in each industry is to breach the ethical
+# guidelines, going by where exclusions and observations have been concentrated.
+# The 'risk' priority is the market value weighted by these.
+INDUSTRY_RISK = {
+    'Energy': 3.0,
+    'Basic Materials': 2.5,
+    'Utilities': 2.0,
+    'Industrials': 1.5,
+    'Consumer Staples': 1.5,
+    'Telecommunications': 1.0,
+    'Consumer Discretionary': 1.0,
+    'Health Care': 1.0,
+    'Technology': 1.0,
+    'Real Estate': 0.8,
+    'Financials': 0.7,
+}
+BUDGET_UNITS = ('calls', 'tokens')
+BUDGET_MULTIPLIERS = {'k': 1_000, 'm': 1_000_000}
+
+def priorities(investment):
+    """Scores an investment for every priority mode; higher scores are processed first."""
+    value = market_value(investment)
+    try:
+        ownership = float(investment.get('ownership') or 0)
+    except (TypeError, ValueError):
+        ownership = 0.0
+    return {
+        'value': float(value),
+        'ownership': ownership,
+        'risk': float(value) * INDUSTRY_RISK.get(investment.get('industry'), 1.0),
+    }
+
+def set_priority(entity):
+    """Stores the priority scores on an investment entity, e.g. before it is written as pending."""
+    entity[PRIORITY_PROPERTY] = priorities(entity)
+    return entity
+
+def priority_order(mode):
+    """Returns the Datastore sort order that puts the highest priority first for a mode."""
+    return f"-{PRIORITY_PROPERTY}.{mode}"
+
+def parse_budget(value):
+    """
+    Parses a '--budget' value into (unit, amount): a number of model calls like '300'
+    or '300calls', or of tokens like '5000000tokens' or '5Mtokens'.
+    """
+    text = value.strip().lower()
+    unit = next((unit for unit in BUDGET_UNITS if text.endswith(unit)), 'calls')
+    number = text[:-len(unit)] if text.endswith(unit) else text
+    multiplier = BUDGET_MULTIPLIERS.get(number[-1:], 1)
+    if multiplier > 1:
+        number = number[:-1]
+    try:
+        amount = int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid budget '{value}', expected e.g. 300, 300calls or 5Mtokens.")
+    if amount <= 0:
+        raise argparse.ArgumentTypeError(f"Invalid budget '{value}', it must be positive.")
+    return unit, amount
+
+class RunBudget:
+    """
+    Caps the model calls or tokens one run may spend. Every attempt counts, including
+    failed and retried ones. Workers stop claiming new batches once it is exhausted;
+    batches already in flight still finish, so a run may overshoot by the calls they
+    still make, including their retries and splits.
+    """
+
+    def __init__(self, max_calls=None, max_tokens=None):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.calls = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_arg(cls, budget):
+        """Builds a budget from a parsed '--budget' value, or an unlimited one for None."""
+        if budget is None:
+            return cls()
+        unit, amount = budget
+        return cls(max_calls=amount) if unit == 'calls' else cls(max_tokens=amount)
+
+    def spend(self, tokens=None):
+        """Records one model call and the tokens it used."""
+        with self._lock:
+            self.calls += 1
+            self.tokens += tokens or 0
+
+    @property
+    def exhausted(self):
+        return ((self.max_calls is not None and self.calls >= self.max_calls)
+                or (self.max_tokens is not None and self.tokens >= self.max_tokens))
+
+    def describe(self):
+        calls = f"{self.calls}/{self.max_calls}" if self.max_calls is not None else str(self.calls)
+        tokens = f"{self.tokens}/{self.max_tokens}" if self.max_tokens is not None else str(self.tokens)
+        return f"{calls} model calls, {tokens} tokens"
+
+def backfill_priorities(client, page_size=BACKFILL_PAGE_SIZE):
+    """
+    Stores the priority scores on every investment that lacks them or has outdated ones.
+    The changed investments get a new 'updatedAt', so 'export_from_datastore.py --since'
+    picks them up.
+    """
+    query = client.query(kind='Investment')
+    updated = 0
+    batch = []
+    for entity in query.fetch():
+        if entity.get(PRIORITY_PROPERTY) == priorities(entity):
+            continue
+        batch.append(stamp_updated(set_priority(entity)))
+        if len(batch) >= page_size:
+            client.put_multi(batch)
+            updated += len(batch)
+            batch = []
+    if batch:
+        client.put_multi(batch)
+        updated += len(batch)
+    print(f"Stored priority scores on {updated} investments.")
+    return updated
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Store the priority scores used by 'create_shallow_investments.py --priority' on every investment. "
+                    "Imports store them on the investments they write; run this once for older data, "
+                    "while no pipeline is running.")
+    parser.parse_args()
+
+    backfill_priorities(datastore.Client(database='investment-reports'))
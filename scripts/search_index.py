@@ -0,0 +1,216 @@
+import argparse
+import bisect
+import functools
+import json
+import math
+import os
+import re
+import time
+import unicodedata
+import numpy as np
+import snowballstemmer
+from export_from_datastore import default_data_dir, default_output_path, write_with_compressed_copies
+
+INDEX_FILE_NAME = 'search_index.json'
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_PREFIX_EXPANSIONS = 50 # Caps how many vocabulary terms a short prefix can expand to
+# Repeat counts for text from each field, so a match in the name or concerns ranks above one in a long deep report
+FIELD_WEIGHTS = {'name': 3, 'concerns': 2, 'guidelines': 2, 'other': 1}
+
+_TOKEN_PATTERN = re.compile(r'\w+')
+_stemmers = [snowballstemmer.stemmer('english'), snowballstemmer.stemmer('norwegian')]
+
+def default_index_path():
+    return os.path.join(default_data_dir(), INDEX_FILE_NAME)
+
+def tokenize(text):
+    """Lowercases `text` and splits it into words, keeping letters such as æ, ø and å intact."""
+    text = unicodedata.normalize('NFC', (text or '').lower())
+    return [token for token in _TOKEN_PATTERN.findall(text) if len(token) > 1 or token.isdigit()]
+
+@functools.lru_cache(maxsize=100_000)
+def stems(token):
+    """Returns the English and Norwegian stems of a token; reports are in English, queries may be in either."""
+    return frozenset(stemmer.stemWord(token) for stemmer in _stemmers)
+
+def _strings(value):
+    """Yields every string inside a nested report section."""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _strings(item)
+
+def document_fields(investment):
+    """Returns (field, text) pairs for the searchable text of an investment."""
+    fields = [('name', investment.get('name'))]
+    for report in ('shallowReport', 'deepReport'):
+        report_data = investment.get(report) or {}
+        risk = report_data.get('riskAssessment') or {}
+        fields.append(('concerns', risk.get('concerns')))
+        fields.extend(('guidelines', guideline) for guideline in risk.get('guidelines') or [])
+        for key, value in risk.items():
+            if key not in ('concerns', 'guidelines', 'category'):
+                fields.extend(('other', text) for text in _strings(value))
+        fields.append(('other', (report_data.get('companyProfile') or {}).get('businessDescription')))
+    return [(field, text) for field, text in fields if text]
+
+def load_export(path):
+    """Reads an export written by export_from_datastore.py, as a JSON array or NDJSON."""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.ndjson'):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+def build_index(investments):
+    """
+    Builds an inverted index from stemmed terms to the investments that contain them.
+    Postings are stored as [doc gap, weighted term frequency, ...] pairs, which keeps
+    the file compact once serialized.
+    """
+    docs = []
+    lengths = []
+    postings = {}
+    for doc, investment in enumerate(sorted(investments, key=lambda item: item['id'])):
+        docs.append([investment['id'], investment.get('name')])
+        frequencies = {}
+        length = 0
+        for field, text in document_fields(investment):
+            weight = FIELD_WEIGHTS[field]
+            for token in tokenize(text):
+                length += 1
+                for stem in stems(token):
+                    frequencies[stem] = frequencies.get(stem, 0) + weight
+        lengths.append(length)
+        for term, frequency in frequencies.items():
+            postings.setdefault(term, []).append((doc, frequency))
+
+    terms = {}
+    for term, entries in postings.items():
+        encoded = []
+        previous = 0
+        for doc, frequency in entries:
+            encoded += [doc - previous, frequency]
+            previous = doc
+        terms[term] = encoded
+    return {'docs': docs, 'lengths': lengths, 'terms': terms}
+
+class SearchIndex:
+    """A loaded search index, ranking investments with BM25."""
+
+    def __init__(self, data):
+        self.docs = data['docs']
+        self.lengths = data['lengths']
+        lengths = np.array(self.lengths, dtype=np.float64)
+        # The BM25 length normalization of each document only depends on the index
+        self.norms = BM25_K1 * (1 - BM25_B + BM25_B * lengths / lengths.mean()) if len(lengths) else lengths
+        self.terms = data['terms']
+        self.vocabulary = sorted(self.terms)
+        self.term_scores = {}
+
+    @classmethod
+    def load(cls, path=None):
+        with open(path or default_index_path(), 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def _scores(self, term):
+        """Returns the documents containing `term` and their BM25 scores for it, decoded on first use."""
+        if term not in self.term_scores:
+            encoded = np.array(self.terms[term], dtype=np.int64)
+            docs = np.cumsum(encoded[0::2])
+            frequencies = encoded[1::2].astype(np.float64)
+            idf = math.log(1 + (len(self.docs) - len(docs) + 0.5) / (len(docs) + 0.5))
+            self.term_scores[term] = (docs, idf * frequencies * (BM25_K1 + 1) / (frequencies + self.norms[docs]))
+        return self.term_scores[term]
+
+    def _prefix_terms(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        matches = []
+        for term in self.vocabulary[start:start + MAX_PREFIX_EXPANSIONS]:
+            if not term.startswith(prefix):
+                break
+            matches.append(term)
+        return matches
+
+    def _query_terms(self, query, prefix):
+        """Maps each query word to the index terms it matches. With `prefix`, the last word also matches as a prefix."""
+        tokens = tokenize(query)
+        words = []
+        for position, token in enumerate(tokens):
+            matched = {stem for stem in stems(token) if stem in self.terms}
+            if prefix and position == len(tokens) - 1:
+                matched.update(self._prefix_terms(token))
+            words.append(matched)
+        return words
+
+    def search(self, query, limit=10, prefix=True):
+        """
+        Returns up to `limit` (id, name, score) results for `query`, best first. Every
+        query word must match; a word matches any of its stems, and with `prefix` the
+        last word also matches every term it is a prefix of, for autocomplete.
+        """
+        words = self._query_terms(query, prefix)
+        if not words or not all(words):
+            return []
+
+        total = np.zeros(len(self.docs))
+        for matched in words:
+            best = np.zeros(len(self.docs))
+            for term in matched:
+                # A word matching several stems or prefixes counts once, with its best term
+                docs, scores = self._scores(term)
+                best[docs] = np.maximum(best[docs], scores)
+            # Documents missing any word drop out for good
+            total = np.where(best > 0, total + best, -np.inf)
+
+        candidates = np.flatnonzero(total > -np.inf)
+        if len(candidates) > limit:
+            candidates = candidates[np.argpartition(-total[candidates], limit)[:limit]]
+        ranked = candidates[np.argsort(-total[candidates], kind='stable')]
+        return [(self.docs[doc][0], self.docs[doc][1], float(total[doc])) for doc in ranked]
+
+def write_index(input_path=None, output_path=None):
+    """Builds the search index from an export and writes it, with compressed copies, as a static file."""
+    input_path = input_path or default_output_path()
+    output_path = output_path or default_index_path()
+
+    start = time.perf_counter()
+    index = build_index(load_export(input_path))
+    data = json.dumps(index, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    write_with_compressed_copies(output_path, data)
+    print(f"Indexed {len(index['docs'])} investments and {len(index['terms'])} terms in "
+          f"{time.perf_counter() - start:.1f}s. Wrote {output_path} ({len(data) / 1024:.0f} KiB).")
+
+def print_results(index, query, limit=10, prefix=True):
+    start = time.perf_counter()
+    results = index.search(query, limit, prefix)
+    elapsed = (time.perf_counter() - start) * 1000
+
+    print(f"Found {len(results)} result(s) for '{query}' in {elapsed:.1f}ms:")
+    for investment_id, name, score in results:
+        print(f"  - {score:6.2f}  {name} ({investment_id})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or query the full-text search index over the report text.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='Build the index from an export.')
+    build_parser.add_argument('--input', default=None,
+                              help='Export to index. Defaults to frontend/public/data/investments_exported.json.')
+    build_parser.add_argument('--output', default=None,
+                              help=f'Index file. Defaults to frontend/public/data/{INDEX_FILE_NAME}.')
+    query_parser = subparsers.add_parser('query', help='Search the index.')
+    query_parser.add_argument('query', help='Words to search for.')
+    query_parser.add_argument('--index', default=None,
+                              help=f'Index file. Defaults to frontend/public/data/{INDEX_FILE_NAME}.')
+    query_parser.add_argument('--num', type=int, default=10, help='Number of results. Defaults to 10.')
+    query_parser.add_argument('--exact', action='store_true', help='Do not match the last word as a prefix.')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        write_index(args.input, args.output)
+    else:
+        print_results(SearchIndex.load(args.index), args.query, args.num, not args.exact)
@@ -0,0 +1,169 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from google.cloud import datastore
+from job_claims import LEASE_SECONDS, make_worker_id
+from stats_index import market_value
+
+PROGRESS_KIND = 'ShardProgress'
+# A node that has not reported for this long has stopped; its claims have expired by then too
+ACTIVE_SECONDS = LEASE_SECONDS
+
+def parse_shard(value):
+    """Parses a '--shard i/N' value into (i, N). Shards are numbered from 0."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', expected the form i/N, e.g. 0/4.")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{value}', i must be between 0 and N-1.")
+    return index, count
+
+def parse_key_range(value):
+    """Parses a '--key-range START:END' value. Either end may be empty to leave it open."""
+    if ':' not in value:
+        raise argparse.ArgumentTypeError(f"Invalid key range '{value}', expected START:END, e.g. a:m.")
+    start, end = value.split(':', 1)
+    return start or None, end or None
+
+def load_base_ids(json_file_path='scripts/investments.json'):
+    """Loads the sorted investment ids from the base investments file."""
+    with open(json_file_path, 'r', encoding='utf-8') as f:
+        return sorted(item['id'] for item in json.load(f))
+
+def shard_key_range(shard_index, shard_count, ids):
+    """
+    Splits the sorted ids into `shard_count` contiguous key ranges of equal size and
+    returns the [start, end) range for one shard. None means the range is open.
+    """
+    start = ids[shard_index * len(ids) // shard_count] if shard_index > 0 else None
+    end = ids[(shard_index + 1) * len(ids) // shard_count] if shard_index < shard_count - 1 else None
+    return start, end
+
+def describe_key_range(key_range):
+    start, end = key_range
+    return f"[{start or ''}, {end or ''})"
+
+class NodeProgress:
+    """
+    Tracks the throughput of one node and periodically writes it to a ShardProgress
+    entity, so a coordinator can combine the progress of every node in a run.
+    """
+
+    def __init__(self, client, run_id, shard_label, report_interval=30):
+        self.client = client
+        self.run_id = run_id
+        self.shard_label = shard_label
+        self.node_id = make_worker_id()
+        self.report_interval = report_interval
+        self.started_at = datetime.now(timezone.utc)
+        self.start_time = time.monotonic()
+        self.last_report = 0.0
+        self.done = 0
+        self.errors = 0
+        self.value_done = 0 # Market value in NOK of the investments done
+
+    def record(self, investments):
+        for investment in investments:
+            if investment.get('state') == 'error_shallow':
+                self.errors += 1
+            elif investment.get('state') != 'pending':
+                self.done += 1
+                self.value_done += market_value(investment)
+
+    @property
+    def items_per_second(self):
+        elapsed = time.monotonic() - self.start_time
+        return (self.done + self.errors) / elapsed if elapsed else 0.0
+
+    def report_due(self):
+        return time.monotonic() - self.last_report >= self.report_interval
+
+    def report(self, finished=False):
+        """Writes the current progress of this node to Datastore; `finished` marks the node's last report."""
+        self.last_report = time.monotonic()
+        key = self.client.key(PROGRESS_KIND, f"{self.run_id}:{self.node_id}")
+        entity = datastore.Entity(key=key)
+        entity.update({
+            'runId': self.run_id,
+            'shard': self.shard_label,
+            'node': self.node_id,
+            'startedAt': self.started_at,
+            'updatedAt': datetime.now(timezone.utc),
+            'done': self.done,
+            'errors': self.errors,
+            'itemsPerSecond': self.items_per_second,
+            'valueDoneNok': self.value_done,
+            'finished': finished,
+        })
+        self.client.put(entity)
+
+    def print_summary(self):
+        elapsed = time.monotonic() - self.start_time
+        print(f"\nNode {self.node_id} (shard {self.shard_label}): {self.done} done, {self.errors} errors "
+              f"in {elapsed:.0f}s ({self.items_per_second:.2f} items/s), "
+              f"covering {self.value_done / 1e9:.1f} bn NOK of market value.")
+
+def count_pending(client):
+    """Counts pending investments with an aggregation query."""
+    query = client.query(kind='Investment')
+    query.add_filter('state', '=', 'pending')
+    result = list(client.aggregation_query(query).count(alias='pending').fetch())
+    return result[0][0].value if result and result[0] else 0
+
+def _node_status(node, now):
+    if node.get('finished'):
+        return 'finished'
+    return 'active' if now - node['updatedAt'] <= timedelta(seconds=ACTIVE_SECONDS) else 'stale'
+
+def print_coordinator_summary(client, run_id=None):
+    """
+    Prints the progress of every node, and the combined progress, of one run or all runs.
+    Only active nodes count toward the combined rate; finished nodes, and nodes that have
+    not reported within ACTIVE_SECONDS, are listed separately.
+    """
+    query = client.query(kind=PROGRESS_KIND)
+    if run_id:
+        query.add_filter('runId', '=', run_id)
+    nodes = sorted(query.fetch(), key=lambda node: (node.get('runId', ''), node.get('shard', '')))
+
+    if not nodes:
+        print("No shard progress found.")
+        return
+
+    now = datetime.now(timezone.utc)
+    by_status = {'active': [], 'finished': [], 'stale': []}
+    for node in nodes:
+        by_status[_node_status(node, now)].append(node)
+
+    titles = {'active': 'Active Nodes', 'finished': 'Finished Nodes',
+              'stale': f'Stale Nodes (no report in {ACTIVE_SECONDS // 60} min)'}
+    for status, title in titles.items():
+        if not by_status[status]:
+            continue
+        print(f"\n{title}:")
+        for node in by_status[status]:
+            print(f"  - Run {node['runId']}, shard {node['shard']} on {node['node']}: "
+                  f"{node['done']} done, {node['errors']} errors, {node['itemsPerSecond']:.2f} items/s "
+                  f"(updated {node['updatedAt']:%Y-%m-%d %H:%M:%S})")
+
+    total_done = sum(node['done'] for node in nodes)
+    total_errors = sum(node['errors'] for node in nodes)
+    total_value = sum(node.get('valueDoneNok', 0) for node in nodes)
+    total_rate = sum(node['itemsPerSecond'] for node in by_status['active'])
+
+    pending = count_pending(client)
+    print(f"\nCombined: {total_done} done, {total_errors} errors across {len(nodes)} node(s), covering "
+          f"{total_value / 1e9:.1f} bn NOK of market value.")
+    print(f"Current rate: {total_rate:.2f} items/s from {len(by_status['active'])} active node(s).")
+    print(f"Pending investments remaining: {pending}")
+    if total_rate > 0:
+        print(f"Estimated time to finish at the current rate: {pending / total_rate / 60:.0f} min")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Show the combined progress of sharded shallow report runs.")
+    parser.add_argument('--run-id', default=None, help='Only show nodes from this run.')
+    args = parser.parse_args()
+
+    print_coordinator_summary(datastore.Client(database='investment-reports'), args.run_id)
@@ -0,0 +1,222 @@
+import json
+import random
+import time
+import zlib
+from google.api_core.exceptions import Aborted, Conflict
+from google.cloud import datastore
+from metrics import get_metrics
+
+STATS_KIND = 'InvestmentStats'
+NUM_SHARDS = 8 # Spreads writes over several entities; each investment always maps to the same shard
+TOP_N = 50 # Highest market value investments kept per category
+DIMENSIONS = ('state', 'category', 'region', 'industry', 'reports')
+TRANSACTION_ATTEMPTS = 3
+REMOVED_STATE = 'removed' # Holdings the fund no longer owns; kept for their reports but not counted or exported
+
+def get_category_from_entity(entity):
+    """Safely extracts the category from a Datastore entity."""
+    if 'shallowReport' in entity and isinstance(entity['shallowReport'], dict):
+        risk_assessment = entity['shallowReport'].get('riskAssessment', {})
+        if isinstance(risk_assessment, dict):
+            return risk_assessment.get('category')
+    return None
+
+def market_value(entity):
+    """Returns marketValueNok as a number, whether it is stored as a number or as a string like '97 148 575'."""
+    value = entity.get('marketValueNok')
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(str(value).replace(' ', '').replace('\u00a0', ''))
+    except ValueError:
+        return 0
+
+def is_removed(entity):
+    return entity.get('state') == REMOVED_STATE
+
+def summarize(entity):
+    """Reduces an investment to the fields the stats index counts, or None for a removed holding."""
+    if is_removed(entity):
+        return None
+    if 'deepReport' in entity:
+        reports = 'deep'
+    elif 'shallowReport' in entity:
+        reports = 'shallow'
+    else:
+        reports = 'none'
+    return {
+        'id': entity.get('id') or entity.key.name,
+        'name': entity.get('name'),
+        'state': entity.get('state') or 'other',
+        'category': get_category_from_entity(entity) or 'none',
+        'region': entity.get('region') or 'none',
+        'industry': entity.get('industry') or 'none',
+        'reports': reports,
+        'marketValueNok': market_value(entity),
+    }
+
+def _shard_for(investment_id):
+    return zlib.crc32(investment_id.encode('utf-8')) % NUM_SHARDS
+
+def _shard_key(client, shard):
+    return client.key(STATS_KIND, f"shard-{shard}")
+
+def _empty_stats():
+    stats = {dimension: {} for dimension in DIMENSIONS}
+    stats['total'] = 0
+    stats['top'] = {}
+    return stats
+
+def _decode(entity):
+    return json.loads(entity['data'])
+
+def _encode(client, shard, stats):
+    # Stored as unindexed JSON text so the counters never touch index limits
+    entity = datastore.Entity(key=_shard_key(client, shard), exclude_from_indexes=('data',))
+    entity['data'] = json.dumps(stats, ensure_ascii=False)
+    return entity
+
+def _count(stats, summary, delta):
+    stats['total'] += delta
+    for dimension in DIMENSIONS:
+        counts = stats[dimension]
+        counts[summary[dimension]] = counts.get(summary[dimension], 0) + delta
+        if counts[summary[dimension]] == 0:
+            del counts[summary[dimension]]
+
+def _update_top(stats, before, after):
+    # An investment that leaves a full list is not replaced, since the shard does not know
+    # what ranked below it; load_stats reports such lists in 'shortTop' until a rebuild
+    if before is not None:
+        top = [item for item in stats['top'].get(before['category'], []) if item['id'] != before['id']]
+        if top:
+            stats['top'][before['category']] = top
+        else:
+            stats['top'].pop(before['category'], None)
+    if after is not None:
+        top = [item for item in stats['top'].get(after['category'], []) if item['id'] != after['id']]
+        top.append({key: after[key] for key in ('id', 'name', 'state', 'marketValueNok')})
+        top.sort(key=lambda item: item['marketValueNok'], reverse=True)
+        stats['top'][after['category']] = top[:TOP_N]
+
+def _apply(stats, before, after):
+    if before is not None:
+        _count(stats, before, -1)
+    if after is not None:
+        _count(stats, after, 1)
+    _update_top(stats, before, after)
+
+def snapshot(client, keys):
+    """Summarizes the stored investments for `keys` before they are overwritten, keyed by id."""
+    return {entity.key.name: summarize(entity) for entity in client.get_multi(keys) if not is_removed(entity)}
+
+def put_with_stats(client, entities):
+    """
+    Writes entities and moves them to their new buckets in the stats index. The snapshot
+    of what they replace is read in the same transaction as the write, so two writers
+    saving the same investment cannot both count its transition.
+    """
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            with client.transaction():
+                before = snapshot(client, [entity.key for entity in entities])
+                client.put_multi(entities)
+            break
+        except (Aborted, Conflict):
+            get_metrics().inc('transaction_conflicts', stage='datastore_commit')
+            if attempt == TRANSACTION_ATTEMPTS - 1:
+                raise
+            time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+    record_writes(client, before, entities)
+
+def apply_transitions(client, transitions):
+    """
+    Moves each investment's contribution in the stats index from its old summary to its
+    new one. `transitions` is a list of (before, after) summaries, where None stands for
+    an investment that did not exist or was removed. Failures are reported rather than
+    raised, since a drifted index can always be rebuilt.
+    """
+    by_shard = {}
+    for before, after in transitions:
+        if before == after:
+            continue
+        investment_id = (after or before)['id']
+        by_shard.setdefault(_shard_for(investment_id), []).append((before, after))
+    if not by_shard:
+        return
+
+    for attempt in range(TRANSACTION_ATTEMPTS):
+        try:
+            with client.transaction():
+                shards = sorted(by_shard)
+                current = {entity.key.name: entity for entity in client.get_multi([_shard_key(client, s) for s in shards])}
+                updated = []
+                for shard in shards:
+                    if f"shard-{shard}" not in current:
+                        # The index has not been built yet; rebuild_stats creates it from a full scan
+                        continue
+                    stats = _decode(current[f"shard-{shard}"])
+                    for before, after in by_shard[shard]:
+                        _apply(stats, before, after)
+                    updated.append(_encode(client, shard, stats))
+                if updated:
+                    client.put_multi(updated)
+            return
+        except (Aborted, Conflict):
+            get_metrics().inc('transaction_conflicts', stage='stats_index')
+            time.sleep(random.uniform(0.05, 0.2) * (attempt + 1))
+        except Exception as e:
+            print(f"Stats index update failed: {e}")
+            break
+    print("Stats index may have drifted; run 'python scripts/query_investments.py stats --rebuild'.")
+
+def record_writes(client, before, entities):
+    """Applies the transitions for entities just written, given a snapshot taken before the write."""
+    transitions = []
+    for entity in entities:
+        investment_id = entity.get('id') or entity.key.name
+        transitions.append((before.get(investment_id), summarize(entity)))
+    apply_transitions(client, transitions)
+
+def load_stats(client):
+    """
+    Reads every stats shard in one lookup and merges them. Returns None if the index has
+    not been built. 'shortTop' holds the categories whose top list has lost entries
+    since the last rebuild, so it may miss investments that now rank in it.
+    """
+    shards = client.get_multi([_shard_key(client, shard) for shard in range(NUM_SHARDS)])
+    if not shards:
+        return None
+
+    merged = _empty_stats()
+    merged['shortTop'] = set()
+    for entity in shards:
+        stats = _decode(entity)
+        merged['total'] += stats['total']
+        for dimension in DIMENSIONS:
+            for value, count in stats[dimension].items():
+                merged[dimension][value] = merged[dimension].get(value, 0) + count
+        for category, top in stats['top'].items():
+            merged['top'].setdefault(category, []).extend(top)
+
+        for category, count in stats['category'].items():
+            if len(stats['top'].get(category, [])) < min(TOP_N, count):
+                merged['shortTop'].add(category)
+
+    for category, top in merged['top'].items():
+        top.sort(key=lambda item: item['marketValueNok'], reverse=True)
+        merged['top'][category] = top[:TOP_N]
+    return merged
+
+def rebuild_stats(client):
+    """Rebuilds the stats index from a full scan of all investments."""
+    print("Rebuilding stats index from a full scan...")
+    shards = [_empty_stats() for _ in range(NUM_SHARDS)]
+    query = client.query(kind='Investment')
+    for entity in query.fetch():
+        summary = summarize(entity)
+        if summary is not None:
+            _apply(shards[_shard_for(summary['id'])], None, summary)
+
+    client.put_multi([_encode(client, shard, stats) for shard, stats in enumerate(shards)])
+    print(f"Stats index rebuilt from {sum(stats['total'] for stats in shards)} investments.")
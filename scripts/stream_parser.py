@@ -0,0 +1,143 @@
+import json
+from jsonschema import ValidationError
+
+WHITESPACE = ' \t\r\n'
+
+class StreamParseError(ValueError):
+    pass
+
+class SectionParser:
+    """
+    Parses a JSON object as its text arrives in chunks. feed() returns every top-level
+    member that completed in the chunk as a (name, value) pair, so a section can be
+    used before the rest of the object has been generated. Malformed text is raised as
+    a StreamParseError as soon as the member that contains it is complete.
+    """
+
+    def __init__(self):
+        self.sections = {}
+        self.closed = False
+        self._buffer = ''
+        self._position = 0 # Next character of the buffer to scan
+        self._member_start = None # Start of the current member, once the opening brace has been seen
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text):
+        self._buffer += text
+        completed = []
+        while self._position < len(self._buffer):
+            char = self._buffer[self._position]
+            self._position += 1
+            if self.closed:
+                if char not in WHITESPACE:
+                    raise StreamParseError(f"Unexpected text after the end of the object: {char!r}")
+            elif self._member_start is None:
+                if char == '{':
+                    self._depth = 1
+                    self._member_start = self._position
+                elif char not in WHITESPACE:
+                    raise StreamParseError(f"Expected a JSON object, got {char!r}")
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in '{[':
+                self._depth += 1
+            elif char in '}]':
+                self._depth -= 1
+                if self._depth == 0:
+                    completed += self._complete_member(last=True)
+            elif char == ',' and self._depth == 1:
+                completed += self._complete_member(last=False)
+        # Only the unscanned part and the current member are needed from here on
+        start = min(self._position, self._member_start if self._member_start is not None else self._position)
+        self._buffer = self._buffer[start:]
+        self._position -= start
+        if self._member_start is not None:
+            self._member_start -= start
+        return completed
+
+    def _complete_member(self, last):
+        member = self._buffer[self._member_start:self._position - 1]
+        self._member_start = self._position
+        if last:
+            self.closed = True
+            if not member.strip() and not self.sections:
+                return [] # An empty object
+        if not member.strip():
+            raise StreamParseError(f"Empty member after {len(self.sections)} sections")
+        try:
+            ((name, value),) = json.loads('{' + member + '}').items()
+        except (ValueError, TypeError) as e:
+            raise StreamParseError(f"Malformed member after {len(self.sections)} sections: {e}")
+        self.sections[name] = value
+        return [(name, value)]
+
+    def close(self):
+        """Returns the parsed object, raising a StreamParseError if the text ended before it did."""
+        if not self.closed:
+            raise StreamParseError(f"The response ended before the object was complete ({len(self.sections)} sections parsed)")
+        return self.sections
+
+class InvalidSectionError(ValidationError):
+    """A streamed report broke its schema. `partial` holds the sections that validated before it."""
+
+    def __init__(self, message, partial, errors):
+        super().__init__(message)
+        self.partial = partial
+        self.errors = errors
+
+class StreamingReport:
+    """
+    Parses a streamed report and checks each top-level section against its compiled
+    schema as soon as it is complete, calling `on_event` with a dict for every step:
+    'chunk' (with the characters received so far), 'section' (a section that
+    validated) and 'invalid' (the section that did not, and why). The first invalid
+    or malformed section raises an InvalidSectionError, so the caller can stop the
+    stream instead of waiting for the rest of it.
+    """
+
+    def __init__(self, schema, on_event=None):
+        self.schema = schema
+        self.on_event = on_event or (lambda event: None)
+        self.parser = SectionParser()
+        self.partial = {}
+        self.received = 0
+
+    def _invalid(self, section, errors):
+        """Reports a problem with one section, or with the report as a whole if `section` is None."""
+        self.on_event({'type': 'invalid', 'section': section, 'errors': errors})
+        subject = f"Section '{section}'" if section else "The report"
+        return InvalidSectionError(f"{subject} is invalid: {'; '.join(errors)}", dict(self.partial), errors)
+
+    def feed(self, text):
+        self.received += len(text)
+        self.on_event({'type': 'chunk', 'chars': self.received})
+        try:
+            sections = self.parser.feed(text)
+        except StreamParseError as e:
+            raise self._invalid(None, [str(e)])
+        for name, value in sections:
+            errors = self.schema.section_errors(name, value)
+            if errors:
+                raise self._invalid(name, errors)
+            self.partial[name] = value
+            self.on_event({'type': 'section', 'section': name, 'sections': len(self.partial)})
+
+    def close(self):
+        """Returns the complete report once the whole object has also passed its schema."""
+        try:
+            report = self.parser.close()
+        except StreamParseError as e:
+            raise self._invalid(None, [str(e)])
+        errors = self.schema.errors(report)
+        if errors:
+            raise self._invalid(None, errors)
+        return report
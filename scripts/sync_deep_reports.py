@@ -1,16 +1,46 @@
 import os
 import json
+import time
+import asyncio
 import argparse
+from requests.adapters import HTTPAdapter
 from google.cloud import datastore, storage
-from vertex_functions import vertex_generate_deep_report, load_pdf_bytes
+from timestamps import stamp_updated
+from stats_index import put_with_stats
+from vertex_functions import DEEP_MODEL, get_response_cache, set_response_cache, vertex_generate_deep_report, load_pdf_bytes
+from rate_limiter import get_limiter, set_limits
+from stream_parser import InvalidSectionError
+from response_cache import ResponseCache
+from gcs_sync import sync_files_to_gcs
+from metrics import get_metrics
+
+WORKERS = 4 # Deep reports generated at the same time
+DEEP_TIMEOUT = 300
+GET_MULTI_LIMIT = 1000 # Datastore's maximum number of keys per lookup
+
+_storage_client = None
+
+def get_storage_client(pool_size=WORKERS * 2):
+    """Returns one storage client for the whole run, with a connection pool sized for parallel uploads."""
+    global _storage_client
+    if _storage_client is None:
+        _storage_client = storage.Client()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        _storage_client._http.mount('https://', adapter)
+    return _storage_client
+
+def set_storage_client(client):
+    """Replaces the storage client for the run, e.g. with a local stand-in for benchmarks."""
+    global _storage_client
+    _storage_client = client
 
 def upload_to_gcs(bucket_name, source_file_path, destination_blob_name):
     """Uploads a file to the bucket."""
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
+    bucket = get_storage_client().bucket(bucket_name)
     blob = bucket.blob(destination_blob_name)
 
-    blob.upload_from_filename(source_file_path)
+    with get_metrics().track('gcs_upload'):
+        blob.upload_from_filename(source_file_path)
 
     print(f"File {source_file_path} uploaded to {destination_blob_name}.")
 
@@ -19,19 +49,102 @@ def get_investment_by_id(client, company_id):
     key = client.key('Investment', company_id)
     return client.get(key)
 
+def get_investments_by_ids(client, company_ids):
+    """Fetches the investments for many ids with batched lookups, keyed by id."""
+    investments = {}
+    for start in range(0, len(company_ids), GET_MULTI_LIMIT):
+        keys = [client.key('Investment', company_id) for company_id in company_ids[start:start + GET_MULTI_LIMIT]]
+        for entity in client.get_multi(keys):
+            investments[entity.key.name] = entity
+    return investments
+
 def update_investment(client, investment_entity):
     """Updates a single investment entity in Datastore."""
-    client.put(investment_entity)
+    stamp_updated(investment_entity)
+    with get_metrics().track('datastore_commit'):
+        put_with_stats(client, [investment_entity])
+    get_metrics().inc('investments', state=investment_entity.get('state'))
+
+def print_progress(company_id):
+    """Returns a deep report event handler that prints each section as it arrives."""
+    def on_event(event):
+        if event['type'] == 'section':
+            print(f"{company_id}: received section '{event['section']}' ({event['sections']} so far).")
+        elif event['type'] == 'invalid':
+            print(f"{company_id}: section '{event['section'] or '(report)'}' failed validation; stopping the stream.")
+    return on_event
+
+async def process_pdf(client, semaphore, bucket_name, pdf_path, investment_entity):
+    """
+    Generates the deep report for one PDF, then uploads the PDF and saves the report.
+    Only generation holds a worker slot, so the upload and save of one PDF overlap
+    with the generation of the next. Returns True on success. A failure is saved as
+    'error_deep' without the report, and a failure to save that is only printed, so
+    one PDF cannot stop the others. When the report broke its schema partway, the
+    sections that validated before it are kept as 'deepReportPartial'.
+    """
+    company_id = investment_entity.key.name
+    previous_report = investment_entity.get('deepReport')
+    try:
+        async with semaphore:
+            print(f"\n--- Processing: {company_id} ({investment_entity.get('name', company_id)}) ---")
+            pdf_bytes = await asyncio.to_thread(load_pdf_bytes, pdf_path)
+            deep_report_data = await vertex_generate_deep_report(
+                pdf_bytes, "full.schema.json", timeout=DEEP_TIMEOUT, on_event=print_progress(company_id)
+            )
+            print(f"Generated deep report for '{company_id}'.")
+
+        investment_entity['deepReport'] = deep_report_data
+        investment_entity['state'] = 'done_deep'
+        investment_entity.pop('deepReportPartial', None)
 
-def sync_deep_reports(force_gcs=False):
+        await asyncio.to_thread(upload_to_gcs, bucket_name, pdf_path, f"{company_id}.pdf")
+        await asyncio.to_thread(update_investment, client, investment_entity)
+        print(f"Successfully updated Datastore for '{company_id}'.")
+        return True
+
+    except Exception as e:
+        print(f"Error processing {company_id}: {e}")
+        if isinstance(e, InvalidSectionError) and e.partial:
+            print(f"Keeping the sections that validated before it: {', '.join(e.partial)}")
+            investment_entity['deepReportPartial'] = e.partial
+        # The report may have been set before the upload or save failed; it is not stored with the error
+        if previous_report is None:
+            investment_entity.pop('deepReport', None)
+        else:
+            investment_entity['deepReport'] = previous_report
+        investment_entity['state'] = 'error_deep'
+        try:
+            await asyncio.to_thread(update_investment, client, investment_entity)
+        except Exception as save_error:
+            print(f"Could not mark '{company_id}' with state 'error_deep': {save_error}")
+            return False
+        print(f"Marked '{company_id}' with state 'error_deep'.")
+        return False
+
+async def generate_deep_reports(client, bucket_name, work, workers):
+    """Processes (pdf_path, investment) pairs with at most `workers` deep reports generated at once."""
+    semaphore = asyncio.Semaphore(workers)
+    results = await asyncio.gather(*(
+        process_pdf(client, semaphore, bucket_name, pdf_path, investment_entity)
+        for pdf_path, investment_entity in work
+    ), return_exceptions=True)
+    for (pdf_path, _), result in zip(work, results):
+        if isinstance(result, BaseException):
+            print(f"Unexpected error processing {pdf_path}: {result}")
+    return [result is True for result in results]
+
+def sync_deep_reports(force_gcs=False, workers=WORKERS, reupload=False, metrics_summary=None):
     """
     Scans a directory for PDF reports, checks which ones are missing a deep report
-    in Datastore, and generates them. Can also force upload all local PDFs to GCS.
+    in Datastore, and generates them, `workers` at a time. With `force_gcs`, it
+    instead syncs all local PDFs to GCS, uploading only new or changed files
+    unless `reupload` is set.
     """
     reports_dir = 'frontend/public/reports'
     client = datastore.Client(database='investment-reports')
     bucket_name = 'oljevakt-investments'
-    
+
     if not os.path.isdir(reports_dir):
         print(f"Error: Reports directory not found at '{reports_dir}'")
         return
@@ -40,60 +153,69 @@ def sync_deep_reports(force_gcs=False):
     print(f"Found {len(pdf_files)} PDF files in '{reports_dir}'.")
 
     if force_gcs:
-        print("\n--- Force uploading all PDFs to GCS ---")
-        for pdf_file in pdf_files:
-            company_id = os.path.splitext(pdf_file)[0]
-            pdf_path = os.path.join(reports_dir, pdf_file)
-            try:
-                upload_to_gcs(bucket_name, pdf_path, f"{company_id}.pdf")
-            except Exception as e:
-                print(f"Error uploading {pdf_file}: {e}")
+        print("\n--- Syncing all PDFs to GCS ---")
+        files = {os.path.join(reports_dir, pdf_file): pdf_file for pdf_file in pdf_files}
+        bucket = get_storage_client(workers * 2).bucket(bucket_name)
+        sync_files_to_gcs(bucket, files, workers=workers * 2, force=reupload)
         return
 
-    for pdf_file in pdf_files:
-        company_id = os.path.splitext(pdf_file)[0]
-        pdf_path = os.path.join(reports_dir, pdf_file)
-        
-        print(f"\n--- Processing: {company_id} ---")
-        
-        investment_entity = get_investment_by_id(client, company_id)
+    # Look up every investment at once instead of one round trip per PDF
+    company_ids = [os.path.splitext(pdf_file)[0] for pdf_file in pdf_files]
+    investments = get_investments_by_ids(client, company_ids)
 
+    work = []
+    for pdf_file, company_id in zip(pdf_files, company_ids):
+        investment_entity = investments.get(company_id)
         if not investment_entity:
             print(f"Warning: No investment found for ID '{company_id}'. Skipping.")
-            continue
-            
-        if investment_entity.get('state') == 'done_deep':
+        elif investment_entity.get('state') == 'done_deep':
             print(f"Deep report already exists for '{company_id}'. Skipping.")
-            continue
+        else:
+            work.append((os.path.join(reports_dir, pdf_file), investment_entity))
 
-        print(f"Found existing investment for '{investment_entity.get('name', company_id)}'.")
-        
-        try:
-            print(f"Generating deep report from {pdf_path}...")
-            pdf_bytes = load_pdf_bytes(pdf_path)
-            schema_filename = "full.schema.json"
-            deep_report_data = vertex_generate_deep_report(pdf_bytes, schema_filename)
-            print("Successfully generated and validated deep report data.")
-            
-            investment_entity['deepReport'] = deep_report_data
-            investment_entity['state'] = 'done_deep'
-            
-            print("Uploading report to GCS...")
-            upload_to_gcs(bucket_name, pdf_path, f"{company_id}.pdf")
-            
-            print("Updating entity in Datastore...")
-            update_investment(client, investment_entity)
-            print(f"Successfully updated Datastore for '{company_id}'.")
-
-        except Exception as e:
-            print(f"Error processing {company_id}: {e}")
-            investment_entity['state'] = 'error_deep'
-            update_investment(client, investment_entity)
-            print(f"Marked '{company_id}' with state 'error_deep'.")
+    if not work:
+        print("No PDFs need a deep report.")
+        return
+
+    print(f"\nGenerating {len(work)} deep reports with {workers} workers...")
+    get_storage_client(workers * 2)
+    start = time.monotonic()
+    results = asyncio.run(generate_deep_reports(client, bucket_name, work, workers))
+
+    print(f"\nFinished {sum(results)} deep reports with {len(results) - sum(results)} errors "
+          f"in {time.monotonic() - start:.0f}s.")
+    get_response_cache().print_stats()
+    get_limiter(DEEP_MODEL).print_stats()
+    get_metrics().print_summary()
+    if metrics_summary:
+        get_metrics().write_summary(metrics_summary)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Sync deep research reports with Datastore and GCS.")
-    parser.add_argument('--force-gcs', action='store_true', help='Force upload all local PDF reports to GCS.')
+    parser.add_argument('--force-gcs', action='store_true',
+                        help='Sync all local PDF reports to GCS, uploading only files the bucket does not already have.')
+    parser.add_argument('--reupload', action='store_true',
+                        help='With --force-gcs, upload every file even if the bucket has the same bytes.')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f'Number of deep reports generated at the same time. Defaults to {WORKERS}; 1 runs them one by one.')
+    parser.add_argument('--no-response-cache', action='store_true',
+                        help='Call the model even for PDFs with a report in the local response cache.')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve OpenMetrics on this port at /metrics, and a JSON summary at /summary, during the run.')
+    parser.add_argument('--metrics-summary', default=None,
+                        help='Write the JSON run summary with per-stage latencies and token usage to this file.')
+    parser.add_argument('--rpm', type=int, default=None,
+                        help=f'Requests per minute allowed for {DEEP_MODEL}. Defaults to its entry in rate_limiter.MODEL_LIMITS.')
+    parser.add_argument('--tpm', type=int, default=None,
+                        help=f'Tokens per minute allowed for {DEEP_MODEL}. Defaults to its entry in rate_limiter.MODEL_LIMITS.')
     args = parser.parse_args()
 
-    sync_deep_reports(force_gcs=args.force_gcs)
+    if args.rpm or args.tpm:
+        set_limits(DEEP_MODEL, args.rpm, args.tpm)
+    if args.no_response_cache:
+        set_response_cache(ResponseCache(enabled=False))
+    if args.metrics_port:
+        get_metrics().serve(args.metrics_port)
+
+    sync_deep_reports(force_gcs=args.force_gcs, workers=args.workers, reupload=args.reupload,
+                      metrics_summary=args.metrics_summary)
@@ -1,5 +1,7 @@
+import asyncio
 import json
-from vertex_functions import vertex_generate_shallow_report
+from vertex_functions import ShallowReportEngine, load_pdf_bytes, load_prompt_template
+from vertex_schema import SHALLOW_SCHEMA
 
 def main():
     with open('./investments.json', 'r', encoding='utf-8') as f:
@@ -17,8 +19,10 @@ def main():
     print("Sending the following data to Vertex AI:")
     print(companies_data_string)
     
-    # Call the Vertex AI function
-    results = vertex_generate_shallow_report(companies_data_string)
+    # Call the Vertex AI function through the engine, which keeps it within the model's quota
+    engine = ShallowReportEngine(load_pdf_bytes('scripts/etchical_guidelines.pdf'), SHALLOW_SCHEMA)
+    prompt = load_prompt_template().format(companies_data=companies_data_string)
+    results = asyncio.run(engine.generate(prompt))
     
     print("\nReceived the following results:")
     print(json.dumps(results, indent=2))
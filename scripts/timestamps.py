@@ -0,0 +1,9 @@
+from datetime import datetime, timezone
+
+def now_utc():
+    return datetime.now(timezone.utc)
+
+def stamp_updated(investment, now=None):
+    """Sets 'updatedAt', which lets the exporter's --since mode find changed investments."""
+    investment['updatedAt'] = now or now_utc()
+    return investment
@@ -2,44 +2,25 @@ import os
 from json import loads
 from google import genai
 from google.genai import types
-from vertex_schema import load_schema_by_name
-import multiprocessing
-import queue
+from vertex_schema import get_schema
+from context_cache import is_cache_expired_error
+from response_cache import ResponseCache, make_key
+from metrics import get_metrics
+from rate_limiter import estimate_tokens, get_limiter, total_tokens, usage_tokens
+from stream_parser import InvalidSectionError, StreamingReport
+import asyncio
+
+PROJECT = "oljefondvakt"
+LOCATION = "global"
+SHALLOW_MODEL = "gemini-2.5-flash"
+DEEP_MODEL = "gemini-2.5-pro"
+
+_shared_client = None
+_response_cache = None
 
 class TimeoutException(Exception):
     pass
 
-def _vertex_call_wrapper(queue, model, contents, config):
-    """Wrapper to run the blocking API call in a separate process."""
-    try:
-        if model == "gemini-2.5-pro":
-            print(f"[{os.getpid()}] Starting Vertex AI call for model: {model}...")
-        client = genai.Client(vertexai=True, project="oljefondvakt", location="global")
-        
-        # Determine if we should stream based on model
-        if model == "gemini-2.5-pro":
-            stream = client.models.generate_content_stream(model=model, contents=contents, config=config)
-            full_response_list = []
-            print(f"[{os.getpid()}] Streaming response:\n---")
-            for chunk in stream:
-                print(chunk.text, end="", flush=True)
-                full_response_list.append(chunk.text)
-            print("\n---")
-            full_response = "".join(full_response_list)
-            queue.put(loads(full_response))
-        else:
-            response = client.models.generate_content(model=model, contents=contents, config=config)
-            queue.put(loads(response.text))
-        
-        if model == "gemini-2.5-pro":
-            print(f"[{os.getpid()}] Vertex AI call finished successfully.")
-
-    except Exception as e:
-        error_message = f"Vertex AI call failed: {e}"
-        if model == "gemini-2.5-pro":
-            print(f"[{os.getpid()}] {error_message}")
-        queue.put(error_message)
-
 def load_pdf_bytes(pdf_path):
     if not os.path.exists(pdf_path):
         raise FileNotFoundError(f"The file {pdf_path} was not found.")
@@ -51,28 +32,51 @@ def load_prompt_template():
     with open(prompt_path, 'r', encoding='utf-8') as f:
         return f.read()
 
-def vertex_generate_shallow_report(ethical_guidelines_pdf_bytes, prompt, schema_filename):
-  client = genai.Client(
-      vertexai=True,
-      project="oljefondvakt",
-      location="global",
-  )
+def get_shared_client():
+    """Returns the process-wide GenAI client, creating it on first use."""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = genai.Client(vertexai=True, project=PROJECT, location=LOCATION)
+    return _shared_client
 
-  document1 = types.Part.from_bytes(
-      data=ethical_guidelines_pdf_bytes,
-      mime_type="application/pdf",
-  )
-  
+def set_shared_client(client):
+    """Replaces the process-wide GenAI client, e.g. with a local stand-in for benchmarks."""
+    global _shared_client
+    _shared_client = client
+
+def get_response_cache():
+    """Returns the process-wide on-disk response cache, creating it on first use."""
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
+
+def set_response_cache(response_cache):
+    """Replaces the process-wide response cache, e.g. with ResponseCache(enabled=False) to bypass it."""
+    global _response_cache
+    _response_cache = response_cache
+
+def _context_prompt_text(cached_context):
+    """Returns the prompt text held in a context cache, which precedes each batch prompt."""
+    return ''.join(part.text or '' for content in cached_context.contents for part in content.parts)
+
+def _build_shallow_request(ethical_guidelines_pdf_bytes, prompt, response_schema, cached_content=None):
   text1 = types.Part.from_text(text=prompt)
 
-  model = "gemini-2.5-flash"
+  if cached_content:
+    # The guidelines PDF is already part of the cached context
+    parts = [text1]
+  else:
+    document1 = types.Part.from_bytes(
+        data=ethical_guidelines_pdf_bytes,
+        mime_type="application/pdf",
+    )
+    parts = [document1, text1]
+
   contents = [
     types.Content(
       role="user",
-      parts=[
-        document1,
-        text1
-      ]
+      parts=parts
     )
   ]
 
@@ -82,30 +86,12 @@ def vertex_generate_shallow_report(ethical_guidelines_pdf_bytes, prompt, schema_
     seed = 0,
     max_output_tokens = 65535,
     response_mime_type = "application/json",
-    response_schema = load_schema_by_name(schema_filename)
-
+    response_schema = response_schema,
+    cached_content = cached_content
   )
+  return contents, generate_content_config
 
-  result_queue = multiprocessing.Queue()
-  process = multiprocessing.Process(
-      target=_vertex_call_wrapper,
-      args=(result_queue, model, contents, generate_content_config)
-  )
-  
-  process.start()
-  process.join(timeout=120) # 2-minute timeout
-
-  if process.is_alive():
-      process.terminate()
-      process.join()
-      raise TimeoutException("Vertex AI call timed out")
-
-  result = result_queue.get()
-  if isinstance(result, Exception):
-      raise result
-      
-  results = result
-  
+def _clean_shallow_reports(results):
   # Post-process the results to clean up the guidelines
   for report in results:
       if 'riskAssessment' in report and 'guidelines' in report['riskAssessment']:
@@ -114,51 +100,195 @@ def vertex_generate_shallow_report(ethical_guidelines_pdf_bytes, prompt, schema_
           
   return results
 
-def vertex_generate_deep_report(pdf_bytes, schema_filename):
-    """Generates a structured deep report from a PDF using Vertex AI."""
-    
-    client = genai.Client(vertexai=True, project="oljefondvakt", location="global")
+class ShallowReportEngine:
+    """
+    Generates shallow reports on one shared async client. At most `max_in_flight`
+    requests are outstanding at a time, and a request running longer than
+    `timeout` seconds is cancelled and raised as a TimeoutException.
 
-    pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-    prompt_part = types.Part.from_text(
-        text="""Analyze the attached PDF document, which is a detailed risk assessment report. It will contain product-based and conduct-based risk as well as key geopolitical conflicts risk exposure.Extract all relevant information and structure it according to the provided JSON schema.
+    With a `cached_context`, the guidelines PDF and the prompt prefix are sent
+    once as a context cache and each prompt only carries the batch-specific part.
+
+    Responses are stored in `response_cache` (the process-wide one by default),
+    keyed on the full prompt, so a rerun of the same batch costs no model call.
+
+    Calls go through `limiter` (the process-wide one for the model by default),
+    which keeps them within the model's quota and retries quota errors. Every
+    attempt and its tokens are charged to `budget`, a scheduling.RunBudget, if given,
+    including attempts that fail, time out or are retried after a quota error.
+    """
+
+    def __init__(self, ethical_guidelines_pdf_bytes, schema_filename, max_in_flight=10, timeout=120, client=None,
+                 cached_context=None, response_cache=None, limiter=None, budget=None):
+        self.pdf_bytes = ethical_guidelines_pdf_bytes
+        self.schema = get_schema(schema_filename)
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.client = client or get_shared_client()
+        self.cached_context = cached_context
+        self.response_cache = response_cache or get_response_cache()
+        self.limiter = limiter or get_limiter(SHALLOW_MODEL)
+        self.budget = budget
+        # Cached and uncached runs send the same full prompt, so they share cache entries
+        self.prompt_prefix = _context_prompt_text(cached_context) if cached_context else ''
+        self._semaphore = None
+
+    def _get_semaphore(self):
+        # Created lazily so it belongs to the event loop that runs the engine.
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphore
+
+    def _cache_key(self, prompt):
+        return make_key(SHALLOW_MODEL, self.pdf_bytes, self.prompt_prefix + prompt, self.schema.schema)
+
+    def cached(self, prompt):
+        """Returns the stored reports for a prompt without calling the model, or None."""
+        text = self.response_cache.get(self._cache_key(prompt))
+        return None if text is None else _clean_shallow_reports(loads(text))
+
+    def discard(self, prompt):
+        """Drops the cached response for a prompt whose reports were rejected, so a retry calls the model again."""
+        self.response_cache.delete(self._cache_key(prompt))
+
+    async def generate(self, prompt):
+        """Generates the shallow reports for one prompt."""
+        cached = await asyncio.to_thread(self.cached, prompt)
+        if cached is not None:
+            return cached
+
+        if self.cached_context is None:
+            response = await self._call(prompt, None)
+        else:
+            cache_name = await self.cached_context.get_name()
+            try:
+                response = await self._call(prompt, cache_name)
+            except Exception as e:
+                if not is_cache_expired_error(e):
+                    raise
+                # The cache expired mid-run; recreate it and retry once
+                self.cached_context.invalidate(cache_name)
+                response = await self._call(prompt, await self.cached_context.get_name())
+
+        results = loads(response.text)
+        # Only responses that parse are cached, so a malformed one is retried on the next run
+        await asyncio.to_thread(self.response_cache.put, self._cache_key(prompt), SHALLOW_MODEL, response.text)
+        return _clean_shallow_reports(results)
+
+    async def _call(self, prompt, cache_name):
+        contents, generate_content_config = _build_shallow_request(
+            self.pdf_bytes, prompt, self.schema.response_schema, cache_name
+        )
+        metrics = get_metrics()
+
+        async def call():
+            # The limiter's waits and backoffs happen before this, so they hold no slot,
+            # and neither they nor the wait for a slot count toward the timeout
+            async with self._get_semaphore():
+                response = None
+                with metrics.track('shallow_generate', model=SHALLOW_MODEL):
+                    try:
+                        response = await asyncio.wait_for(
+                            self.client.aio.models.generate_content(
+                                model=SHALLOW_MODEL, contents=contents, config=generate_content_config
+                            ),
+                            timeout=self.timeout,
+                        )
+                        return response
+                    except asyncio.TimeoutError:
+                        raise TimeoutException(f"Vertex AI call timed out after {self.timeout}s")
+                    finally:
+                        # Every attempt is charged; failed ones have no usage to report
+                        if self.budget is not None:
+                            self.budget.spend(total_tokens(response) if response is not None else None)
+
+        response = await self.limiter.call(call, estimate_tokens(contents), total_tokens)
+        metrics.record_usage('shallow_generate', SHALLOW_MODEL, response.usage_metadata)
+        return response
+
+DEEP_PROMPT = """Analyze the attached PDF document, which is a detailed risk assessment report. It will contain product-based and conduct-based risk as well as key geopolitical conflicts risk exposure.Extract all relevant information and structure it according to the provided JSON schema.
 
 Key formatting instructions:
 - For the `guidelines` field, use the format 'section.letter' (e.g., '4.e', '3.d').
 - The `category` must be one of the following: "1", "2", "3", or "4".
 
 All text must be in English."""
-    )
-    
-    model = "gemini-2.5-pro"
+
+def _build_deep_request(pdf_bytes, response_schema):
+    pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+    prompt_part = types.Part.from_text(text=DEEP_PROMPT)
     contents = [types.Content(role="user", parts=[pdf_part, prompt_part])]
-    
+
     generate_content_config = types.GenerateContentConfig(
         temperature=0,
         response_mime_type="application/json",
-        response_schema=load_schema_by_name(schema_filename)
+        response_schema=response_schema
     )
+    return contents, generate_content_config
+
+async def vertex_generate_deep_report(pdf_bytes, schema_filename, timeout=300, client=None, response_cache=None,
+                                      on_event=None):
+    """
+    Generates a structured deep report from a PDF by streaming the response on the
+    shared async client, so several reports can be generated at once in one process.
+    A call running longer than `timeout` seconds raises a TimeoutException. A report
+    already generated for the same PDF, prompt and schema is returned from
+    `response_cache` (the process-wide one by default) without calling the model.
+    Calls are kept within the deep model's quota, and quota errors are retried.
+
+    Each top-level section is validated against the schema as soon as it has been
+    streamed. The first malformed or invalid one stops the stream and raises an
+    InvalidSectionError holding the sections that validated before it. Progress is
+    passed to `on_event` as dicts; see stream_parser.StreamingReport.
+    """
+    schema = get_schema(schema_filename)
+    response_cache = response_cache or get_response_cache()
+    cache_key = make_key(DEEP_MODEL, pdf_bytes, DEEP_PROMPT, schema.schema)
+    text = await asyncio.to_thread(response_cache.get, cache_key)
+    if text is not None:
+        print("Using cached deep report for this PDF.")
+        return loads(text)
+
+    client = client or get_shared_client()
+    contents, generate_content_config = _build_deep_request(pdf_bytes, schema.response_schema)
 
-    result_queue = multiprocessing.Queue()
-    process = multiprocessing.Process(
-        target=_vertex_call_wrapper,
-        args=(result_queue, model, contents, generate_content_config)
+    metrics = get_metrics()
+    usage = []
+
+    async def stream():
+        chunks = []
+        report = StreamingReport(schema, on_event)
+        response = await client.aio.models.generate_content_stream(
+            model=DEEP_MODEL, contents=contents, config=generate_content_config
+        )
+        try:
+            async for chunk in response:
+                if chunk.text:
+                    chunks.append(chunk.text)
+                    report.feed(chunk.text)
+                if chunk.usage_metadata:
+                    # The last chunk carries the totals for the whole response
+                    usage[:] = [chunk.usage_metadata]
+        finally:
+            # Closes the connection when an invalid section stops the stream early
+            if hasattr(response, 'aclose'):
+                await response.aclose()
+        return "".join(chunks), report.close()
+
+    async def call():
+        with metrics.track('deep_generate', model=DEEP_MODEL):
+            try:
+                return await asyncio.wait_for(stream(), timeout=timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutException(f"Vertex AI call for deep report timed out after {timeout}s")
+            except InvalidSectionError:
+                metrics.inc('validation_failures', stage='deep_generate', scope='section')
+                raise
+
+    text, result = await get_limiter(DEEP_MODEL).call(
+        call, estimate_tokens(contents), lambda _: usage_tokens(usage[-1] if usage else None)
     )
-    
-    process.start()
-    try:
-        # Wait for the result to appear on the queue, with a timeout.
-        result = result_queue.get(timeout=300)
-    except queue.Empty:
-        raise TimeoutException("Vertex AI call for deep report timed out")
-    finally:
-        # Always ensure the child process is terminated.
-        if process.is_alive():
-            process.terminate()
-            process.join()
-
-    if isinstance(result, str):
-        raise Exception(result)
-        
-    return result
+    metrics.record_usage('deep_generate', DEEP_MODEL, usage[-1] if usage else None)
 
+    await asyncio.to_thread(response_cache.put, cache_key, DEEP_MODEL, text)
+    return result
@@ -1,12 +1,125 @@
 import os
+import copy
 import json
+import threading
+from google.genai import types
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
+
+SCHEMA_DIR = os.path.dirname(__file__)
+SHALLOW_SCHEMA = 'shallow.schema.json'
+# Fields the shallow model only echoes back so each report can be matched to its company.
+# They are dropped before a report is stored, so the stored report has its own schema.
+SHALLOW_MATCH_FIELDS = ('id',)
+
+class CompiledSchema:
+    """
+    One schema file, loaded once: the JSON schema, its GenAI SDK version and
+    Draft7Validators for the whole schema and, for list schemas, for one item.
+    The validators are built once and reused for every report.
+    """
+
+    def __init__(self, filename, schema):
+        Draft7Validator.check_schema(schema)
+        self.filename = filename
+        # The Google GenAI library does not expect the '$schema' key
+        self.schema = {key: value for key, value in schema.items() if key != '$schema'}
+        # The SDK rewrites schema dicts in place, so it gets its own converted copy
+        self.response_schema = types.Schema.model_validate(copy.deepcopy(self.schema))
+        self.validator = Draft7Validator(schema)
+        items = schema.get('items') if schema.get('type') == 'array' else None
+        self.item_validator = Draft7Validator(items) if isinstance(items, dict) else None
+        # Validators for the top-level properties of an object schema, e.g. for streamed reports
+        self.section_validators = {name: Draft7Validator(prop) for name, prop in schema.get('properties', {}).items()}
+
+    def _validator(self, items):
+        if items and self.item_validator is None:
+            raise ValueError(f"{self.filename} is not a list schema")
+        return self.item_validator if items else self.validator
+
+    def validate(self, instance, items=False):
+        """Raises the most relevant ValidationError, like jsonschema.validate, if `instance` is invalid."""
+        error = best_match(self._validator(items).iter_errors(instance))
+        if error is not None:
+            raise error
+
+    def errors(self, instance, items=False):
+        """Returns every validation error message for `instance`, each prefixed with its path."""
+        messages = []
+        for error in sorted(self._validator(items).iter_errors(instance), key=lambda e: list(map(str, e.absolute_path))):
+            path = '.'.join(str(part) for part in error.absolute_path)
+            messages.append(f"{path}: {error.message}" if path else error.message)
+        return messages
+
+    def section_errors(self, name, value):
+        """
+        Returns the error messages for one top-level property of an object schema, each
+        prefixed with its path. Properties the schema does not describe are not checked.
+        """
+        validator = self.section_validators.get(name)
+        if validator is None:
+            return []
+        messages = []
+        for error in sorted(validator.iter_errors(value), key=lambda e: list(map(str, e.absolute_path))):
+            messages.append('.'.join([name] + [str(part) for part in error.absolute_path]) + f": {error.message}")
+        return messages
+
+    def validate_many(self, instances, items=True):
+        """
+        Validates many instances with the same compiled validator. By default each
+        instance is checked as one item of a list schema. Returns the error messages
+        of every invalid instance, keyed by its index; valid instances are left out.
+        """
+        invalid = {}
+        for index, instance in enumerate(instances):
+            messages = self.errors(instance, items)
+            if messages:
+                invalid[index] = messages
+        return invalid
+
+class SchemaRegistry:
+    """Loads and compiles each schema file in `schema_dir` the first time it is asked for."""
+
+    def __init__(self, schema_dir=SCHEMA_DIR):
+        self.schema_dir = schema_dir
+        self._schemas = {}
+        self._lock = threading.Lock()
+
+    def get(self, filename):
+        with self._lock:
+            compiled = self._schemas.get(filename)
+            if compiled is None:
+                with open(os.path.join(self.schema_dir, filename), 'r') as f:
+                    compiled = CompiledSchema(filename, json.load(f))
+                self._schemas[filename] = compiled
+            return compiled
+
+    def get_item(self, filename, without=()):
+        """Returns the compiled schema of one item of a list schema, with the `without` properties left out."""
+        base = self.get(filename)
+        key = (filename, 'items', tuple(without))
+        with self._lock:
+            compiled = self._schemas.get(key)
+            if compiled is None:
+                items = copy.deepcopy(base.schema['items'])
+                for name in without:
+                    items.get('properties', {}).pop(name, None)
+                if 'required' in items:
+                    items['required'] = [name for name in items['required'] if name not in without]
+                compiled = CompiledSchema(f"{filename}#items", items)
+                self._schemas[key] = compiled
+            return compiled
+
+_registry = SchemaRegistry()
+
+def get_schema(filename):
+    """Returns the compiled schema for a file in the scripts directory, loading it on first use."""
+    return _registry.get(filename)
+
+def get_stored_shallow_schema():
+    """Returns the compiled schema of one shallow report as it is stored on an investment."""
+    return _registry.get_item(SHALLOW_SCHEMA, SHALLOW_MATCH_FIELDS)
 
 def load_schema_by_name(filename):
-    """Loads a schema from the scripts directory and removes the '$schema' key."""
-    schema_path = os.path.join(os.path.dirname(__file__), filename)
-    with open(schema_path, 'r') as f:
-        schema = json.load(f)
-    # The Google GenAI library does not expect the '$schema' key
-    if '$schema' in schema:
-        del schema['$schema']
-    return schema
+    """Returns a schema from the scripts directory without the '$schema' key. It is shared, so do not modify it."""
+    return get_schema(filename).schema